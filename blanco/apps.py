@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class BlancoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'blanco'
+
+    def ready(self):
+        # Registrar las señales que invalidan el índice de palabras
+        from . import palabras  # noqa: F401
+        # Contar las consultas de cada vista y mensaje del consumer (si las métricas están activas)
+        from . import metricas
+        metricas.instalar()
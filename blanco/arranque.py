@@ -0,0 +1,50 @@
+"""
+Tareas de fondo del proceso ASGI.
+
+Arrancan con el proceso y no con la primera conexión WebSocket: con el evento
+lifespan.startup si el servidor lo envía (uvicorn) o, si no (Daphne no lo
+envía), con la primera petición de cualquier tipo, HTTP incluida. Así un
+trabajador que solo ha atendido páginas también se entera de los drenados y
+limpia partidas abandonadas.
+"""
+import logging
+
+from . import limpieza, reparto
+
+logger = logging.getLogger(__name__)
+
+
+def arrancar():
+    """Arranca en el bucle actual las tareas de fondo que no estén corriendo"""
+    if reparto.activo():
+        reparto.asegurar_escucha()
+    limpieza.asegurar_limpieza()
+
+
+class TareasDeFondo:
+    """Envoltorio de la aplicación ASGI que arranca las tareas de fondo del proceso"""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.ciclo_de_vida(receive, send)
+        arrancar()
+        return await self.inner(scope, receive, send)
+
+    async def ciclo_de_vida(self, receive, send):
+        while True:
+            mensaje = await receive()
+            if mensaje['type'] == 'lifespan.startup':
+                try:
+                    arrancar()
+                except Exception as error:
+                    logger.exception('No se pudieron arrancar las tareas de fondo')
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif mensaje['type'] == 'lifespan.shutdown':
+                # Las tareas terminan con el bucle; las salas se vuelcan al cerrarse sus conexiones
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
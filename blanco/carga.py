@@ -0,0 +1,354 @@
+"""
+Pruebas de carga de las salas del juego Blanco.
+
+simular() crea salas de prueba en la base de datos y las juega todas a la vez
+contra PartidaConsumer con WebsocketCommunicator, en el mismo proceso y con la
+capa de canales configurada. En cada sala se conectan de MIN a MAX jugadores,
+el host inicia la partida y va eliminando jugadores, los impostores eliminados
+intentan adivinar y, al terminar cada ronda, el host empieza otra. Entre
+acción y acción los jugadores piensan un tiempo aleatorio de media `pausa`
+segundos.
+
+Cada acción espera a que todos los jugadores de su sala reciban la difusión,
+así que en el resumen quedan la latencia de acción a difusión (p50 y p99), los
+mensajes por segundo que reciben los clientes, las consultas por acción
+(contadas en todas las conexiones a la base de datos, incluidas las escrituras
+agrupadas) y la memoria de cada sala: la de su estado en memoria y lo que
+crece el proceso al conectarla, clientes simulados incluidos. Los clientes
+comparten proceso y CPU con el servidor, así que con muchas salas la latencia
+es una cota superior. Las decisiones de los jugadores se toman mirando la sala
+en memoria, lo que solo es posible por eso mismo.
+"""
+import asyncio
+import math
+import random
+import secrets
+import sys
+import time
+import tracemalloc
+import zlib
+from collections import Counter
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from . import ejecutores, estado, limites, protocolo
+from .models import GameSession, GamePlayer
+from .routing import websocket_urlpatterns
+
+# Lo que ofrece un navegador con DecompressionStream
+SUBPROTOCOLO = f'{protocolo.SUBPROTOCOLO}+{protocolo.EXTENSION_DEFLATE}'
+# Segundos que se espera la difusión de una acción antes de darla por perdida
+ESPERA_MAXIMA = 5
+# Probabilidad de que un impostor eliminado acierte la palabra
+ACIERTO = 0.3
+
+
+class ContadorConsultas:
+    """
+    Cuenta las consultas de todas las conexiones a la base de datos mientras está activo.
+
+    Las conexiones son de cada hilo: activar() y desactivar() se llaman con
+    database_sync_to_async para que alcancen las del hilo en el que el consumer
+    hace sus consultas; las que se abran en otros hilos (los de ejecutores.py)
+    se cuentan al crearse y dejan de contar al desactivarlo.
+    """
+
+    def __init__(self):
+        self.consultas = 0
+        self.activo = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if self.activo:
+            self.consultas += 1
+        return execute(sql, params, many, context)
+
+    def _instalar(self, conexion):
+        if self not in conexion.execute_wrappers:
+            conexion.execute_wrappers.append(self)
+
+    def _conexion_creada(self, sender, connection, **kwargs):
+        self._instalar(connection)
+
+    def activar(self):
+        self.activo = True
+        for conexion in connections.all():
+            self._instalar(conexion)
+        connection_created.connect(self._conexion_creada)
+
+    def desactivar(self):
+        self.activo = False
+        connection_created.disconnect(self._conexion_creada)
+        for conexion in connections.all():
+            if self in conexion.execute_wrappers:
+                conexion.execute_wrappers.remove(self)
+
+
+class Metricas:
+    """Lo medido durante la simulación, sumado en todas las salas"""
+
+    def __init__(self):
+        self.latencias = []
+        self.acciones = Counter()
+        self.sin_respuesta = 0
+        self.mensajes = 0
+        self.tramas = 0
+        self.bytes = 0
+
+    def recibido(self, trama, mensajes):
+        self.tramas += 1
+        self.mensajes += len(mensajes)
+        self.bytes += len(trama)
+
+
+def tamano(objeto, vistos=None):
+    """Bytes de un objeto y de todo lo que contiene, sin contar dos veces lo compartido"""
+    vistos = set() if vistos is None else vistos
+    if id(objeto) in vistos or isinstance(objeto, (type, asyncio.Future, asyncio.Handle)):
+        return 0
+    vistos.add(id(objeto))
+    total = sys.getsizeof(objeto)
+    if isinstance(objeto, dict):
+        total += sum(tamano(k, vistos) + tamano(v, vistos) for k, v in objeto.items())
+    elif isinstance(objeto, (list, tuple, set, frozenset)):
+        total += sum(tamano(v, vistos) for v in objeto)
+    if hasattr(objeto, '__dict__'):
+        total += tamano(vars(objeto), vistos)
+    for campo in getattr(type(objeto), '__slots__', ()):
+        total += tamano(getattr(objeto, campo, None), vistos)
+    return total
+
+
+def percentil(valores, p):
+    """Percentil p (0-100) por el método del rango más cercano"""
+    if not valores:
+        return None
+    ordenados = sorted(valores)
+    return ordenados[max(math.ceil(p / 100 * len(ordenados)) - 1, 0)]
+
+
+class JugadorSimulado:
+    """Un cliente de la sala: envía acciones y apunta cuándo le llega cada difusión"""
+
+    def __init__(self, aplicacion, codigo, usuario, subprotocolo, metricas):
+        self.usuario = usuario
+        self.metricas = metricas
+        self.comunicador = WebsocketCommunicator(
+            aplicacion, f'/ws/partida/{codigo}/', subprotocols=[subprotocolo] if subprotocolo else None
+        )
+        self.comunicador.scope['user'] = usuario
+        self.compacto = False
+        self.recepcion = None
+        # Futuro que se resuelve con la hora de llegada del siguiente mensaje de la sala
+        self.espera = None
+
+    async def conectar(self):
+        conectado, subprotocolo = await self.comunicador.connect(timeout=ESPERA_MAXIMA)
+        if not conectado:
+            raise RuntimeError(f'{self.usuario.username} no ha podido conectarse')
+        self.compacto = (subprotocolo or '').split('+')[0] == protocolo.SUBPROTOCOLO
+        self.recepcion = asyncio.ensure_future(self.recibir())
+
+    async def recibir(self):
+        while True:
+            # Directamente de la cola: receive_output cancela la aplicación si se agota su tiempo
+            salida = await self.comunicador.output_queue.get()
+            if salida['type'] != 'websocket.send':
+                return
+            trama = salida.get('text') or salida['bytes']
+            texto = trama if isinstance(trama, str) else zlib.decompress(trama, -15).decode()
+            mensaje = protocolo.decodificar(texto)
+            mensajes = mensaje['mensajes'] if mensaje.get('type') == 'lote' else [mensaje]
+            self.metricas.recibido(trama, mensajes)
+            # Los avisos de presencia llegan por su cuenta, no como respuesta a una acción
+            if self.espera is not None and not self.espera.done():
+                if any(m.get('type') != 'presencia' for m in mensajes):
+                    self.espera.set_result(time.perf_counter())
+
+    async def enviar(self, mensaje):
+        await self.comunicador.send_to(text_data=protocolo.codificar(mensaje, self.compacto))
+
+    async def desconectar(self):
+        if self.recepcion is not None:
+            self.recepcion.cancel()
+        await self.comunicador.disconnect()
+
+
+class SalaSimulada:
+    """Una partida jugada de principio a fin por sus jugadores simulados"""
+
+    def __init__(self, aplicacion, codigo, usuarios, subprotocolo, metricas, aleatorio, pausa):
+        self.codigo = codigo
+        self.metricas = metricas
+        self.aleatorio = aleatorio
+        self.pausa = pausa
+        self.jugadores = [JugadorSimulado(aplicacion, codigo, u, subprotocolo, metricas) for u in usuarios]
+        self.host = self.jugadores[0]
+        self.por_usuario = {jugador.usuario.id: jugador for jugador in self.jugadores}
+
+    async def pensar(self):
+        await asyncio.sleep(self.aleatorio.expovariate(1 / self.pausa) if self.pausa > 0 else 0)
+
+    async def conectar(self):
+        # Los jugadores llegan escalonados, como al compartir el código de la sala
+        async def llegar(jugador):
+            await asyncio.sleep(self.aleatorio.uniform(0, self.pausa))
+            await jugador.conectar()
+
+        await asyncio.gather(*(llegar(jugador) for jugador in self.jugadores))
+
+    async def desconectar(self):
+        for jugador in self.jugadores:
+            await jugador.desconectar()
+
+    async def accion(self, jugador, mensaje):
+        """Envía una acción y espera a que todos los jugadores de la sala reciban su difusión"""
+        bucle = asyncio.get_running_loop()
+        for otro in self.jugadores:
+            otro.espera = bucle.create_future()
+        inicio = time.perf_counter()
+        await jugador.enviar(mensaje)
+        try:
+            llegadas = await asyncio.wait_for(
+                asyncio.gather(*(otro.espera for otro in self.jugadores)), ESPERA_MAXIMA
+            )
+        except asyncio.TimeoutError:
+            self.metricas.sin_respuesta += 1
+            return
+        self.metricas.acciones[mensaje['type']] += 1
+        self.metricas.latencias.extend(llegada - inicio for llegada in llegadas)
+
+    async def jugar(self, rondas):
+        await self.pensar()
+        await self.accion(self.host, {'type': 'iniciar_partida'})
+        for ronda in range(rondas):
+            if ronda:
+                await self.pensar()
+                await self.accion(self.host, {'type': 'nueva_ronda'})
+            await self.jugar_ronda()
+        await self.pensar()
+        await self.accion(self.host, {'type': 'terminar_partida'})
+
+    async def jugar_ronda(self):
+        # Cada acción elimina a alguien o gasta una adivinación: la ronda acaba antes de este límite
+        for _ in range(2 * len(self.jugadores)):
+            sala = estado.sala_en_memoria(self.codigo)
+            if sala is None or sala.ronda_terminada or sala.estado != 'en_juego':
+                return
+            await self.pensar()
+            adivinan = [
+                j for j in sala.jugadores.values() if j.es_impostor and j.eliminado and not j.ya_intento_adivinar
+            ]
+            if adivinan:
+                acierta = self.aleatorio.random() < ACIERTO
+                await self.accion(self.por_usuario[adivinan[0].user_id], {
+                    'type': 'adivinar_palabra',
+                    'palabra_adivinada': sala.palabra_impostor if acierta else 'ni idea',
+                })
+            else:
+                victima = self.aleatorio.choice(sala.activos())
+                await self.accion(self.host, {'type': 'eliminar_jugador', 'jugador_id': victima.id})
+
+
+def crear_salas(salas, min_jugadores, max_jugadores, aleatorio):
+    """Crea las partidas de prueba en espera; devuelve [(codigo, [usuarios])]"""
+    # Una marca por simulación para no chocar con partidas reales ni con simulaciones anteriores
+    marca = secrets.token_hex(2).upper()
+    tamanos = [aleatorio.randint(min_jugadores, max_jugadores) for _ in range(salas)]
+    codigos = [f'{marca}{i:04d}' for i in range(salas)]
+    usuarios = User.objects.bulk_create([
+        User(username=f'carga_{codigo}_{j}') for codigo, n in zip(codigos, tamanos) for j in range(n)
+    ])
+    por_sala = []
+    for codigo, n in zip(codigos, tamanos):
+        por_sala.append((codigo, usuarios[:n]))
+        usuarios = usuarios[n:]
+    partidas = GameSession.objects.bulk_create([
+        GameSession(codigo=codigo, host=jugadores[0]) for codigo, jugadores in por_sala
+    ])
+    GamePlayer.objects.bulk_create([
+        GamePlayer(session=partida, user=usuario)
+        for partida, (_, jugadores) in zip(partidas, por_sala) for usuario in jugadores
+    ])
+    return por_sala
+
+
+def borrar_salas(por_sala):
+    GameSession.objects.filter(codigo__in=[codigo for codigo, _ in por_sala]).delete()
+    User.objects.filter(id__in=[u.id for _, jugadores in por_sala for u in jugadores]).delete()
+
+
+async def simular(salas=50, min_jugadores=4, max_jugadores=9, rondas=3, pausa=1.0, semilla=None,
+                  subprotocolo=SUBPROTOCOLO):
+    """Juega `salas` partidas a la vez y devuelve el resumen de lo medido"""
+    aleatorio = random.Random(semilla)
+    metricas = Metricas()
+    aplicacion = URLRouter(websocket_urlpatterns)
+    por_sala = await database_sync_to_async(crear_salas)(salas, min_jugadores, max_jugadores, aleatorio)
+    simuladas = [
+        SalaSimulada(aplicacion, codigo, usuarios, subprotocolo, metricas, aleatorio, pausa)
+        for codigo, usuarios in por_sala
+    ]
+    jugadores = sum(len(usuarios) for _, usuarios in por_sala)
+    try:
+        # Conexión: memoria que ocupan las salas ya cargadas (tracemalloc solo aquí, frena todo)
+        consultas_conexion = ContadorConsultas()
+        await database_sync_to_async(consultas_conexion.activar)()
+        tracemalloc.start()
+        try:
+            antes = tracemalloc.get_traced_memory()[0]
+            await asyncio.gather(*(sala.conectar() for sala in simuladas))
+            memoria_total = tracemalloc.get_traced_memory()[0] - antes
+        finally:
+            tracemalloc.stop()
+            await database_sync_to_async(consultas_conexion.desactivar)()
+        codigos = {sala.codigo for sala in simuladas}
+        memoria_estado = tamano([sala for sala in estado.salas_activas() if sala.codigo in codigos])
+
+        # Partidas: hasta que todas terminan y se han escrito sus cambios
+        consultas_juego = ContadorConsultas()
+        await database_sync_to_async(consultas_juego.activar)()
+        try:
+            inicio = time.perf_counter()
+            await asyncio.gather(*(sala.jugar(rondas) for sala in simuladas))
+            duracion = time.perf_counter() - inicio
+            guardados = [
+                sala.guardado_programado for sala in estado.salas_activas()
+                if sala.guardado_programado is not None and not sala.guardado_programado.done()
+            ]
+            await asyncio.gather(*guardados)
+        finally:
+            await database_sync_to_async(consultas_juego.desactivar)()
+    finally:
+        await asyncio.gather(*(sala.desconectar() for sala in simuladas), return_exceptions=True)
+        await database_sync_to_async(borrar_salas)(por_sala)
+
+    acciones = sum(metricas.acciones.values())
+    return {
+        'salas': salas,
+        'jugadores': jugadores,
+        'acciones': acciones,
+        'acciones_por_tipo': dict(metricas.acciones),
+        'sin_respuesta': metricas.sin_respuesta,
+        'duracion_s': duracion,
+        'latencia_p50_ms': _ms(percentil(metricas.latencias, 50)),
+        'latencia_p99_ms': _ms(percentil(metricas.latencias, 99)),
+        'latencia_max_ms': _ms(max(metricas.latencias, default=None)),
+        'mensajes_por_segundo': metricas.mensajes / duracion,
+        'tramas_por_segundo': metricas.tramas / duracion,
+        'bytes_por_segundo': metricas.bytes / duracion,
+        'consultas_por_accion': consultas_juego.consultas / acciones if acciones else None,
+        'consultas_por_conexion': consultas_conexion.consultas / jugadores,
+        'memoria_sala_kb': memoria_estado / salas / 1024,
+        'memoria_total_sala_kb': memoria_total / salas / 1024,
+        'ejecutores': {ejecutor.nombre: ejecutor.estadisticas() for ejecutor in ejecutores.EJECUTORES},
+        'limites': limites.estadisticas(),
+    }
+
+
+def _ms(segundos):
+    return None if segundos is None else segundos * 1000
@@ -0,0 +1,145 @@
+"""
+Difusión agrupada de los mensajes de cada sala.
+
+Los handlers del consumer no envían a la capa de canales directamente: anotan
+que la sala ha cambiado y encolan sus avisos, y la cola de la sala se vacía
+cada TICK segundos. En cada vaciado los cambios se publican como un solo delta
+(publicar() junta todo lo modificado desde la versión anterior) y todo lo
+pendiente sale en un único mensaje por destinatario, en el mismo orden en que
+se encoló. El delta ocupa el lugar del primer cambio anotado, así que los avisos
+posteriores llegan con el estado ya aplicado.
+
+Los avisos urgentes (el fin de la partida) vacían la cola en el momento, junto
+con lo que ya estuviera en ella.
+"""
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+from . import estado, metricas
+
+# Segundos durante los que se acumulan los mensajes de una sala
+TICK = getattr(settings, 'BLANCO_DIFUSION_TICK', 0.03)
+
+# Marca en la cola del punto en el que va el delta de la sala
+CAMBIOS = object()
+
+
+class ColaSala:
+    """Mensajes pendientes de una sala"""
+    __slots__ = ('pendientes', 'vaciado')
+
+    def __init__(self):
+        self.pendientes = []
+        self.vaciado = None
+
+
+_colas = {}
+_estadisticas = {
+    'vaciados': 0,
+    'encolados': 0,
+    'enviados': 0,
+    'cambios_anotados': 0,
+    'deltas_publicados': 0,
+    'maximo_por_vaciado': 0,
+}
+
+
+def _cola(codigo):
+    cola = _colas.get(codigo)
+    if cola is None:
+        cola = _colas[codigo] = ColaSala()
+        cola.vaciado = asyncio.ensure_future(_vaciar_despues(codigo))
+    return cola
+
+
+async def _vaciar_despues(codigo):
+    await asyncio.sleep(TICK)
+    await vaciar(codigo)
+
+
+def anotar_cambios(codigo):
+    """La sala ha cambiado: su delta sale en el próximo vaciado"""
+    _estadisticas['cambios_anotados'] += 1
+    cola = _cola(codigo)
+    if CAMBIOS not in cola.pendientes:
+        cola.pendientes.append(CAMBIOS)
+
+
+async def avisar(codigo, mensaje, urgente=False):
+    """Encola un aviso para todos los jugadores de la sala"""
+    _estadisticas['encolados'] += 1
+    _cola(codigo).pendientes.append(mensaje)
+    if urgente:
+        await vaciar(codigo)
+
+
+async def vaciar(codigo):
+    """Envía lo pendiente de la sala: un mensaje por destinatario"""
+    cola = _colas.pop(codigo, None)
+    if cola is None:
+        return
+    if cola.vaciado is not asyncio.current_task():
+        cola.vaciado.cancel()
+
+    sala = estado.sala_en_memoria(codigo)
+    if sala is None and CAMBIOS in cola.pendientes and estado.sala_obsoleta(codigo):
+        # Una vista ha escrito en la base de datos (sala_modificada): se recarga y lo que
+        # haya cambiado sale en el delta. Las salas que no están cargadas no se cargan aquí.
+        sala = await estado.obtener_sala(codigo)
+    elementos = []
+    privados = None
+    for pendiente in cola.pendientes:
+        if pendiente is not CAMBIOS:
+            elementos.append({'type': 'partida_message', 'message': pendiente})
+            continue
+        publicado = sala.publicar() if sala is not None else None
+        if publicado is None:
+            continue
+        delta, privados = publicado
+        _estadisticas['deltas_publicados'] += 1
+        elementos.append({'type': 'partida_delta', 'delta': delta})
+
+    _estadisticas['vaciados'] += 1
+    _estadisticas['maximo_por_vaciado'] = max(_estadisticas['maximo_por_vaciado'], len(cola.pendientes))
+    if not elementos:
+        return
+
+    channel_layer = get_channel_layer()
+    if not privados:
+        await channel_layer.group_send(f'partida_{codigo}', _trama(elementos))
+        _estadisticas['enviados'] += 1
+        if sala is not None:
+            metricas.anotar_difusion(sum(len(canales) for canales in sala.canales.values()))
+        return
+
+    # Si han cambiado campos privados, cada canal recibe su propia trama
+    enviados = 0
+    for user_id, canales in list(sala.canales.items()):
+        propios = [
+            dict(elemento, privado=privados.get(user_id)) if elemento['type'] == 'partida_delta' else elemento
+            for elemento in elementos
+        ]
+        for canal in list(canales):
+            await channel_layer.send(canal, _trama(propios))
+            _estadisticas['enviados'] += 1
+            enviados += 1
+    metricas.anotar_difusion(enviados)
+
+
+def _trama(elementos):
+    if len(elementos) == 1:
+        return elementos[0]
+    return {'type': 'partida_lote', 'eventos': elementos}
+
+
+def estadisticas():
+    """Mensajes agrupados por vaciado desde que arrancó el proceso"""
+    datos = dict(_estadisticas)
+    vaciados = datos['vaciados'] or 1
+    datos['tick'] = TICK
+    datos['salas_pendientes'] = len(_colas)
+    datos['mensajes_por_vaciado'] = (datos['encolados'] + datos['cambios_anotados']) / vaciados
+    datos['agrupados'] = datos['encolados'] + datos['cambios_anotados'] - datos['vaciados']
+    return datos
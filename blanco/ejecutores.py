@@ -0,0 +1,162 @@
+"""
+Hilos de la base de datos, separados para lecturas y escrituras.
+
+database_sync_to_async de channels lleva todas las llamadas al mismo hilo
+(thread_sensitive): una carga de sala lenta retrasa el guardado de las
+transiciones de todas las demás y al revés. Aquí cada camino tiene su propio
+ThreadPoolExecutor, con su tamaño:
+
+- LECTURA (BLANCO_HILOS_LECTURA, 4): carga de salas al conectar o cuando otro
+  proceso las ha cambiado y el índice de palabras.
+- ESCRITURA (BLANCO_HILOS_ESCRITURA, 2; uno con SQLite): volcado de
+  transiciones y puntos, expulsiones y la limpieza periódica.
+
+Cada ejecutor lleva la cuenta de lo que espera en su cola y de lo que está
+en curso, y anota en metricas cuánto espera cada llamada antes de empezar.
+Con el ejecutor saturado (todos los hilos ocupados) el trabajo que no es
+crítico se aplaza o se descarta: los refresh_request esperan hueco hasta
+BLANCO_ESPERA_APLAZABLE segundos (1) y, si no lo hay, el cliente recibe un
+'ocupado' para repetirlo a los BLANCO_REINTENTAR_MS milisegundos; la
+limpieza se salta esa pasada.
+
+Con 0 hilos se usa el hilo compartido de channels, como antes; es lo que
+necesitan las pruebas con TestCase, cuya transacción solo ve su conexión.
+"""
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import connection
+
+from . import metricas
+
+# Segundos que un trabajo aplazable espera a que el ejecutor tenga hueco
+ESPERA_APLAZABLE = getattr(settings, 'BLANCO_ESPERA_APLAZABLE', 1)
+# Cada cuánto se vuelve a mirar si hay hueco mientras se espera
+SONDEO = 0.02
+# Milisegundos tras los que el cliente repite una petición descartada
+REINTENTAR_MS = getattr(settings, 'BLANCO_REINTENTAR_MS', 2000)
+
+
+class Ejecutor:
+    """ThreadPoolExecutor con nombre, tamaño configurable y cuenta de su cola"""
+
+    def __init__(self, nombre, ajuste, hilos_por_defecto, un_hilo_en_sqlite=False):
+        self.nombre = nombre
+        self.ajuste = ajuste
+        self.hilos_por_defecto = hilos_por_defecto
+        self.un_hilo_en_sqlite = un_hilo_en_sqlite
+        self.pendientes = 0
+        self.en_curso = 0
+        self.aplazadas = 0
+        self.descartadas = 0
+        self.lock = threading.Lock()
+        self._pool = None
+        self._tamano = None
+
+    def hilos(self):
+        # Se lee en cada llamada para que override_settings funcione en las pruebas
+        hilos = getattr(settings, self.ajuste, self.hilos_por_defecto)
+        if self.un_hilo_en_sqlite and connection.vendor == 'sqlite':
+            # SQLite admite un solo escritor: más hilos solo se esperarían unos a otros
+            return min(hilos, 1)
+        return hilos
+
+    def pool(self, hilos):
+        if self._pool is None or self._tamano != hilos:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+            self._pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix=f'blanco-{self.nombre}')
+            self._tamano = hilos
+        return self._pool
+
+    def saturado(self):
+        """Todos los hilos están ocupados: lo que llegue ahora tendrá que esperar"""
+        hilos = self.hilos()
+        return bool(hilos) and self.pendientes + self.en_curso >= hilos
+
+    async def hueco(self, espera=None):
+        """Espera hasta `espera` segundos (ESPERA_APLAZABLE) a que el ejecutor no esté saturado; False si no"""
+        if not self.saturado():
+            return True
+        self.aplazadas += 1
+        limite = time.monotonic() + (ESPERA_APLAZABLE if espera is None else espera)
+        while time.monotonic() < limite:
+            await asyncio.sleep(SONDEO)
+            if not self.saturado():
+                return True
+        self.descartadas += 1
+        return False
+
+    async def ejecutar(self, funcion, *args, **kwargs):
+        hilos = self.hilos()
+        if not hilos:
+            return await metricas.database_sync_to_async(funcion)(*args, **kwargs)
+
+        encolada = time.perf_counter()
+        with self.lock:
+            self.pendientes += 1
+
+        @functools.wraps(funcion)
+        def en_hilo(*args, **kwargs):
+            with self.lock:
+                self.pendientes -= 1
+                self.en_curso += 1
+            metricas.anotar_espera_ejecutor(self.nombre, time.perf_counter() - encolada)
+            try:
+                return funcion(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.en_curso -= 1
+
+        llamada = metricas.database_sync_to_async(en_hilo, thread_sensitive=False, executor=self.pool(hilos))
+        return await llamada(*args, **kwargs)
+
+    def estadisticas(self):
+        return {
+            'hilos': self.hilos(),
+            'pendientes': self.pendientes,
+            'en_curso': self.en_curso,
+            'aplazadas': self.aplazadas,
+            'descartadas': self.descartadas,
+        }
+
+
+LECTURA = Ejecutor('lectura', 'BLANCO_HILOS_LECTURA', 4)
+ESCRITURA = Ejecutor('escritura', 'BLANCO_HILOS_ESCRITURA', 2, un_hilo_en_sqlite=True)
+EJECUTORES = (LECTURA, ESCRITURA)
+
+
+def _en(ejecutor):
+    def decorador(funcion):
+        @functools.wraps(funcion)
+        async def llamada(*args, **kwargs):
+            return await ejecutor.ejecutar(funcion, *args, **kwargs)
+        return llamada
+    return decorador
+
+
+# database_sync_to_async por el ejecutor de cada camino
+de_lectura = _en(LECTURA)
+de_escritura = _en(ESCRITURA)
+
+
+metricas.registrar_indicador(
+    'blanco_ejecutor_cola', 'Llamadas esperando un hilo libre en cada ejecutor', 'gauge',
+    lambda: {(e.nombre,): e.pendientes for e in EJECUTORES},
+)
+metricas.registrar_indicador(
+    'blanco_ejecutor_en_curso', 'Llamadas ejecutándose en cada ejecutor', 'gauge',
+    lambda: {(e.nombre,): e.en_curso for e in EJECUTORES},
+)
+metricas.registrar_indicador(
+    'blanco_ejecutor_aplazadas_total', 'Trabajos no críticos aplazados por un ejecutor saturado', 'counter',
+    lambda: {(e.nombre,): e.aplazadas for e in EJECUTORES},
+)
+metricas.registrar_indicador(
+    'blanco_ejecutor_descartadas_total', 'Trabajos no críticos descartados por un ejecutor saturado', 'counter',
+    lambda: {(e.nombre,): e.descartadas for e in EJECUTORES},
+)
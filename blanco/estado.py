@@ -0,0 +1,704 @@
+"""
+Estado en memoria de las salas activas del juego Blanco.
+
+Mientras una sala tiene conexiones WebSocket abiertas, su GameSession y sus
+GamePlayer se mantienen en memoria del proceso y son la fuente de verdad.
+Las eliminaciones, adivinaciones y cambios de ronda se aplican aquí como
+transiciones en memoria y se escriben en la base de datos de forma asíncrona
+y agrupada, fuera del camino crítico de cada mensaje.
+"""
+import asyncio
+import logging
+from contextlib import nullcontext
+
+from django.conf import settings
+
+from . import protocolo, reglas
+from .ejecutores import de_escritura, de_lectura
+from .roles import repartir
+
+logger = logging.getLogger(__name__)
+
+# Segundos que se esperan antes de volcar los cambios pendientes a la base de datos
+RETARDO_ESCRITURA = getattr(settings, 'BLANCO_RETARDO_ESCRITURA', 0.25)
+
+CAMPOS_SALA = (
+    'estado', 'ronda_actual', 'ronda_terminada', 'palabra_impostor',
+    'palabra_buena_actual', 'palabra_infiltrado_actual', 'mazo_palabras', 'posicion_mazo',
+)
+
+CAMPOS_JUGADOR = (
+    'palabra_secreta', 'eliminado', 'es_impostor', 'es_infiltrado', 'es_bueno',
+    'puntos', 'ronda_actual', 'ya_intento_adivinar',
+)
+
+# Campos que se envían a los clientes. Los privados solo los recibe su jugador.
+CAMPOS_PUBLICOS_SALA = (
+    'estado', 'ronda_actual', 'ronda_terminada', 'palabra_buena_actual', 'palabra_infiltrado_actual',
+)
+CAMPOS_PUBLICOS_JUGADOR = (
+    'puntos', 'ronda_actual', 'eliminado', 'es_impostor', 'es_infiltrado', 'es_bueno',
+    'ya_intento_adivinar',
+)
+CAMPOS_PRIVADOS_JUGADOR = ('palabra_secreta',)
+
+
+class JugadorEstado:
+    """Copia en memoria de un GamePlayer"""
+    __slots__ = ('id', 'user_id', 'username') + CAMPOS_JUGADOR
+
+    def __init__(self, **campos):
+        for campo in self.__slots__:
+            setattr(self, campo, campos.get(campo))
+
+    @classmethod
+    def desde_modelo(cls, jugador):
+        return cls(
+            id=jugador.id,
+            user_id=jugador.user_id,
+            username=jugador.user.username,
+            **{campo: getattr(jugador, campo) for campo in CAMPOS_JUGADOR}
+        )
+
+
+class SalaEstado:
+    """Copia en memoria de una GameSession con sus jugadores"""
+
+    def __init__(self, id, codigo, host_id, jugadores, **campos):
+        self.id = id
+        self.codigo = codigo
+        self.host_id = host_id
+        for campo in CAMPOS_SALA:
+            setattr(self, campo, campos.get(campo))
+        # Los jugadores se guardan por id, en orden de llegada a la sala
+        self.jugadores = {jugador.id: jugador for jugador in jugadores}
+        self.conexiones = 0
+        self.obsoleta = False
+        self.pendientes_sala = set()
+        self.pendientes_jugadores = {}
+        # Puntos ganados aún sin guardar; se escriben como F('puntos') + n
+        self.pendientes_puntos = {}
+        # Jugadores expulsados cuya fila aún no se ha borrado
+        self.pendientes_borrados = set()
+        # Campos que una vista ha escrito en la base de datos después de cambiarlos aquí
+        # (ver invalidar_sala): no se vuelcan, para no pisar lo que escribió la vista
+        self.superados = []
+        self.guardado_programado = None
+        # Ordena los volcados de la sala entre sí y con las recargas: ninguna lectura se adelanta
+        # a una escritura en curso y dos volcados no se escriben en desorden desde hilos distintos
+        self.volcado = asyncio.Lock()
+        # Versión del estado que ven los clientes y cambios aún no publicados
+        self.version = 0
+        self.delta_sala = {}
+        self.delta_jugadores = {}
+        self.delta_quitados = []
+        self.delta_privados = {}
+        # Canales WebSocket abiertos por cada usuario, para los envíos privados
+        self.canales = {}
+        # Tramas y bytes enviados a los clientes de la sala (ver protocolo.registrar_envio)
+        self.transmision = {}
+        # Cubos de fichas de los mensajes que llegan a la sala, por tipo (ver limites.py)
+        self.limites = {}
+        # (versión, protocolo.Codificado) de la parte pública del último snapshot
+        self.snapshot = None
+
+    @classmethod
+    def desde_modelo(cls, partida):
+        jugadores = partida.players.select_related('user').order_by('id')
+        return cls(
+            id=partida.id,
+            codigo=partida.codigo,
+            host_id=partida.host_id,
+            jugadores=[JugadorEstado.desde_modelo(j) for j in jugadores],
+            **{campo: getattr(partida, campo) for campo in CAMPOS_SALA}
+        )
+
+    # Consultas
+
+    def es_host(self, user_id):
+        return self.host_id == user_id
+
+    def jugador_de_usuario(self, user_id):
+        for jugador in self.jugadores.values():
+            if jugador.user_id == user_id:
+                return jugador
+        return None
+
+    def activos(self):
+        return [j for j in self.jugadores.values() if not j.eliminado]
+
+    def datos_jugador(self, jugador):
+        """Campos públicos de un jugador, tal y como los reciben los clientes"""
+        datos = {
+            'id': jugador.id,
+            'user_id': jugador.user_id,
+            'username': jugador.username,
+            'es_host': self.host_id == jugador.user_id,
+        }
+        for campo in CAMPOS_PUBLICOS_JUGADOR:
+            datos[campo] = getattr(jugador, campo)
+        return datos
+
+    def datos_publicos(self):
+        """Lo que ven todos los jugadores en el snapshot"""
+        jugadores_data = [self.datos_jugador(jugador) for jugador in self.jugadores.values()]
+        activos = len(self.activos())
+
+        datos = {campo: getattr(self, campo) for campo in CAMPOS_PUBLICOS_SALA}
+        datos.update({
+            'version': self.version,
+            'jugadores': jugadores_data,
+            'jugadores_activos': activos,
+            'jugadores_eliminados': len(jugadores_data) - activos,
+        })
+        return datos
+
+    def palabra_secreta(self, user_id):
+        mi_jugador = self.jugador_de_usuario(user_id)
+        return (mi_jugador.palabra_secreta or '') if mi_jugador else ''
+
+    def datos(self, user_id=None):
+        """Snapshot completo de la partida; solo incluye la palabra secreta de user_id"""
+        return dict(self.datos_publicos(), palabra_secreta=self.palabra_secreta(user_id))
+
+    def snapshot_publico(self):
+        """
+        datos_publicos() como protocolo.Codificado, que se codifica una vez por
+        formato. Se reutiliza mientras la versión no cambie; con cambios aún sin
+        publicar (que no suben la versión hasta publicar()) se hace uno nuevo
+        sin guardarlo. Una escritura desde las vistas recarga la sala, y la
+        sala nueva empieza sin snapshot.
+        """
+        if self.delta_sala or self.delta_jugadores or self.delta_quitados:
+            return protocolo.Codificado(self.datos_publicos())
+        if self.snapshot is None or self.snapshot[0] != self.version:
+            self.snapshot = (self.version, protocolo.Codificado(self.datos_publicos()))
+        return self.snapshot[1]
+
+    # Cambios (marcan los campos que hay que escribir en la base de datos)
+
+    def cambiar(self, **campos):
+        for campo, valor in campos.items():
+            if campo in CAMPOS_PUBLICOS_SALA and getattr(self, campo) != valor:
+                self.delta_sala[campo] = valor
+            setattr(self, campo, valor)
+            self.pendientes_sala.add(campo)
+
+    def cambiar_jugador(self, jugador, **campos):
+        for campo, valor in campos.items():
+            if getattr(jugador, campo) != valor:
+                if campo in CAMPOS_PUBLICOS_JUGADOR:
+                    self.delta_jugadores.setdefault(jugador.id, {})[campo] = valor
+                elif campo in CAMPOS_PRIVADOS_JUGADOR:
+                    self.delta_privados.setdefault(jugador.user_id, {})[campo] = valor
+            setattr(jugador, campo, valor)
+        self.pendientes_jugadores.setdefault(jugador.id, set()).update(campos)
+
+    def sumar_puntos(self, jugadores, puntos):
+        for jugador in jugadores:
+            # Se guarda el incremento y no el total, para no pisar puntos escritos desde otro sitio
+            self.pendientes_puntos[jugador.id] = self.pendientes_puntos.get(jugador.id, 0) + puntos
+            jugador.puntos += puntos
+            self.delta_jugadores.setdefault(jugador.id, {})['puntos'] = jugador.puntos
+
+    def quitar_jugador(self, jugador_id):
+        jugador = self.jugadores.pop(jugador_id, None)
+        self.pendientes_jugadores.pop(jugador_id, None)
+        self.pendientes_puntos.pop(jugador_id, None)
+        if jugador is not None:
+            self.delta_jugadores.pop(jugador_id, None)
+            self.delta_privados.pop(jugador.user_id, None)
+            self.delta_quitados.append(jugador_id)
+
+    def expulsar_jugador(self, jugador_id):
+        """Quita al jugador de la sala y deja su fila para borrarla en el próximo volcado"""
+        if jugador_id not in self.jugadores:
+            return False
+        self.quitar_jugador(jugador_id)
+        self.pendientes_borrados.add(jugador_id)
+        return True
+
+    def registrar_diferencias(self, anterior):
+        """Anota como cambios sin publicar todo lo que difiere de la versión anterior de la sala"""
+        self.version = anterior.version
+        for campo in CAMPOS_PUBLICOS_SALA:
+            if getattr(anterior, campo) != getattr(self, campo):
+                self.delta_sala[campo] = getattr(self, campo)
+        for jugador in self.jugadores.values():
+            previo = anterior.jugadores.get(jugador.id)
+            if previo is None:
+                self.delta_jugadores[jugador.id] = self.datos_jugador(jugador)
+                previo = JugadorEstado()
+            else:
+                for campo in CAMPOS_PUBLICOS_JUGADOR:
+                    if getattr(previo, campo) != getattr(jugador, campo):
+                        self.delta_jugadores.setdefault(jugador.id, {})[campo] = getattr(jugador, campo)
+            for campo in CAMPOS_PRIVADOS_JUGADOR:
+                if getattr(previo, campo) != getattr(jugador, campo):
+                    self.delta_privados.setdefault(jugador.user_id, {})[campo] = getattr(jugador, campo)
+        self.delta_quitados = [j for j in anterior.jugadores if j not in self.jugadores]
+
+    def publicar(self):
+        """
+        Cierra los cambios acumulados en una nueva versión.
+
+        Devuelve (delta_publico, privados) o None si no ha cambiado nada visible.
+        privados es un diccionario {user_id: campos} con lo que solo debe ver cada jugador.
+        """
+        if not (self.delta_sala or self.delta_jugadores or self.delta_quitados or self.delta_privados):
+            return None
+        self.version += 1
+        delta = {'version': self.version}
+        if self.delta_sala:
+            delta['partida'] = self.delta_sala
+        if self.delta_jugadores:
+            delta['jugadores'] = self.delta_jugadores
+        if self.delta_quitados:
+            delta['quitados'] = self.delta_quitados
+        if self.delta_quitados or any('eliminado' in c for c in self.delta_jugadores.values()):
+            activos = len(self.activos())
+            delta.setdefault('partida', {}).update({
+                'jugadores_activos': activos,
+                'jugadores_eliminados': len(self.jugadores) - activos,
+            })
+        privados = self.delta_privados
+        self.delta_sala = {}
+        self.delta_jugadores = {}
+        self.delta_quitados = []
+        self.delta_privados = {}
+        return delta, privados
+
+    def extraer_pendientes(self):
+        """Devuelve y limpia los cambios pendientes (sala, jugadores, puntos y borrados) como valores"""
+        while self.superados:
+            self.descartar_pendientes(self.superados.pop(0))
+        campos_sala = {campo: getattr(self, campo) for campo in self.pendientes_sala}
+        cambios_jugadores = {}
+        for jugador_id, campos in self.pendientes_jugadores.items():
+            jugador = self.jugadores.get(jugador_id)
+            if jugador is not None:
+                cambios_jugadores[jugador_id] = {campo: getattr(jugador, campo) for campo in campos}
+        incrementos = self.pendientes_puntos
+        borrados = sorted(self.pendientes_borrados)
+        self.pendientes_sala = set()
+        self.pendientes_jugadores = {}
+        self.pendientes_puntos = {}
+        self.pendientes_borrados = set()
+        return campos_sala, cambios_jugadores, incrementos, borrados
+
+    def devolver_pendientes(self, campos_sala, cambios_jugadores, incrementos, borrados):
+        """Vuelve a marcar como pendiente lo extraído que no se pudo escribir"""
+        self.pendientes_sala.update(campos_sala)
+        for jugador_id, campos in cambios_jugadores.items():
+            if jugador_id in self.jugadores:
+                self.pendientes_jugadores.setdefault(jugador_id, set()).update(campos)
+        for jugador_id, puntos in incrementos.items():
+            if jugador_id in self.jugadores:
+                self.pendientes_puntos[jugador_id] = self.pendientes_puntos.get(jugador_id, 0) + puntos
+        self.pendientes_borrados.update(borrados)
+
+    def descartar_pendientes(self, escritos):
+        """Olvida los campos pendientes que ya ha escrito otro (ver Transicion.escritos)"""
+        self.pendientes_sala.difference_update(escritos.get('sala', ()))
+        campos = escritos.get('campos_jugadores', ())
+        for jugador_id in escritos.get('jugadores', ()):
+            pendientes = self.pendientes_jugadores.get(jugador_id)
+            if pendientes is not None:
+                pendientes.difference_update(campos)
+                if not pendientes:
+                    del self.pendientes_jugadores[jugador_id]
+
+    # Transiciones del juego (las reglas están en reglas.py)
+
+    def foto(self):
+        return reglas.foto(self.palabra_impostor, self.ronda_terminada, self.jugadores.values())
+
+    def jugador_por_id(self, jugador_id):
+        return self.jugadores.get(jugador_id)
+
+    def eliminar_jugador(self, jugador_id):
+        """Elimina un jugador de la ronda actual y, si con eso termina, reparte los puntos.
+
+        Devuelve el reglas.Resultado aplicado, o None si no se ha podido eliminar
+        (p. ej. con la ronda ya cerrada por una adivinación que llegó antes).
+        """
+        resultado = reglas.eliminar(self.foto(), jugador_id)
+        if resultado is not None:
+            reglas.aplicar(resultado, self)
+        return resultado
+
+    def procesar_adivinacion(self, user_id, palabra_adivinada):
+        """Procesa la adivinación de palabra por un impostor eliminado"""
+        mi_jugador = self.jugador_de_usuario(user_id)
+        resultado = reglas.adivinar(self.foto(), mi_jugador.id if mi_jugador else None, palabra_adivinada)
+        if resultado is None:
+            return {'error': 'No puedes adivinar la palabra'}
+        reglas.aplicar(resultado, self)
+        return {
+            'correcto': resultado.correcto,
+            'mensaje': reglas.mensaje(resultado, self.palabra_impostor),
+            'ronda_terminada': resultado.ronda_terminada,
+        }
+
+    def asignar_roles(self, roles, palabra_buena, palabra_infiltrado, palabra_impostor):
+        """Asigna a cada jugador el rol de la lista (ya barajada) que le corresponde"""
+        for jugador, rol in zip(self.jugadores.values(), roles):
+            self.cambiar_jugador(
+                jugador,
+                eliminado=False,
+                es_bueno=rol == 'bueno',
+                es_infiltrado=rol == 'infiltrado',
+                es_impostor=rol == 'impostor',
+                ya_intento_adivinar=False,
+                palabra_secreta={
+                    'bueno': palabra_buena,
+                    'infiltrado': palabra_infiltrado,
+                }.get(rol, palabra_impostor),
+                ronda_actual=self.ronda_actual,
+            )
+
+    def iniciar_partida(self, palabra_buena, palabra_infiltrado):
+        """Inicia la partida con las palabras dadas"""
+        # Sin reparto para este número de jugadores (menos de 4 o más de MAX_JUGADORES) no se empieza
+        roles = repartir(len(self.jugadores))
+        if roles is None:
+            return False
+
+        self.cambiar(
+            palabra_buena_actual=palabra_buena,
+            palabra_infiltrado_actual=palabra_infiltrado,
+            palabra_impostor=palabra_buena,  # El impostor debe adivinar la palabra buena
+            estado='en_juego',
+            ronda_actual=1,
+            ronda_terminada=False,
+        )
+
+        self.asignar_roles(roles, palabra_buena, palabra_infiltrado, "¡Impostor! No tienes palabra en esta ronda.")
+        return True
+
+    def iniciar_nueva_ronda(self, palabra_buena, palabra_infiltrado):
+        """Inicia una nueva ronda con las palabras dadas"""
+        roles = repartir(len(self.jugadores))
+        if roles is None:
+            return False
+
+        self.cambiar(
+            palabra_buena_actual=palabra_buena,
+            palabra_infiltrado_actual=palabra_infiltrado,
+            palabra_impostor=palabra_buena,
+            ronda_actual=self.ronda_actual + 1,
+            ronda_terminada=False,
+        )
+
+        self.asignar_roles(roles, palabra_buena, palabra_infiltrado, "Tú no tienes palabra, eres el impostor.")
+        return True
+
+
+# Registro de salas activas en este proceso, indexado por código
+
+_salas = {}
+_cargas = {}
+# Un candado por sala para que las acciones de distintas conexiones no se intercalen
+_candados = {}
+# Última invalidación aplicada por sala, para no recargar una vez por cada conexión
+_marcas = {}
+
+
+def cargar_sala(codigo):
+    """Carga una sala desde la base de datos (None si no existe)"""
+    from .models import GameSession
+    try:
+        partida = GameSession.objects.get(codigo=codigo)
+    except GameSession.DoesNotExist:
+        return None
+    return SalaEstado.desde_modelo(partida)
+
+
+def sala_en_memoria(codigo):
+    """Devuelve la sala si está cargada en este proceso, sin tocar la base de datos"""
+    sala = _salas.get(codigo)
+    if sala is None or sala.obsoleta:
+        return None
+    return sala
+
+
+def sala_cargada(codigo):
+    """La sala cargada en este proceso, aunque esté obsoleta (None si no lo está)"""
+    return _salas.get(codigo)
+
+
+def sala_obsoleta(codigo):
+    """La sala está cargada pero una vista la ha invalidado: hay que recargarla antes de publicar"""
+    sala = _salas.get(codigo)
+    return sala is not None and sala.obsoleta
+
+
+def candado(codigo):
+    """Candado de la sala; sobrevive a las recargas del estado"""
+    lock = _candados.get(codigo)
+    if lock is None:
+        lock = _candados[codigo] = asyncio.Lock()
+    return lock
+
+
+def salas_activas():
+    """Salas cargadas en este proceso"""
+    return list(_salas.values())
+
+
+def invalidar_sala(codigo, marca=None, escritos=None):
+    """
+    Marca la sala para recargarla; se usa cuando una vista escribe directamente
+    en la base de datos. escritos (Transicion.escritos) son los campos que ha
+    escrito la vista: lo pendiente de esos campos ya no se vuelca.
+    """
+    if marca is not None:
+        if _marcas.get(codigo) == marca:
+            return
+        _marcas[codigo] = marca
+    sala = _salas.get(codigo)
+    if sala is not None:
+        if escritos:
+            # Se aplica al extraer los pendientes, en el bucle de eventos de la sala
+            sala.superados.append(escritos)
+        sala.obsoleta = True
+
+
+async def obtener_sala(codigo):
+    """Devuelve el estado en memoria de la sala, cargándolo la primera vez"""
+    sala = _salas.get(codigo)
+    if sala is not None and not sala.obsoleta:
+        return sala
+
+    # Evitar que varias conexiones simultáneas carguen la misma sala
+    carga = _cargas.get(codigo)
+    if carga is None:
+        carga = asyncio.ensure_future(_recargar(codigo, sala))
+        _cargas[codigo] = carga
+        carga.add_done_callback(lambda _: _cargas.pop(codigo, None))
+    return await carga
+
+
+async def _recargar(codigo, anterior):
+    if anterior is None:
+        sala = await de_lectura(cargar_sala)(codigo)
+    else:
+        # Volcar primero lo que la sala tuviera pendiente para no perderlo; si no se puede,
+        # se sigue con la sala anterior y se recarga después de reintentarlo. La lectura se hace
+        # con el volcado cerrado para que vea también lo que estuviera escribiéndose
+        async with anterior.volcado:
+            if not await _volcar(anterior):
+                return anterior
+            sala = await de_lectura(cargar_sala)(codigo)
+    if sala is None:
+        _salas.pop(codigo, None)
+        return None
+    if anterior is not None:
+        sala.conexiones = anterior.conexiones
+        sala.canales = anterior.canales
+        sala.volcado = anterior.volcado
+        # Lo que haya cambiado fuera de la sala se publica como un delta más
+        sala.registrar_diferencias(anterior)
+    _salas[codigo] = sala
+    return sala
+
+
+def descartar_sala(codigo):
+    """Quita la sala del registro (por ejemplo, cuando la partida se borra)"""
+    sala = _salas.pop(codigo, None)
+    _marcas.pop(codigo, None)
+    lock = _candados.get(codigo)
+    if lock is not None and not lock.locked():
+        del _candados[codigo]
+    if sala is not None and sala.guardado_programado is not None:
+        sala.guardado_programado.cancel()
+
+
+async def guardar_sala(sala):
+    """
+    Vuelca inmediatamente los cambios pendientes de la sala. Devuelve False si
+    no se han podido escribir: siguen pendientes y se reintenta pasado
+    RETARDO_ESCRITURA.
+    """
+    async with sala.volcado:
+        return await _volcar(sala)
+
+
+async def _volcar(sala):
+    campos_sala, cambios_jugadores, incrementos, borrados = sala.extraer_pendientes()
+    if not campos_sala and not cambios_jugadores and not incrementos and not borrados:
+        return True
+    from .models import GamePlayer
+
+    # Completar cada jugador con todos los campos que se van a escribir en bloque
+    campos = set()
+    for valores in cambios_jugadores.values():
+        campos.update(valores)
+    filas = []
+    for jugador_id in cambios_jugadores:
+        fila = GamePlayer(id=jugador_id, session_id=sala.id)
+        for campo in campos:
+            setattr(fila, campo, getattr(sala.jugadores[jugador_id], campo))
+        filas.append(fila)
+    try:
+        await de_escritura(escribir_transicion)(
+            sala.id, campos_sala, filas, sorted(campos), incrementos, borrados
+        )
+    except Exception:
+        logger.exception('No se pudieron guardar los cambios de la sala %s', sala.codigo)
+        sala.devolver_pendientes(campos_sala, cambios_jugadores, incrementos, borrados)
+        programar_guardado(sala)
+        return False
+    return True
+
+
+def escribir_transicion(sala_id, campos_sala, jugadores, campos, incrementos=None, borrados=None):
+    """Escribe una transición de ronda en una sola transacción.
+
+    La partida se actualiza con un UPDATE de solo los campos cambiados y los
+    jugadores con un único bulk_update (UPDATE ... CASE) de esos campos. Los
+    puntos se suman en la base de datos (F('puntos') + n) con otro UPDATE y
+    los jugadores expulsados se borran con un DELETE. Una sola sentencia ya es
+    atómica, así que solo se abre la transacción cuando hay varias.
+    """
+    from django.db import transaction
+    from django.db.models import Case, F, Value, When
+    from django.utils import timezone
+    from .models import GameSession, GamePlayer
+
+    sentencias = sum(map(bool, (campos_sala, jugadores and campos, incrementos, borrados)))
+    with transaction.atomic() if sentencias > 1 else nullcontext():
+        if campos_sala:
+            # update() no aplica auto_now: la marca de actividad se pone a mano
+            GameSession.objects.filter(id=sala_id).update(actualizado=timezone.now(), **campos_sala)
+        if jugadores and campos:
+            GamePlayer.objects.bulk_update(jugadores, campos, batch_size=len(jugadores))
+        if incrementos:
+            GamePlayer.objects.filter(id__in=incrementos).update(puntos=F('puntos') + Case(
+                *[When(id=jugador_id, then=Value(puntos)) for jugador_id, puntos in incrementos.items()],
+                default=Value(0),
+            ))
+        if borrados:
+            GamePlayer.objects.filter(id__in=borrados).delete()
+
+
+class Transicion:
+    """Cambios de una acción sobre una partida de la base de datos, escritos de una vez.
+
+    La usan las vistas, que trabajan con los modelos en lugar de con la sala en memoria.
+    """
+
+    def __init__(self, partida):
+        self.partida = partida
+        self._jugadores = None
+        self.campos_sala = {}
+        self.modificados = {}
+        self.campos_jugadores = set()
+        self.incrementos = {}
+        # Lo ya escrito, para invalidar_sala
+        self.escritos_sala = set()
+        self.escritos_jugadores = set()
+        self.escritos_campos_jugadores = set()
+
+    def jugadores(self):
+        """Jugadores de la partida, leídos una sola vez por acción"""
+        if self._jugadores is None:
+            self._jugadores = list(self.partida.players.select_related('user').order_by('id'))
+        return self._jugadores
+
+    def jugador_de_usuario(self, user_id):
+        return next((j for j in self.jugadores() if str(j.user_id) == str(user_id)), None)
+
+    def jugador_por_id(self, jugador_id):
+        return next((j for j in self.jugadores() if j.id == jugador_id), None)
+
+    def foto(self):
+        return reglas.foto(self.partida.palabra_impostor, self.partida.ronda_terminada, self.jugadores())
+
+    def cambiar(self, **campos):
+        for campo, valor in campos.items():
+            if getattr(self.partida, campo) != valor:
+                self.campos_sala[campo] = valor
+            setattr(self.partida, campo, valor)
+
+    def cambiar_jugador(self, jugador, **campos):
+        for campo, valor in campos.items():
+            if getattr(jugador, campo) != valor:
+                self.modificados[jugador.id] = jugador
+                self.campos_jugadores.add(campo)
+            setattr(jugador, campo, valor)
+
+    def sumar_puntos(self, jugadores, puntos):
+        for jugador in jugadores:
+            self.incrementos[jugador.id] = self.incrementos.get(jugador.id, 0) + puntos
+            jugador.puntos += puntos
+
+    def guardar(self):
+        if not self.campos_sala and not self.modificados and not self.incrementos:
+            return
+        escribir_transicion(
+            self.partida.id, self.campos_sala, list(self.modificados.values()), sorted(self.campos_jugadores),
+            self.incrementos,
+        )
+        self.escritos_sala.update(self.campos_sala)
+        if self.campos_jugadores:
+            self.escritos_jugadores.update(self.modificados)
+            self.escritos_campos_jugadores.update(self.campos_jugadores)
+        self.campos_sala = {}
+        self.modificados = {}
+        self.campos_jugadores = set()
+        self.incrementos = {}
+
+    def escritos(self):
+        """Campos de la partida y de los jugadores que ha escrito la transición (los puntos se suman, no cuentan)"""
+        return {
+            'sala': sorted(self.escritos_sala),
+            'jugadores': sorted(self.escritos_jugadores),
+            'campos_jugadores': sorted(self.escritos_campos_jugadores),
+        }
+
+
+def programar_guardado(sala):
+    """Agrupa los cambios de la sala y los escribe pasado RETARDO_ESCRITURA"""
+    if sala.guardado_programado is not None and not sala.guardado_programado.done():
+        return
+
+    async def guardar_despues():
+        await asyncio.sleep(RETARDO_ESCRITURA)
+        # Lo que cambie mientras se escribe (o un reintento) programa otro guardado
+        sala.guardado_programado = None
+        guardada = await guardar_sala(sala)
+        if guardada and sala.conexiones <= 0 and _salas.get(sala.codigo) is sala:
+            # Se habían ido todos mientras no se podía escribir
+            descartar_sala(sala.codigo)
+
+    sala.guardado_programado = asyncio.ensure_future(guardar_despues())
+
+
+async def conectar(codigo, user_id, canal):
+    """Registra una conexión a la sala y la devuelve (None si no existe)"""
+    sala = await obtener_sala(codigo)
+    if sala is not None:
+        sala.conexiones += 1
+        sala.canales.setdefault(user_id, set()).add(canal)
+    return sala
+
+
+async def desconectar(codigo, user_id, canal):
+    """Registra la salida de una conexión; sin conexiones, la sala se vuelca y sale de memoria"""
+    sala = _salas.get(codigo)
+    if sala is None:
+        return
+    sala.conexiones -= 1
+    canales = sala.canales.get(user_id)
+    if canales is not None:
+        canales.discard(canal)
+        if not canales:
+            del sala.canales[user_id]
+    if sala.conexiones > 0:
+        return
+    if not await guardar_sala(sala):
+        # Sigue en memoria hasta que el reintento la escriba
+        return
+    if _salas.get(codigo) is sala and sala.conexiones <= 0:
+        descartar_sala(codigo)
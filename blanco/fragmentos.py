@@ -0,0 +1,86 @@
+"""
+Fragmentos de la página de partida renderizados en el servidor.
+
+La página completa (views.partida) y los clientes WebSocket usan las mismas
+plantillas de templates/blanco/fragmentos/, así que cuando cambia la sala solo
+se vuelven a renderizar y enviar las partes afectadas, sin recargar la página.
+"""
+from django.template.loader import render_to_string
+
+FRAGMENTOS = {
+    'estado': 'blanco/fragmentos/estado.html',
+    'palabra': 'blanco/fragmentos/palabra.html',
+    'puntuacion': 'blanco/fragmentos/puntuacion.html',
+    'jugadores': 'blanco/fragmentos/jugadores.html',
+    'roles': 'blanco/fragmentos/roles.html',
+    'controles': 'blanco/fragmentos/controles.html',
+    'ronda': 'blanco/fragmentos/ronda.html',
+}
+
+# Fragmentos que dependen de cada campo de la sala o de los jugadores
+DEPENDENCIAS_SALA = {
+    'estado': set(FRAGMENTOS),
+    'ronda_actual': {'estado', 'ronda'},
+    'ronda_terminada': {'estado', 'palabra', 'jugadores', 'roles', 'controles', 'ronda'},
+}
+DEPENDENCIAS_JUGADOR = {
+    'puntos': {'puntuacion'},
+    'ronda_actual': {'puntuacion'},
+    'eliminado': {'palabra', 'jugadores', 'roles', 'ronda'},
+    'ya_intento_adivinar': {'palabra'},
+    'es_impostor': {'jugadores', 'roles', 'ronda'},
+    'es_infiltrado': {'jugadores', 'roles', 'ronda'},
+    'es_bueno': {'jugadores', 'roles', 'ronda'},
+}
+# Cambios en quién está en la sala
+DEPENDENCIAS_MIEMBROS = {'puntuacion', 'jugadores', 'roles', 'controles', 'ronda'}
+
+
+def contexto(sala, user_id):
+    """Contexto común de la página y de los fragmentos para el jugador user_id"""
+    jugadores = list(sala.jugadores.values())
+    jugadores_activos = [j for j in jugadores if not j.eliminado]
+    mi_gameplayer = sala.jugador_de_usuario(user_id)
+    es_host = sala.es_host(user_id)
+
+    return {
+        'partida': sala,
+        'jugadores': jugadores,
+        'jugadores_activos': jugadores_activos,
+        'jugadores_eliminados': [j for j in jugadores if j.eliminado],
+        # Contar roles para mostrar información (solo para el host o si la ronda terminó)
+        'buenos_activos': [j for j in jugadores_activos if j.es_bueno],
+        'infiltrados_activos': [j for j in jugadores_activos if j.es_infiltrado],
+        'impostores_activos': [j for j in jugadores_activos if j.es_impostor],
+        'es_host': es_host,
+        'puede_empezar': es_host and len(jugadores) >= 4 and sala.estado != 'en_juego',
+        'palabra': mi_gameplayer.palabra_secreta if mi_gameplayer and sala.estado == 'en_juego' and not mi_gameplayer.eliminado else None,
+        'mi_gameplayer': mi_gameplayer,
+    }
+
+
+def renderizar(sala, user_id, nombres=None):
+    """Renderiza los fragmentos pedidos (todos si nombres es None) para el jugador user_id"""
+    ctx = contexto(sala, user_id)
+    if nombres is None:
+        nombres = FRAGMENTOS
+    return {nombre: render_to_string(FRAGMENTOS[nombre], ctx) for nombre in nombres if nombre in FRAGMENTOS}
+
+
+def afectados(delta, privado=None):
+    """Nombres de los fragmentos que cambian con un delta publicado por SalaEstado.publicar"""
+    nombres = set()
+    for campo in delta.get('partida', {}):
+        nombres |= DEPENDENCIAS_SALA.get(campo, set())
+    for cambios in delta.get('jugadores', {}).values():
+        if 'id' in cambios:
+            # Jugador nuevo en la sala
+            nombres |= DEPENDENCIAS_MIEMBROS
+        for campo in cambios:
+            nombres |= DEPENDENCIAS_JUGADOR.get(campo, set())
+    if delta.get('quitados'):
+        nombres |= DEPENDENCIAS_MIEMBROS
+    if privado:
+        nombres.add('palabra')
+    # Mantener el orden de la página
+    return [nombre for nombre in FRAGMENTOS if nombre in nombres]
@@ -0,0 +1,119 @@
+"""
+Límite de los mensajes que llegan por el WebSocket.
+
+Cada tipo de mensaje tiene un cubo de fichas (token bucket) por conexión y
+otro por sala: el cubo se rellena a `por_segundo` fichas por segundo hasta
+`rafaga`, cada mensaje gasta una y sin fichas el mensaje se descarta. Así un
+cliente con un fallo (o malintencionado) que repite mensajes en bucle no
+acapara ni la base de datos ni los sockets de los demás jugadores, y el de la
+sala acota lo que pueden sumar entre todas sus conexiones.
+
+Los límites se configuran por tipo en BLANCO_LIMITES, que se mezcla con
+LIMITES_POR_DEFECTO; '*' vale para las acciones sin entrada propia y None
+quita el límite de un ámbito:
+
+    BLANCO_LIMITES = {'refresh_request': {'conexion': (0.5, 2), 'sala': None}}
+
+Los descartados se cuentan por tipo y ámbito, y los refresh_request que
+llegan mientras la misma conexión tiene otro en curso se funden con él y se
+cuentan como colapsados (ver PartidaConsumer.receive). Las cuentas están en
+/blanco/metricas/.
+"""
+import time
+from collections import Counter
+
+from django.conf import settings
+
+from . import metricas
+
+# tipo -> {ámbito: (fichas por segundo, ráfaga)}
+LIMITES_POR_DEFECTO = {
+    'latido': {'conexion': (1, 5), 'sala': None},
+    'refresh_request': {'conexion': (1, 5), 'sala': (5, 20)},
+    '*': {'conexion': (10, 30), 'sala': (30, 90)},
+}
+LIMITES = {**LIMITES_POR_DEFECTO, **getattr(settings, 'BLANCO_LIMITES', {})}
+
+_descartados = Counter()  # (tipo, ámbito) -> mensajes
+_colapsados = Counter()  # tipo -> mensajes
+
+
+class Cubo:
+    """Fichas disponibles de un cubo, rellenadas al consultarlo"""
+    __slots__ = ('fichas', 'actualizado')
+
+    def __init__(self, rafaga):
+        self.fichas = rafaga
+        self.actualizado = time.monotonic()
+
+    def tomar(self, por_segundo, rafaga):
+        ahora = time.monotonic()
+        self.fichas = min(rafaga, self.fichas + (ahora - self.actualizado) * por_segundo)
+        self.actualizado = ahora
+        if self.fichas < 1:
+            return False
+        self.fichas -= 1
+        return True
+
+    def espera(self, por_segundo):
+        """Segundos hasta que haya una ficha"""
+        return max(0, 1 - self.fichas) / por_segundo
+
+
+def limites(tipo):
+    return LIMITES.get(tipo, LIMITES['*'])
+
+
+def _tomar(cubos, tipo, ambito):
+    limite = limites(tipo).get(ambito)
+    if limite is None:
+        return True
+    cubo = cubos.get(tipo)
+    if cubo is None:
+        cubo = cubos[tipo] = Cubo(limite[1])
+    return cubo.tomar(*limite)
+
+
+def admitir(tipo, conexion, sala=None):
+    """
+    Gasta una ficha del cubo de la conexión y otra del de la sala (los de cada
+    una, {tipo: Cubo}); devuelve False, y lo cuenta, si alguno está vacío.
+    """
+    if not _tomar(conexion, tipo, 'conexion'):
+        _descartados[tipo, 'conexion'] += 1
+        return False
+    if sala is not None and not _tomar(sala, tipo, 'sala'):
+        _descartados[tipo, 'sala'] += 1
+        return False
+    return True
+
+
+def reintentar_ms(tipo, conexion, sala=None):
+    """Milisegundos hasta que los dos cubos vuelvan a tener ficha para el tipo"""
+    espera = 0
+    for cubos, ambito in ((conexion, 'conexion'), (sala, 'sala')):
+        limite = limites(tipo).get(ambito)
+        if cubos is not None and limite is not None and tipo in cubos:
+            espera = max(espera, cubos[tipo].espera(limite[0]))
+    return int(espera * 1000) + 1
+
+
+def colapsar(tipo):
+    _colapsados[tipo] += 1
+
+
+def estadisticas():
+    return {
+        'descartados': {f'{tipo}:{ambito}': n for (tipo, ambito), n in sorted(_descartados.items())},
+        'colapsados': dict(_colapsados),
+    }
+
+
+metricas.registrar_indicador(
+    'blanco_mensajes_descartados_total', 'Mensajes del WebSocket descartados por el límite de su tipo', 'counter',
+    lambda: dict(_descartados), etiquetas=('tipo', 'limite'),
+)
+metricas.registrar_indicador(
+    'blanco_mensajes_colapsados_total', 'Mensajes fundidos con otro igual que ya estaba en curso', 'counter',
+    lambda: {(tipo,): n for tipo, n in _colapsados.items()}, etiquetas=('tipo',),
+)
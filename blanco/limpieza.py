@@ -0,0 +1,111 @@
+"""
+Limpieza de partidas abandonadas.
+
+Las partidas sin jugadores se borran con una sola consulta (NOT EXISTS) y las
+que llevan demasiado tiempo esperando o terminadas, por lotes, para que ni el
+logout ni el proceso dependan del número total de partidas. La limpieza
+periódica corre dentro del proceso ASGI cada BLANCO_LIMPIEZA_INTERVALO segundos
+(0 la desactiva; arranca con el proceso, ver arranque.py) y también se puede
+lanzar con `manage.py limpiar_partidas`.
+
+Una sala abierta en un proceso no está en la memoria de los demás, así que en
+cada pasada el proceso renueva la marca de actividad (actualizado) de las suyas
+y nadie expira una partida marcada hace menos de PRESENCIA segundos, aunque
+sea antigua: un lobby abierto en otro trabajador o durante el cron no se borra.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+
+from . import ejecutores, estado
+from .models import GamePlayer, GameSession
+
+logger = logging.getLogger(__name__)
+
+# Segundos de vida de una partida esperando o terminada, y de inactividad
+EDAD_MAXIMA = getattr(settings, 'BLANCO_PARTIDA_EDAD_MAXIMA', 24 * 3600)
+INACTIVIDAD_MAXIMA = getattr(settings, 'BLANCO_PARTIDA_INACTIVIDAD', 2 * 3600)
+INTERVALO = getattr(settings, 'BLANCO_LIMPIEZA_INTERVALO', 300)
+LOTE = getattr(settings, 'BLANCO_LIMPIEZA_LOTE', 500)
+# Segundos que protege la marca de las salas abiertas: cubre alguna pasada saltada
+PRESENCIA = getattr(settings, 'BLANCO_LIMPIEZA_PRESENCIA', 3 * INTERVALO)
+ESTADOS_EXPIRABLES = ('esperando', 'terminada')
+
+_tarea = None
+
+
+def borrar_partidas_vacias():
+    """Borra las partidas que no tienen ningún jugador; devuelve cuántas"""
+    vacias = GameSession.objects.filter(~Exists(GamePlayer.objects.filter(session=OuterRef('pk'))))
+    borradas, _ = vacias.delete()
+    return borradas
+
+
+def marcar_abiertas(ahora=None):
+    """Renueva la marca de actividad de las salas abiertas en este proceso; devuelve cuántas"""
+    codigos = [sala.codigo for sala in estado.salas_activas()]
+    if not codigos:
+        return 0
+    return GameSession.objects.filter(codigo__in=codigos).update(actualizado=ahora or timezone.now())
+
+
+def partidas_expiradas(ahora=None):
+    """Partidas esperando o terminadas demasiado antiguas o inactivas, y sin marca reciente de estar abiertas"""
+    ahora = ahora or timezone.now()
+    return GameSession.objects.filter(estado__in=ESTADOS_EXPIRABLES).filter(
+        Q(creado__lt=ahora - timedelta(seconds=EDAD_MAXIMA))
+        | Q(actualizado__lt=ahora - timedelta(seconds=INACTIVIDAD_MAXIMA))
+    ).exclude(actualizado__gte=ahora - timedelta(seconds=PRESENCIA))
+
+
+def expirar_partidas(ahora=None, lote=LOTE):
+    """Borra por lotes las partidas expiradas que no están abiertas en este ni en otro proceso"""
+    total = 0
+    abiertas = [sala.codigo for sala in estado.salas_activas()]
+    while True:
+        with transaction.atomic():
+            ids = list(
+                partidas_expiradas(ahora).exclude(codigo__in=abiertas).values_list('id', flat=True)[:lote]
+            )
+            if not ids:
+                break
+            GameSession.objects.filter(id__in=ids).delete()
+        total += len(ids)
+        if len(ids) < lote:
+            break
+    return total
+
+
+def limpiar(lote=LOTE):
+    """Una pasada completa de limpieza: (vacías, expiradas)"""
+    marcar_abiertas()
+    return borrar_partidas_vacias(), expirar_partidas(lote=lote)
+
+
+async def _limpiar_periodicamente():
+    while True:
+        await asyncio.sleep(INTERVALO)
+        # La limpieza puede esperar: si las escrituras de las partidas no le dejan hueco, se salta la pasada
+        if not await ejecutores.ESCRITURA.hueco():
+            continue
+        try:
+            vacias, expiradas = await ejecutores.de_escritura(limpiar)()
+        except Exception:
+            logger.exception('Falló la limpieza de partidas')
+            continue
+        if vacias or expiradas:
+            logger.info('Limpieza: %s partidas vacías y %s expiradas borradas', vacias, expiradas)
+
+
+def asegurar_limpieza():
+    """Arranca la limpieza periódica en el bucle del proceso (ver arranque.py) si no está corriendo"""
+    global _tarea
+    if INTERVALO <= 0:
+        return
+    if _tarea is None or _tarea.done():
+        _tarea = asyncio.ensure_future(_limpiar_periodicamente())
@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from blanco import rendimiento
+
+
+class Command(BaseCommand):
+    help = ('Compara la última ejecución de blanco.tests_rendimiento con las anteriores y falla '
+            'si alguna operación es más lenta que el umbral o hace más consultas')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--historial', default=rendimiento.HISTORIAL,
+            help='Fichero JSON del historial (por defecto BLANCO_RENDIMIENTO_HISTORIAL)'
+        )
+        parser.add_argument('--umbral', type=float, default=20, help='Porcentaje de empeoramiento tolerado')
+        parser.add_argument(
+            '--referencia', type=int, default=5,
+            help='Ejecuciones anteriores (de la misma base de datos) cuya mediana sirve de referencia'
+        )
+        parser.add_argument(
+            '--medida', choices=['minimo_ms', 'mediana_ms'], default='minimo_ms',
+            help='Tiempo que se compara: el mínimo es el que menos ruido tiene'
+        )
+
+    def handle(self, *args, **options):
+        if not options['historial']:
+            raise CommandError('Indica el historial con --historial o BLANCO_RENDIMIENTO_HISTORIAL')
+        historial = rendimiento.cargar(options['historial'])
+        if not historial:
+            raise CommandError(f'No hay ejecuciones en {options["historial"]}')
+
+        medida = options['medida']
+        filas = rendimiento.comparar(historial, options['umbral'], options['referencia'], medida)
+        self.stdout.write(f'Última ejecución: {historial[-1]["fecha"]} ({historial[-1]["base_de_datos"]})')
+        self.stdout.write(f'{"operación":<44} {"consultas":>9} {"antes ms":>9} {"ahora ms":>9} {"cambio":>7}')
+        regresiones = []
+        for nombre, antes, ahora, cambio, regresion in filas:
+            if antes is None:
+                self.stdout.write(f'{nombre:<44} {ahora["consultas"]:>9} {"-":>9} {ahora[medida]:>9.2f} {"nueva":>7}')
+                continue
+            consultas = str(ahora['consultas'])
+            if ahora['consultas'] != antes['consultas']:
+                consultas = f'{antes["consultas"]}→{ahora["consultas"]}'
+            linea = f'{nombre:<44} {consultas:>9} {antes[medida]:>9.2f} {ahora[medida]:>9.2f} {cambio:>+7.0%}'
+            if regresion:
+                regresiones.append(nombre)
+                linea = self.style.ERROR(linea)
+            self.stdout.write(linea)
+
+        if regresiones:
+            raise CommandError(
+                f'{len(regresiones)} operación(es) más lentas de un {options["umbral"]:g}% '
+                f'o con más consultas: {", ".join(regresiones)}'
+            )
+        self.stdout.write(self.style.SUCCESS('Sin regresiones'))
@@ -0,0 +1,33 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from blanco.reparto import GRUPO_TRABAJADORES
+
+
+class Command(BaseCommand):
+    help = 'Retira un trabajador del reparto de salas (o lo vuelve a activar con --activar)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('trabajador', help='Identificador del trabajador en BLANCO_TRABAJADORES')
+        parser.add_argument('--activar', action='store_true', help='Devolver el trabajador al reparto')
+
+    def handle(self, *args, **options):
+        trabajador = options['trabajador']
+        if trabajador not in getattr(settings, 'BLANCO_TRABAJADORES', {}):
+            raise CommandError(f'El trabajador "{trabajador}" no está en BLANCO_TRABAJADORES')
+
+        # El aviso llega a todos los procesos por la capa de canales compartida
+        tipo = 'trabajador.activar' if options['activar'] else 'trabajador.drenar'
+        async_to_sync(get_channel_layer().group_send)(
+            GRUPO_TRABAJADORES,
+            {'type': tipo, 'trabajador': trabajador}
+        )
+
+        if options['activar']:
+            self.stdout.write(self.style.SUCCESS(f'Trabajador {trabajador} devuelto al reparto'))
+        else:
+            self.stdout.write(self.style.SUCCESS(
+                f'Trabajador {trabajador} drenándose: sus salas se guardan y pasan a los demás'
+            ))
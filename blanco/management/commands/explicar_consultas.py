@@ -0,0 +1,74 @@
+import re
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from blanco.models import GamePlayer, GameSession
+
+# Líneas del plan que indican una lectura completa de la tabla
+RECORRIDO_COMPLETO = [
+    re.compile(r'\bSeq Scan on (\w+)'),          # PostgreSQL
+    re.compile(r'\bSCAN (\w+)(?! USING)\s*$'),   # SQLite
+]
+
+
+def consultas_calientes(partida_id, user_id, codigo):
+    """Consultas de los consumers y vistas que se ejecutan en cada acción"""
+    return [
+        ('jugador de la sala', GamePlayer.objects.filter(session_id=partida_id, user_id=user_id)),
+        ('jugadores activos', GamePlayer.objects.filter(session_id=partida_id, eliminado=False).order_by('id')),
+        ('partida por código', GameSession.objects.filter(codigo=codigo)),
+        ('salas del usuario', GamePlayer.objects.filter(user_id=user_id).values_list('session__codigo', flat=True)),
+        ('partidas por estado', GameSession.objects.filter(estado='esperando', creado__lt=timezone.now())),
+    ]
+
+
+def recorridos_completos(plan):
+    """Tablas que el plan lee enteras"""
+    tablas = []
+    for linea in plan.splitlines():
+        for patron in RECORRIDO_COMPLETO:
+            coincidencia = patron.search(linea)
+            if coincidencia:
+                tablas.append(coincidencia.group(1))
+    return tablas
+
+
+class Command(BaseCommand):
+    help = 'Ejecuta EXPLAIN sobre las consultas más frecuentes y comprueba que usan índices'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--plan', action='store_true', help='Mostrar el plan completo de cada consulta')
+        parser.add_argument(
+            '--sin-seqscan', action='store_true',
+            help='En PostgreSQL, desactivar enable_seqscan para ver si hay índice aunque la tabla sea pequeña'
+        )
+
+    def handle(self, *args, **options):
+        # Valores reales si los hay, para que el planificador use estadísticas representativas
+        jugador = GamePlayer.objects.select_related('session').first()
+        if jugador is not None:
+            partida_id, user_id, codigo = jugador.session_id, jugador.user_id, jugador.session.codigo
+        else:
+            partida_id, user_id, codigo = 1, 1, 'XXXXXX'
+
+        fallos = []
+        with transaction.atomic():
+            if options['sin_seqscan'] and connection.vendor == 'postgresql':
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+            for nombre, consulta in consultas_calientes(partida_id, user_id, codigo):
+                plan = consulta.explain()
+                tablas = recorridos_completos(plan)
+                if tablas:
+                    fallos.append(nombre)
+                    self.stdout.write(self.style.ERROR(f'{nombre}: recorre entera {", ".join(tablas)}'))
+                else:
+                    self.stdout.write(self.style.SUCCESS(f'{nombre}: usa índice'))
+                if options['plan']:
+                    self.stdout.write(plan)
+
+        if fallos:
+            raise CommandError(f'{len(fallos)} consulta(s) sin índice: {", ".join(fallos)}')
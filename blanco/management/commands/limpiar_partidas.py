@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from blanco import limpieza
+
+
+class Command(BaseCommand):
+    help = 'Borra las partidas vacías y las que llevan demasiado tiempo esperando, terminadas o inactivas'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lote', type=int, default=limpieza.LOTE, help='Partidas borradas por transacción')
+        parser.add_argument('--simular', action='store_true', help='Solo contar lo que se borraría')
+
+    def handle(self, *args, **options):
+        if options['simular']:
+            expiradas = limpieza.partidas_expiradas().count()
+            self.stdout.write(f'Se borrarían {expiradas} partidas expiradas (más las que estén vacías)')
+            return
+
+        vacias, expiradas = limpieza.limpiar(lote=options['lote'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{vacias} partidas vacías y {expiradas} expiradas borradas'
+        ))
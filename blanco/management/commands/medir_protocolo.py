@@ -0,0 +1,80 @@
+import json
+import timeit
+
+from django.core.management.base import BaseCommand
+
+from blanco import protocolo
+from blanco.estado import JugadorEstado, SalaEstado
+
+
+def sala_de_prueba(n):
+    """Sala en memoria con n jugadores esperando a empezar (sin base de datos)"""
+    jugadores = [
+        JugadorEstado(id=i, user_id=i, username=f'jugador{i}', puntos=0, ronda_actual=1, eliminado=False,
+                      es_impostor=False, es_infiltrado=False, es_bueno=False, ya_intento_adivinar=False)
+        for i in range(1, n + 1)
+    ]
+    return SalaEstado(id=1, codigo='MEDIDA', host_id=1, jugadores=jugadores, estado='esperando', ronda_actual=1,
+                      ronda_terminada=False)
+
+
+def mensajes_de_prueba(n):
+    """Los mensajes de estado más frecuentes de una partida con n jugadores"""
+    sala = sala_de_prueba(n)
+    sala.iniciar_partida('Croquetas', 'Tortilla española')
+    inicio, _ = sala.publicar()
+    snapshot = {'type': 'partida_updated', 'data': sala.datos(1)}
+    # El mismo snapshot con la parte pública ya codificada, como lo envía el consumer
+    en_cache = {
+        'type': 'partida_updated', 'data': sala.snapshot_publico().con(palabra_secreta=sala.palabra_secreta(1))
+    }
+    sala.eliminar_jugador(n)
+    eliminacion, _ = sala.publicar()
+    lote = {'type': 'lote', 'mensajes': [
+        dict(eliminacion, type='partida_delta'),
+        {'type': 'ronda_terminada', 'message': 'La ronda ha terminado. El host puede iniciar una nueva ronda.'},
+    ]}
+    return [
+        ('snapshot', snapshot),
+        ('snapshot caché', en_cache),
+        ('inicio de ronda', dict(inicio, type='partida_delta')),
+        ('eliminación', dict(eliminacion, type='partida_delta')),
+        ('lote', lote),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'Compara bytes y tiempo de codificación de los mensajes en JSON, compactos y comprimidos'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min', type=int, default=4, help='Jugadores de la sala más pequeña')
+        parser.add_argument('--max', type=int, default=9, help='Jugadores de la sala más grande')
+        parser.add_argument('--repeticiones', type=int, default=2000, help='Codificaciones por medida')
+
+    def handle(self, *args, **options):
+        repeticiones = options['repeticiones']
+        self.stdout.write(
+            f'{"jug.":>4}  {"mensaje":<16} {"JSON B":>7} {"compacto B":>10} {"ahorro":>7} {"deflate B":>9} '
+            f'{"JSON µs":>8} {"compacto µs":>11}'
+        )
+        for n in range(options['min'], options['max'] + 1):
+            for nombre, mensaje in mensajes_de_prueba(n):
+                normal = protocolo.codificar(mensaje)
+                compacto = protocolo.codificar(mensaje, compacto=True)
+                # La codificación compacta no pierde nada
+                assert protocolo.decodificar(compacto) == json.loads(normal), nombre
+
+                bytes_normal = len(normal.encode())
+                bytes_compacto = len(compacto.encode())
+                bytes_deflate = len(protocolo.comprimir(compacto))
+                tiempo_normal = timeit.timeit(lambda: protocolo.codificar(mensaje), number=repeticiones)
+                tiempo_compacto = timeit.timeit(
+                    lambda: protocolo.codificar(mensaje, compacto=True), number=repeticiones
+                )
+                self.stdout.write(
+                    f'{n:>4}  {nombre:<16} {bytes_normal:>7} {bytes_compacto:>10} '
+                    f'{1 - bytes_compacto / bytes_normal:>7.0%} {bytes_deflate:>9} '
+                    f'{tiempo_normal / repeticiones * 1e6:>8.1f} {tiempo_compacto / repeticiones * 1e6:>11.1f}'
+                )
+        self.stdout.write('Los fragmentos HTML de los deltas no se incluyen: ocupan lo mismo en las dos codificaciones.')
+        self.stdout.write(f'Solo se comprimen las tramas de al menos {protocolo.UMBRAL_COMPRESION} bytes.')
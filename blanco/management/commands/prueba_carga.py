@@ -0,0 +1,71 @@
+import json
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand
+
+from blanco import carga
+
+
+class Command(BaseCommand):
+    help = 'Juega muchas salas a la vez contra PartidaConsumer y mide latencia, mensajes, consultas y memoria'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--salas', type=int, default=50, help='Salas jugadas a la vez')
+        parser.add_argument('--min-jugadores', type=int, default=4)
+        parser.add_argument('--max-jugadores', type=int, default=9)
+        parser.add_argument('--rondas', type=int, default=3, help='Rondas por partida')
+        parser.add_argument('--pausa', type=float, default=1.0, help='Segundos medios entre acciones de una sala')
+        parser.add_argument('--semilla', type=int, help='Semilla de las decisiones de los jugadores')
+        parser.add_argument(
+            '--subprotocolo', default=carga.SUBPROTOCOLO,
+            help='Subprotocolo que ofrecen los clientes (vacío: JSON sin comprimir)'
+        )
+        parser.add_argument('--json', action='store_true', help='Escribir el resumen en JSON')
+
+    def handle(self, *args, **options):
+        resumen = async_to_sync(carga.simular)(
+            salas=options['salas'],
+            min_jugadores=options['min_jugadores'],
+            max_jugadores=options['max_jugadores'],
+            rondas=options['rondas'],
+            pausa=options['pausa'],
+            semilla=options['semilla'],
+            subprotocolo=options['subprotocolo'],
+        )
+        if options['json']:
+            self.stdout.write(json.dumps(resumen, indent=2))
+            return
+
+        self.stdout.write(
+            f'{resumen["salas"]} salas, {resumen["jugadores"]} jugadores, '
+            f'{resumen["acciones"]} acciones en {resumen["duracion_s"]:.1f} s'
+        )
+        for tipo, cuantas in sorted(resumen['acciones_por_tipo'].items()):
+            self.stdout.write(f'  {tipo:<20} {cuantas:>7}')
+        self.stdout.write(
+            f'Latencia acción → difusión: p50 {resumen["latencia_p50_ms"]:.1f} ms, '
+            f'p99 {resumen["latencia_p99_ms"]:.1f} ms, máx. {resumen["latencia_max_ms"]:.1f} ms'
+        )
+        self.stdout.write(
+            f'Recibido por los clientes: {resumen["mensajes_por_segundo"]:.0f} mensajes/s en '
+            f'{resumen["tramas_por_segundo"]:.0f} tramas/s ({resumen["bytes_por_segundo"] / 1024:.1f} KB/s)'
+        )
+        self.stdout.write(
+            f'Consultas: {resumen["consultas_por_accion"]:.2f} por acción, '
+            f'{resumen["consultas_por_conexion"]:.2f} por conexión'
+        )
+        self.stdout.write(
+            f'Memoria por sala: {resumen["memoria_sala_kb"]:.1f} KB de estado, '
+            f'{resumen["memoria_total_sala_kb"]:.1f} KB con conexiones y clientes simulados'
+        )
+        for nombre, ejecutor in resumen['ejecutores'].items():
+            self.stdout.write(
+                f'Ejecutor de {nombre}: {ejecutor["hilos"]} hilos, {ejecutor["aplazadas"]} aplazadas, '
+                f'{ejecutor["descartadas"]} descartadas'
+            )
+        for limite, descartados in resumen['limites']['descartados'].items():
+            self.stdout.write(self.style.WARNING(f'Descartados por el límite {limite}: {descartados}'))
+        if resumen['sin_respuesta']:
+            self.stdout.write(self.style.ERROR(
+                f'{resumen["sin_respuesta"]} acciones sin difusión en {carga.ESPERA_MAXIMA} s'
+            ))
@@ -0,0 +1,103 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from blanco import reglas, roles, simulacion
+
+
+class Command(BaseCommand):
+    help = 'Juega rondas al azar con las reglas de la ronda para cada reparto de roles y resume puntos y finales'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--min-jugadores', type=int, default=4)
+        parser.add_argument('--max-jugadores', type=int, default=9)
+        parser.add_argument('--rondas', type=int, default=10000, help='Rondas de cada reparto de roles')
+        parser.add_argument(
+            '--acierto', type=float, default=0.25, help='Probabilidad de que un impostor eliminado acierte la palabra'
+        )
+        parser.add_argument('--procesos', type=int, help='Procesos que juegan a la vez (por defecto, uno por CPU)')
+        parser.add_argument('--semilla', type=int)
+        parser.add_argument(
+            '--juego', action='store_true', help='Solo el reparto que usa el juego para cada tamaño (roles.py)'
+        )
+        parser.add_argument('--detalle', action='store_true', help='Puntos medios por rol de cada reparto')
+        parser.add_argument('--json', action='store_true', help='Escribir el resumen en JSON')
+
+    def handle(self, *args, **options):
+        inicio = time.perf_counter()
+        total, por_reparto = simulacion.simular(
+            min_jugadores=options['min_jugadores'],
+            max_jugadores=options['max_jugadores'],
+            rondas=options['rondas'],
+            acierto=options['acierto'],
+            procesos=options['procesos'],
+            semilla=options['semilla'],
+            solo_juego=options['juego'],
+        )
+        duracion = time.perf_counter() - inicio
+
+        if options['json']:
+            self.stdout.write(json.dumps({
+                'duracion_s': duracion,
+                'total': self.exportar(total),
+                'repartos': {'-'.join(map(str, reparto)): self.exportar(cuentas)
+                             for reparto, cuentas in sorted(por_reparto.items())},
+            }, indent=2))
+            return
+
+        self.stdout.write(
+            f'{total["rondas"]} rondas de {len(por_reparto)} repartos en {duracion:.1f} s '
+            f'({total["rondas"] / duracion:.0f} rondas/s)'
+        )
+        self.stdout.write('Puntos por jugador y ronda:')
+        for rol in reglas.ROLES:
+            histograma = total['puntos'][rol]
+            veces = sum(histograma.values())
+            if not veces:
+                continue
+            reparto = ', '.join(f'{valor}: {cuantas * 100 / veces:.1f}%' for valor, cuantas in sorted(histograma.items()))
+            self.stdout.write(f'  {rol:<11} media {simulacion.media(histograma):.2f}  ({reparto})')
+        longitud = total['longitud']
+        if longitud:
+            self.stdout.write(
+                f'Eliminaciones por ronda: media {simulacion.media(longitud):.2f}, '
+                f'p50 {simulacion.percentil(longitud, 50)}, p99 {simulacion.percentil(longitud, 99)}, '
+                f'máx. {max(longitud)}'
+            )
+        self.stdout.write('Finales:')
+        for codigos, veces in total['finales'].most_common():
+            self.stdout.write(f'  {codigos:<48} {veces * 100 / total["rondas"]:>6.2f}%')
+
+        if options['detalle']:
+            self.stdout.write(f'{"jug.":>4}  {"B-I-M":<8} {"bueno":>6} {"infiltr.":>8} {"impostor":>8} {"elim.":>6}')
+            for reparto, cuentas in sorted(por_reparto.items(), key=lambda p: (sum(p[0]), p[0])):
+                medias = [simulacion.media(cuentas['puntos'][rol]) for rol in reglas.ROLES]
+                columnas = ' '.join(f'{m:>{ancho}.2f}' if m is not None else ' ' * ancho
+                                    for m, ancho in zip(medias, (6, 8, 8)))
+                # * el reparto que usa el juego
+                marca = '*' if roles.reparto(sum(reparto)) == reparto else ' '
+                self.stdout.write(
+                    f'{sum(reparto):>4}{marca} {"-".join(map(str, reparto)):<8} {columnas} '
+                    f'{simulacion.media(cuentas["longitud"]) or 0:>6.2f}'
+                )
+
+        if total['atascos']:
+            self.stdout.write(self.style.ERROR(f'{total["atascos"]} rondas sin final (ninguna regla las termina):'))
+            for ejemplo in total['ejemplos']:
+                self.stdout.write(f'  {ejemplo}')
+        else:
+            self.stdout.write(self.style.SUCCESS('Todas las rondas han terminado con alguna regla'))
+
+    @staticmethod
+    def exportar(cuentas):
+        return {
+            'rondas': cuentas['rondas'],
+            'puntos': {rol: {str(valor): veces for valor, veces in sorted(histograma.items())}
+                       for rol, histograma in cuentas['puntos'].items()},
+            'puntos_medios': {rol: simulacion.media(histograma) for rol, histograma in cuentas['puntos'].items()},
+            'eliminaciones': {str(valor): veces for valor, veces in sorted(cuentas['longitud'].items())},
+            'finales': dict(cuentas['finales'].most_common()),
+            'atascos': cuentas['atascos'],
+            'ejemplos': cuentas['ejemplos'],
+        }
@@ -0,0 +1,281 @@
+"""
+Métricas del camino caliente: vistas, mensajes del consumer, consultas y saltos de hilo.
+
+Cada vista (MetricasMiddleware) y cada mensaje que despacha PartidaConsumer
+(medir() en dispatch) se cronometra en un histograma por tipo, junto con las
+consultas que hace y el tiempo que pasa en la base de datos. Las consultas se
+atribuyen con una ContextVar: database_sync_to_async copia el contexto al hilo
+en el que se ejecuta, así que las del consumer se cuentan aunque no corran en
+su hilo. database_sync_to_async de este módulo mide además cuánto cuesta el
+salto al hilo de la base de datos, y difusion.py anota a cuántos canales va
+cada vaciado. Los indicadores (gauges y contadores que se leen al exponer,
+como las colas de ejecutores.py) se añaden con registrar_indicador().
+
+Todo se expone en formato de texto de Prometheus en /blanco/metricas/ (solo
+staff). Con BLANCO_METRICAS = False no se instala nada: el middleware se
+retira, medir() devuelve un contexto vacío y database_sync_to_async es la de
+channels.
+"""
+import functools
+import threading
+import time
+from bisect import bisect_left
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+from channels.db import database_sync_to_async as _database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+ACTIVAS = getattr(settings, 'BLANCO_METRICAS', True)
+
+SEGUNDOS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+CUENTAS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histograma:
+    """Histograma acumulativo de Prometheus con una serie por combinación de etiquetas"""
+
+    def __init__(self, nombre, ayuda, limites, etiquetas=()):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.limites = limites
+        self.etiquetas = etiquetas
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observar(self, valor, *etiquetas):
+        with self.lock:
+            serie = self.series.get(etiquetas)
+            if serie is None:
+                # Una cubeta por límite, la de +Inf, la suma y la cuenta
+                serie = self.series[etiquetas] = [0] * (len(self.limites) + 1) + [0, 0]
+            serie[bisect_left(self.limites, valor)] += 1
+            serie[-2] += valor
+            serie[-1] += 1
+
+    def exponer(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} histogram']
+        with self.lock:
+            series = {etiquetas: list(serie) for etiquetas, serie in self.series.items()}
+        for valores, serie in sorted(series.items()):
+            base = [f'{nombre}="{_escapar(valor)}"' for nombre, valor in zip(self.etiquetas, valores)]
+            acumulado = 0
+            for limite, cuenta in zip(self.limites + ('+Inf',), serie):
+                acumulado += cuenta
+                cubeta = ','.join(base + [f'le="{limite}"'])
+                lineas.append(f'{self.nombre}_bucket{{{cubeta}}} {acumulado}')
+            sufijo = '{' + ','.join(base) + '}' if base else ''
+            lineas.append(f'{self.nombre}_sum{sufijo} {serie[-2]}')
+            lineas.append(f'{self.nombre}_count{sufijo} {serie[-1]}')
+        return lineas
+
+
+def _escapar(valor):
+    return str(valor).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Familia:
+    """Tiempo, consultas y tiempo de base de datos de un tipo de operación"""
+
+    def __init__(self, prefijo, que, etiquetas):
+        self.segundos = Histograma(f'{prefijo}_segundos', f'Duración de cada {que}', SEGUNDOS, etiquetas)
+        self.consultas = Histograma(f'{prefijo}_consultas', f'Consultas SQL de cada {que}', CUENTAS, etiquetas)
+        self.bd_segundos = Histograma(
+            f'{prefijo}_bd_segundos', f'Tiempo en la base de datos de cada {que}', SEGUNDOS, etiquetas
+        )
+
+    def histogramas(self):
+        return [self.segundos, self.consultas, self.bd_segundos]
+
+
+CONSUMER = Familia('blanco_consumer', 'mensaje del cliente o evento de la capa de canales', ('tipo',))
+VISTAS = Familia('blanco_vista', 'petición HTTP', ('vista', 'metodo'))
+SALTO_HILO = Histograma(
+    'blanco_salto_hilo_segundos', 'Espera de database_sync_to_async sin contar la función', SEGUNDOS, ('funcion',)
+)
+EJECUCION_HILO = Histograma(
+    'blanco_ejecucion_hilo_segundos', 'Ejecución de la función en el hilo de database_sync_to_async', SEGUNDOS,
+    ('funcion',)
+)
+DIFUSION = Histograma(
+    'blanco_difusion_destinatarios', 'Canales a los que se envía cada vaciado de la cola de una sala',
+    (1, 2, 4, 6, 9, 12, 16, 24, 32, 64),
+)
+ESPERA_EJECUTOR = Histograma(
+    'blanco_ejecutor_espera_segundos', 'Espera en la cola de un ejecutor hasta tener hilo', SEGUNDOS, ('ejecutor',)
+)
+HISTOGRAMAS = CONSUMER.histogramas() + VISTAS.histogramas() + [SALTO_HILO, EJECUCION_HILO, DIFUSION, ESPERA_EJECUTOR]
+
+
+class Indicador:
+    """Gauge o contador de Prometheus cuyo valor se lee al exponer"""
+
+    def __init__(self, nombre, ayuda, tipo, leer, etiquetas):
+        self.nombre = nombre
+        self.ayuda = ayuda
+        self.tipo = tipo
+        self.leer = leer
+        self.etiquetas = etiquetas
+
+    def exponer(self):
+        lineas = [f'# HELP {self.nombre} {self.ayuda}', f'# TYPE {self.nombre} {self.tipo}']
+        for valores, valor in sorted(self.leer().items()):
+            base = ','.join(f'{nombre}="{_escapar(v)}"' for nombre, v in zip(self.etiquetas, valores))
+            lineas.append(f'{self.nombre}{{{base}}} {valor}' if base else f'{self.nombre} {valor}')
+        return lineas
+
+
+INDICADORES = []
+
+
+def registrar_indicador(nombre, ayuda, tipo, leer, etiquetas=('ejecutor',)):
+    """leer() devuelve {(valores de las etiquetas): valor}"""
+    INDICADORES.append(Indicador(nombre, ayuda, tipo, leer, etiquetas))
+
+
+class Medicion:
+    """Lo que se va acumulando durante una operación medida"""
+    __slots__ = ('etiquetas', 'consultas', 'tiempo_bd', 'activa')
+
+    def __init__(self, etiquetas):
+        self.etiquetas = etiquetas
+        self.consultas = 0
+        self.tiempo_bd = 0
+        self.activa = True
+
+
+_medicion = ContextVar('blanco_medicion', default=None)
+
+
+class Cronometro:
+    """Contexto (normal o asíncrono) que mide una operación de una familia"""
+
+    def __init__(self, familia, etiquetas):
+        self.familia = familia
+        self.medicion = Medicion(etiquetas)
+
+    def __enter__(self):
+        self.token = _medicion.set(self.medicion)
+        self.inicio = time.perf_counter()
+        return self.medicion
+
+    def __exit__(self, *exc):
+        duracion = time.perf_counter() - self.inicio
+        _medicion.reset(self.token)
+        # Las tareas que se lanzaron durante la operación heredan la medición: ya no cuenta
+        medicion = self.medicion
+        medicion.activa = False
+        self.familia.segundos.observar(duracion, *medicion.etiquetas)
+        self.familia.consultas.observar(medicion.consultas, *medicion.etiquetas)
+        self.familia.bd_segundos.observar(medicion.tiempo_bd, *medicion.etiquetas)
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, *exc):
+        self.__exit__(*exc)
+
+
+_NADA = nullcontext()
+
+
+def medir(familia, *etiquetas):
+    if not ACTIVAS:
+        return _NADA
+    return Cronometro(familia, etiquetas)
+
+
+def etiquetar(*etiquetas):
+    """Cambia las etiquetas de la operación en curso (p. ej. al saber el tipo del mensaje)"""
+    medicion = _medicion.get()
+    if medicion is not None:
+        medicion.etiquetas = etiquetas
+
+
+def contar_consulta(execute, sql, params, many, context):
+    """execute_wrapper de todas las conexiones: suma la consulta a la operación en curso"""
+    medicion = _medicion.get()
+    if medicion is None or not medicion.activa:
+        return execute(sql, params, many, context)
+    inicio = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        medicion.consultas += 1
+        medicion.tiempo_bd += time.perf_counter() - inicio
+
+
+def instalar_en_conexion(sender=None, connection=None, **kwargs):
+    """Receptor de connection_created (y uso directo al arrancar)"""
+    if contar_consulta not in connection.execute_wrappers:
+        connection.execute_wrappers.append(contar_consulta)
+
+
+def instalar():
+    if not ACTIVAS:
+        return
+    from django.db.backends.signals import connection_created
+    connection_created.connect(instalar_en_conexion)
+    for conexion in connections.all():
+        instalar_en_conexion(connection=conexion)
+
+
+def database_sync_to_async(funcion, **opciones):
+    """channels.db.database_sync_to_async (con sus mismas opciones) que además mide el salto de hilo"""
+    if not ACTIVAS:
+        return _database_sync_to_async(funcion, **opciones)
+
+    def cronometrada(*args, **kwargs):
+        inicio = time.perf_counter()
+        resultado = funcion(*args, **kwargs)
+        return resultado, time.perf_counter() - inicio
+
+    en_hilo = _database_sync_to_async(cronometrada, **opciones)
+    nombre = getattr(funcion, '__qualname__', repr(funcion))
+
+    @functools.wraps(funcion)
+    async def medida(*args, **kwargs):
+        inicio = time.perf_counter()
+        resultado, ejecucion = await en_hilo(*args, **kwargs)
+        SALTO_HILO.observar(time.perf_counter() - inicio - ejecucion, nombre)
+        EJECUCION_HILO.observar(ejecucion, nombre)
+        return resultado
+
+    return medida
+
+
+def anotar_difusion(destinatarios):
+    if ACTIVAS:
+        DIFUSION.observar(destinatarios)
+
+
+def anotar_espera_ejecutor(ejecutor, segundos):
+    if ACTIVAS:
+        ESPERA_EJECUTOR.observar(segundos, ejecutor)
+
+
+class MetricasMiddleware:
+    """Mide cada vista; va al final de MIDDLEWARE para no contar los estáticos"""
+
+    def __init__(self, get_response):
+        if not ACTIVAS:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with Cronometro(VISTAS, ('-', request.method)) as medicion:
+            respuesta = self.get_response(request)
+            coincidencia = getattr(request, 'resolver_match', None)
+            if coincidencia is not None:
+                medicion.etiquetas = (coincidencia.view_name, request.method)
+        return respuesta
+
+
+def exponer():
+    """Todas las métricas en formato de texto de Prometheus"""
+    lineas = []
+    for metrica in HISTOGRAMAS + INDICADORES:
+        lineas.extend(metrica.exponer())
+    return '\n'.join(lineas) + '\n'
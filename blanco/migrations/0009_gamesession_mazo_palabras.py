@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-18 01:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blanco', '0008_alter_gameplayer_ya_intento_adivinar'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamesession',
+            name='mazo_palabras',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='gamesession',
+            name='posicion_mazo',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
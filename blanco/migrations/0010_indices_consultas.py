@@ -0,0 +1,27 @@
+# Generated by Django 5.2.4 on 2026-10-18 01:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blanco', '0009_gamesession_mazo_palabras'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='gameplayer',
+            index=models.Index(condition=models.Q(('eliminado', False)), fields=['session', 'id'], name='blanco_jugador_activo_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gameplayer',
+            index=models.Index(fields=['user', 'session'], name='blanco_jugador_usuario_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='gamesession',
+            index=models.Index(fields=['estado', 'creado'], name='blanco_partida_estado_idx'),
+        ),
+    ]
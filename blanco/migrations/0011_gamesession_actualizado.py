@@ -0,0 +1,24 @@
+# Generated by Django 5.2.4 on 2026-10-18 01:40
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('blanco', '0010_indices_consultas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='gamesession',
+            name='actualizado',
+            field=models.DateTimeField(auto_now=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddIndex(
+            model_name='gamesession',
+            index=models.Index(fields=['estado', 'actualizado'], name='blanco_partida_inactiva_idx'),
+        ),
+    ]
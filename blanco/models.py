@@ -6,6 +6,7 @@ from django.contrib.auth.models import User
 class GameSession(models.Model):
     codigo = models.CharField(max_length=8, unique=True)
     creado = models.DateTimeField(auto_now_add=True)
+    actualizado = models.DateTimeField(auto_now=True)  # Último cambio de la partida (para expirar las inactivas)
     estado = models.CharField(max_length=20, default='esperando')  # esperando, en_juego, terminada
     host = models.ForeignKey(User, on_delete=models.CASCADE, related_name='hosted_sessions', null=True, blank=True)
     palabra_impostor = models.CharField(max_length=100, blank=True, null=True)  # Palabra que debe adivinar el impostor
@@ -13,6 +14,15 @@ class GameSession(models.Model):
     ronda_actual = models.IntegerField(default=1)  # Número de ronda actual (1, 2, 3...)
     palabra_buena_actual = models.CharField(max_length=100, blank=True, null=True)
     palabra_infiltrado_actual = models.CharField(max_length=100, blank=True, null=True)
+    mazo_palabras = models.BinaryField(blank=True, null=True)  # IDs de PalabraPar barajados (array de enteros)
+    posicion_mazo = models.PositiveIntegerField(default=0)  # Siguiente carta del mazo
+
+    class Meta:
+        indexes = [
+            # Limpieza y listados de partidas por estado y antigüedad
+            models.Index(fields=['estado', 'creado'], name='blanco_partida_estado_idx'),
+            models.Index(fields=['estado', 'actualizado'], name='blanco_partida_inactiva_idx'),
+        ]
 
     def __str__(self):
         return f"Partida {self.codigo}"
@@ -32,6 +42,12 @@ class GamePlayer(models.Model):
 
     class Meta:
         unique_together = ('session', 'user')
+        indexes = [
+            # Jugadores activos de una sala en orden de llegada (parcial: solo los no eliminados)
+            models.Index(fields=['session', 'id'], condition=models.Q(eliminado=False), name='blanco_jugador_activo_idx'),
+            # Salas de un usuario (logout): la sesión sale del índice sin leer la tabla
+            models.Index(fields=['user', 'session'], name='blanco_jugador_usuario_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.username} en {self.session.codigo}"
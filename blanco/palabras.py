@@ -0,0 +1,193 @@
+"""
+Elección de pares de palabras sin consultar la base de datos en cada ronda.
+
+El índice guarda en memoria los pares de PalabraPar agrupados por categoría; la
+tabla de alias para sortear en O(1) con pesos por categoría se construye la
+primera vez que se sortea, no en cada recarga. Se reconstruye
+cuando se guarda o borra un par en este proceso (señales) o, como mucho, cada
+BLANCO_PALABRAS_TTL segundos para recoger los cambios hechos desde otros procesos.
+
+Cada partida además tiene su mazo: los IDs de los pares barajados y guardados
+como un array de enteros con la posición de la siguiente carta. Robar una carta
+es O(1) y no repite par hasta agotar el mazo, que entonces se vuelve a barajar.
+"""
+import math
+import random
+import threading
+import time
+from array import array
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import PalabraPar
+
+TTL = getattr(settings, 'BLANCO_PALABRAS_TTL', 300)
+# Peso de cada categoría en el sorteo ({'animales': 2}); las que no aparecen pesan 1
+PESOS_CATEGORIAS = getattr(settings, 'BLANCO_PESOS_CATEGORIAS', {})
+
+
+def tabla_alias(pesos):
+    """Tabla de alias de Vose: permite sortear un índice con esos pesos en O(1)"""
+    n = len(pesos)
+    total = sum(pesos)
+    probabilidad = [peso * n / total for peso in pesos]
+    alias = list(range(n))
+    pequenos = [i for i, p in enumerate(probabilidad) if p < 1]
+    grandes = [i for i, p in enumerate(probabilidad) if p >= 1]
+    while pequenos and grandes:
+        pequeno, grande = pequenos.pop(), grandes.pop()
+        alias[pequeno] = grande
+        probabilidad[grande] -= 1 - probabilidad[pequeno]
+        (pequenos if probabilidad[grande] < 1 else grandes).append(grande)
+    for i in pequenos + grandes:
+        probabilidad[i] = 1
+    return probabilidad, alias
+
+
+class MuestreadorPalabras:
+    """Índice en memoria de los pares de palabras con sorteo ponderado"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pares = None
+        self.por_id = {}
+        self.por_categoria = {}
+        self.probabilidad = None
+        self.alias = None
+        self.cargado_en = 0
+        self.sorteos = 0
+        self.tiempo_total = 0
+        self.tiempo_maximo = 0
+        self.barajados = 0
+
+    def cargado(self):
+        return self.pares is not None and time.monotonic() - self.cargado_en < TTL
+
+    def invalidar(self):
+        with self.lock:
+            self.pares = None
+
+    def cargar(self):
+        """Lee los pares de la base de datos y reconstruye el índice"""
+        pares = list(PalabraPar.objects.values_list('id', 'palabra_buena', 'palabra_infiltrado', 'categoria'))
+        por_categoria = {}
+        for i, (_, _, _, categoria) in enumerate(pares):
+            por_categoria.setdefault(categoria, []).append(i)
+        with self.lock:
+            self.pares = pares
+            self.por_id = {par[0]: i for i, par in enumerate(pares)}
+            self.por_categoria = por_categoria
+            # La tabla de alias solo la usa sortear(): se construye al primer sorteo
+            self.probabilidad = self.alias = None
+            self.cargado_en = time.monotonic()
+
+    def _tabla(self):
+        """Tabla de alias de los pares cargados, construida la primera vez que se pide"""
+        with self.lock:
+            if self.probabilidad is None:
+                pesos = [PESOS_CATEGORIAS.get(categoria, 1) for _, _, _, categoria in self.pares]
+                self.probabilidad, self.alias = tabla_alias(pesos) if pesos and sum(pesos) > 0 else ([], [])
+            return self.probabilidad, self.alias
+
+    def sortear(self, categoria=None, azar=random):
+        """Índice de un par al azar: de la categoría dada o, sin ella, con los pesos de las categorías"""
+        if not self.cargado():
+            self.cargar()
+        if categoria is not None:
+            indices = self.por_categoria.get(categoria)
+            return azar.choice(indices) if indices else None
+        probabilidad, alias = self._tabla()
+        if not probabilidad:
+            return None
+        i = azar.randrange(len(probabilidad))
+        return i if azar.random() < probabilidad[i] else alias[i]
+
+    def _medir(self, inicio):
+        duracion = time.perf_counter_ns() - inicio
+        self.sorteos += 1
+        self.tiempo_total += duracion
+        self.tiempo_maximo = max(self.tiempo_maximo, duracion)
+
+    def barajar(self):
+        """Mazo nuevo con todos los pares; las categorías con más peso tienden a salir antes"""
+        # Claves de Efraimidis-Spirakis: ordenar por u^(1/peso) da una permutación ponderada
+        claves = []
+        for id_par, _, _, categoria in self.pares:
+            peso = PESOS_CATEGORIAS.get(categoria, 1)
+            if peso > 0:
+                claves.append((math.log(1 - random.random()) / peso, id_par))
+        claves.sort(reverse=True)
+        self.barajados += 1
+        return array('I', (id_par for _, id_par in claves))
+
+    def robar(self, mazo, posicion, excluir=()):
+        """Saca la siguiente carta del mazo de una partida.
+
+        Devuelve ((palabra_buena, palabra_infiltrado) o None, mazo, posicion) con el
+        mazo y la posición que hay que guardar en la partida.
+        """
+        if not self.cargado():
+            self.cargar()
+        inicio = time.perf_counter_ns()
+        with self.lock:
+            mazo = mazo or b''
+            excluir = set(excluir)
+            elegido = None
+            # Como mucho dos pasadas: lo que queda del mazo actual y un mazo nuevo
+            for _ in range(2):
+                cartas = memoryview(mazo).cast('I')
+                if posicion >= len(cartas):
+                    mazo, posicion = bytearray(self.barajar()), 0
+                    cartas = memoryview(mazo).cast('I')
+                aplazadas = 0
+                while posicion < len(cartas):
+                    i = self.por_id.get(cartas[posicion])
+                    if i is None:
+                        # Par borrado desde que se barajó el mazo
+                        posicion += 1
+                        continue
+                    par = self.pares[i]
+                    if (par[1] in excluir or par[2] in excluir) and aplazadas < len(cartas) - posicion:
+                        # Recién usado (p. ej. al empezar un mazo nuevo): se cambia en su
+                        # sitio por una carta del final, sin copiar el mazo
+                        if not isinstance(mazo, bytearray):
+                            mazo = bytearray(mazo)
+                            cartas = memoryview(mazo).cast('I')
+                        final = len(cartas) - 1 - aplazadas
+                        cartas[posicion], cartas[final] = cartas[final], cartas[posicion]
+                        aplazadas += 1
+                        continue
+                    elegido = par
+                    posicion += 1
+                    break
+                if elegido is not None or not len(cartas):
+                    break
+            self._medir(inicio)
+        if elegido is None:
+            return None, mazo, posicion
+        return (elegido[1], elegido[2]), mazo, posicion
+
+    def estadisticas(self):
+        with self.lock:
+            return {
+                'cargado': self.pares is not None,
+                'pares': len(self.pares or []),
+                'categorias': {categoria or '': len(indices) for categoria, indices in self.por_categoria.items()},
+                'pesos': {categoria or '': PESOS_CATEGORIAS.get(categoria, 1) for categoria in self.por_categoria},
+                'tabla_alias': len(self.probabilidad or []),
+                'mazos_barajados': self.barajados,
+                'robos': self.sorteos,
+                'latencia_media_us': round(self.tiempo_total / self.sorteos / 1000, 2) if self.sorteos else 0,
+                'latencia_maxima_us': round(self.tiempo_maximo / 1000, 2),
+            }
+
+
+muestreador = MuestreadorPalabras()
+
+
+@receiver(post_save, sender=PalabraPar)
+@receiver(post_delete, sender=PalabraPar)
+def invalidar_indice(sender, **kwargs):
+    muestreador.invalidar()
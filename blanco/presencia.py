@@ -0,0 +1,156 @@
+"""
+Presencia de los jugadores en las salas.
+
+Cada proceso cuenta en memoria las conexiones abiertas de cada (codigo, user_id):
+una recarga de página abre una conexión nueva y cierra la anterior sin que el
+jugador se haya ido. La salida solo se anuncia si pasados GRACIA segundos el
+jugador no ha vuelto, y las entradas y salidas de una sala se agrupan en un
+único aviso por cada VENTANA. Con el reparto de salas (reparto.py) todas las
+conexiones de una sala llegan al mismo proceso, así que la cuenta local es la
+de la sala.
+
+Los clientes envían un latido cada pocos segundos. Las conexiones que pasan
+CADUCIDAD segundos sin latir se cierran: la red las ha perdido sin avisar.
+"""
+import asyncio
+import logging
+import time
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Segundos que se espera a que vuelva un jugador antes de anunciar que se ha ido
+GRACIA = getattr(settings, 'BLANCO_PRESENCIA_GRACIA', 5)
+# Segundos durante los que se acumulan entradas y salidas antes de avisar a la sala
+VENTANA = getattr(settings, 'BLANCO_PRESENCIA_VENTANA', 1)
+# Segundos sin latido tras los que se cierra una conexión (0 desactiva la vigilancia).
+# Holgado: los navegadores espacian los temporizadores de las pestañas en segundo plano.
+CADUCIDAD = getattr(settings, 'BLANCO_PRESENCIA_CADUCIDAD', 90)
+
+
+class Presencia:
+    """Conexiones abiertas de un jugador en una sala"""
+    __slots__ = ('username', 'canales', 'salida')
+
+    def __init__(self, username):
+        self.username = username
+        self.canales = set()
+        self.salida = None
+
+
+_presencias = {}  # codigo -> {user_id: Presencia}
+_latidos = {}  # canal -> último latido (time.monotonic)
+_avisos = {}  # codigo -> {'conectados': {user_id: username}, 'desconectados': {...}}
+_vigilancia = None
+
+
+def entrar(codigo, user_id, username, canal):
+    """Registra una conexión; devuelve True si el jugador no estaba ya presente"""
+    jugadores = _presencias.setdefault(codigo, {})
+    presencia = jugadores.get(user_id)
+    nuevo = presencia is None
+    if nuevo:
+        presencia = jugadores[user_id] = Presencia(username)
+        _anotar(codigo, user_id, username, entra=True)
+    elif presencia.salida is not None:
+        # Ha vuelto dentro del periodo de gracia (recarga o reconexión): no se anuncia nada
+        presencia.salida.cancel()
+        presencia.salida = None
+    presencia.canales.add(canal)
+    _latidos[canal] = time.monotonic()
+    return nuevo
+
+
+def salir(codigo, user_id, canal):
+    """Registra el cierre de una conexión; sin conexiones, la salida se anuncia pasada la gracia"""
+    _latidos.pop(canal, None)
+    presencia = _presencias.get(codigo, {}).get(user_id)
+    if presencia is None:
+        return
+    presencia.canales.discard(canal)
+    if not presencia.canales and presencia.salida is None:
+        presencia.salida = asyncio.get_running_loop().call_later(GRACIA, _marcharse, codigo, user_id)
+
+
+def _marcharse(codigo, user_id):
+    jugadores = _presencias.get(codigo, {})
+    presencia = jugadores.get(user_id)
+    if presencia is None or presencia.canales:
+        return
+    del jugadores[user_id]
+    if not jugadores:
+        del _presencias[codigo]
+    _anotar(codigo, user_id, presencia.username, entra=False)
+
+
+def _anotar(codigo, user_id, username, entra):
+    """Acumula el cambio para el próximo aviso; una entrada y una salida en la misma ventana se anulan"""
+    avisos = _avisos.get(codigo)
+    if avisos is None:
+        avisos = _avisos[codigo] = {'conectados': {}, 'desconectados': {}}
+        asyncio.ensure_future(_publicar(codigo))
+    contrario = avisos['desconectados' if entra else 'conectados']
+    if user_id in contrario:
+        del contrario[user_id]
+    else:
+        avisos['conectados' if entra else 'desconectados'][user_id] = username
+
+
+async def _publicar(codigo):
+    await asyncio.sleep(VENTANA)
+    avisos = _avisos.pop(codigo, None)
+    if not avisos or not (avisos['conectados'] or avisos['desconectados']):
+        return
+    await get_channel_layer().group_send(f'partida_{codigo}', {
+        'type': 'partida_message',
+        'message': {
+            'type': 'presencia',
+            'conectados': list(avisos['conectados'].values()),
+            'desconectados': list(avisos['desconectados'].values()),
+            'presentes': presentes(codigo),
+        }
+    })
+
+
+def presentes(codigo):
+    """IDs de los usuarios presentes en la sala (incluidos los que están en periodo de gracia)"""
+    return sorted(_presencias.get(codigo, {}))
+
+
+def esta_presente(codigo, user_id):
+    return user_id in _presencias.get(codigo, {})
+
+
+def latido(canal):
+    if canal in _latidos:
+        _latidos[canal] = time.monotonic()
+
+
+def caducados(ahora=None):
+    """Canales que llevan más de CADUCIDAD segundos sin latir"""
+    limite = (ahora or time.monotonic()) - CADUCIDAD
+    return [canal for canal, ultimo in _latidos.items() if ultimo < limite]
+
+
+async def _vigilar_latidos():
+    channel_layer = get_channel_layer()
+    while True:
+        await asyncio.sleep(CADUCIDAD / 3)
+        for canal in caducados():
+            # El consumer cierra la conexión; su disconnect la quita de la presencia
+            _latidos.pop(canal, None)
+            try:
+                await channel_layer.send(canal, {'type': 'presencia.caducada'})
+            except Exception:
+                logger.exception('No se pudo cerrar la conexión sin latido %s', canal)
+
+
+def asegurar_vigilancia():
+    """Arranca la vigilancia de latidos en el bucle del proceso si no está corriendo"""
+    global _vigilancia
+    if CADUCIDAD <= 0:
+        return
+    if _vigilancia is None or _vigilancia.done():
+        _vigilancia = asyncio.ensure_future(_vigilar_latidos())
@@ -0,0 +1,262 @@
+"""
+Codificación compacta y compresión de los mensajes del WebSocket de la partida.
+
+El cliente la pide ofreciendo el subprotocolo SUBPROTOCOLO en el handshake; si
+no lo ofrece (o el servidor no lo acepta) todo sigue en JSON normal. Una trama
+compacta es JSON sin espacios de la forma [VERSION, mensaje], y en el mensaje:
+
+- las claves conocidas (CLAVES) van abreviadas a una o dos letras; las claves
+  desconocidas que se podrían confundir con una abreviatura llevan delante '~';
+- los valores conocidos de 'type' (TIPOS) van como su posición en la lista;
+- las listas de diccionarios con las mismas claves (los jugadores de un
+  snapshot) van por columnas: {'#': [claves], '=': [[valores], ...]};
+- los booleanos de las claves de BOOLEANOS van como 1 y 0.
+
+La página recibe el esquema en la plantilla, así que websocket.js no repite
+ninguna tabla. Las listas solo pueden crecer por el final; cualquier otro
+cambio debe subir VERSION, que forma parte del nombre del subprotocolo.
+
+La compresión se negocia igual, añadiendo '+deflate' al subprotocolo
+(blanco.compacto.1+deflate, o blanco.json+deflate sin codificación compacta).
+Con ella, las tramas de al menos UMBRAL_COMPRESION bytes se envían como
+mensajes binarios comprimidos con deflate (sin cabecera zlib, cada uno por
+separado); las pequeñas siguen como texto porque comprimirlas no compensa.
+
+Un valor Codificado (la parte pública del snapshot de una sala, ver
+SalaEstado.snapshot_publico) se codifica una vez por formato y codificar() lo
+inserta ya hecho en la trama.
+"""
+import json
+import secrets
+import string
+import zlib
+
+from django.conf import settings
+
+VERSION = 1
+SUBPROTOCOLO = f'blanco.compacto.{VERSION}'
+SUBPROTOCOLO_JSON = 'blanco.json'
+EXTENSION_DEFLATE = 'deflate'
+
+COMPRIMIR = getattr(settings, 'BLANCO_COMPRESION', True)
+# Bytes a partir de los que una trama se comprime
+UMBRAL_COMPRESION = getattr(settings, 'BLANCO_COMPRESION_UMBRAL', 512)
+NIVEL_COMPRESION = getattr(settings, 'BLANCO_COMPRESION_NIVEL', 6)
+
+CLAVES = [
+    'type', 'data', 'version', 'partida', 'jugadores', 'quitados', 'privado', 'fragmentos',
+    'mensajes', 'message', 'resultado', 'correcto', 'mensaje', 'error', 'estado', 'ronda_actual',
+    'ronda_terminada', 'palabra_buena_actual', 'palabra_infiltrado_actual', 'jugadores_activos',
+    'jugadores_eliminados', 'palabra_secreta', 'presentes', 'id', 'user_id', 'username', 'es_host',
+    'puntos', 'eliminado', 'es_impostor', 'es_infiltrado', 'es_bueno', 'ya_intento_adivinar',
+    'conectados', 'desconectados', 'url', 'jugador_id', 'palabra_adivinada', 'palabra',
+    'puntuacion', 'roles', 'controles', 'ronda', 'reintentar',
+]
+
+TIPOS = [
+    'partida_updated', 'partida_delta', 'lote', 'presencia', 'latido', 'redirigir', 'error',
+    'jugador_eliminado', 'jugador_expulsado', 'partida_iniciada', 'nueva_ronda_iniciada',
+    'partida_terminada', 'ronda_terminada', 'adivinacion_resultado', 'refresh_request',
+    'eliminar_jugador', 'nueva_ronda', 'iniciar_partida', 'terminar_partida', 'expulsar_jugador',
+    'adivinar_palabra', 'ocupado',
+]
+
+BOOLEANOS = {
+    'es_host', 'eliminado', 'es_impostor', 'es_infiltrado', 'es_bueno', 'ya_intento_adivinar',
+    'ronda_terminada', 'correcto',
+}
+
+
+def abreviatura(posicion):
+    """a, b, ..., Z, aa, ab, ...: la misma regla que aplica websocket.js"""
+    letras = string.ascii_letters
+    if posicion < len(letras):
+        return letras[posicion]
+    return letras[posicion // len(letras) - 1] + letras[posicion % len(letras)]
+
+
+ABREVIATURAS = {clave: abreviatura(i) for i, clave in enumerate(CLAVES)}
+CLAVES_ABREVIADAS = {corta: clave for clave, corta in ABREVIATURAS.items()}
+RESERVADAS = set(CLAVES_ABREVIADAS) | {'#', '='}
+POSICION_TIPOS = {tipo: i for i, tipo in enumerate(TIPOS)}
+
+
+def esquema():
+    """Lo que necesita el cliente para codificar y decodificar, para la plantilla"""
+    return {
+        'subprotocolo': SUBPROTOCOLO,
+        'compresion': EXTENSION_DEFLATE if COMPRIMIR else None,
+        'version': VERSION,
+        'claves': CLAVES,
+        'tipos': TIPOS,
+        'booleanos': sorted(BOOLEANOS),
+    }
+
+
+def _compactar_clave(clave):
+    if clave in ABREVIATURAS:
+        return ABREVIATURAS[clave]
+    clave = str(clave)
+    if clave in RESERVADAS or clave.startswith('~'):
+        return '~' + clave
+    return clave
+
+
+def _expandir_clave(clave):
+    if clave.startswith('~'):
+        return clave[1:]
+    return CLAVES_ABREVIADAS.get(clave, clave)
+
+
+def compactar(valor, clave=None):
+    if isinstance(valor, dict):
+        return {_compactar_clave(k): compactar(v, k) for k, v in valor.items()}
+    if isinstance(valor, (list, tuple)):
+        if len(valor) > 1 and all(isinstance(v, dict) for v in valor):
+            columnas = list(valor[0])
+            if all(list(v) == columnas for v in valor):
+                return {
+                    '#': [_compactar_clave(c) for c in columnas],
+                    '=': [[compactar(fila[c], c) for c in columnas] for fila in valor],
+                }
+        return [compactar(v) for v in valor]
+    if isinstance(valor, bool):
+        return int(valor) if clave in BOOLEANOS else valor
+    if clave == 'type' and valor in POSICION_TIPOS:
+        return POSICION_TIPOS[valor]
+    return valor
+
+
+def expandir(valor, clave=None):
+    if isinstance(valor, dict):
+        if len(valor) == 2 and '#' in valor and '=' in valor:
+            columnas = [_expandir_clave(c) for c in valor['#']]
+            return [{c: expandir(v, c) for c, v in zip(columnas, fila)} for fila in valor['=']]
+        expandido = {}
+        for k, v in valor.items():
+            k = _expandir_clave(k)
+            expandido[k] = expandir(v, k)
+        return expandido
+    if isinstance(valor, list):
+        return [expandir(v) for v in valor]
+    if clave in BOOLEANOS and type(valor) is int:
+        return bool(valor)
+    if clave == 'type' and type(valor) is int:
+        return TIPOS[valor]
+    return valor
+
+
+def negociar(ofrecidos):
+    """Elige el primer subprotocolo ofrecido que se soporta: (subprotocolo, compacto, comprimido)"""
+    for ofrecido in ofrecidos:
+        base, _, extension = ofrecido.partition('+')
+        if base not in (SUBPROTOCOLO, SUBPROTOCOLO_JSON) or extension not in ('', EXTENSION_DEFLATE):
+            continue
+        if extension and not COMPRIMIR:
+            continue
+        return ofrecido, base == SUBPROTOCOLO, bool(extension)
+    return None, False, False
+
+
+def comprimir(texto):
+    """Deflate sin cabecera, lo que espera DecompressionStream('deflate-raw') en el navegador"""
+    compresor = zlib.compressobj(NIVEL_COMPRESION, zlib.DEFLATED, -15)
+    return compresor.compress(texto.encode()) + compresor.flush()
+
+
+def _codificar(valor, compacto, default=None):
+    if not compacto:
+        return json.dumps(valor, default=default)
+    return json.dumps(compactar(valor), separators=(',', ':'), ensure_ascii=False, default=default)
+
+
+class Codificado:
+    """
+    Diccionario que se codifica una sola vez por formato. con() devuelve el
+    mismo diccionario con claves añadidas, que se codifican aparte y se unen
+    al texto ya hecho: el texto común se comparte entre todas las copias.
+    """
+    __slots__ = ('valor', 'extra', 'textos')
+
+    def __init__(self, valor, extra=None, textos=None):
+        self.valor = valor
+        self.extra = extra
+        self.textos = {} if textos is None else textos
+
+    def con(self, **extra):
+        return Codificado(self.valor, extra, self.textos)
+
+    def texto(self, compacto):
+        base = self.textos.get(compacto)
+        if base is None:
+            base = self.textos[compacto] = _codificar(self.valor, compacto)
+        if not self.extra:
+            return base
+        extra = _codificar(self.extra, compacto)
+        if base == '{}':
+            return extra
+        # '{...}' + '{...}' -> '{..., ...}', con el separador que pondría json.dumps
+        return base[:-1] + (',' if compacto else ', ') + extra[1:]
+
+
+# Marca de los valores Codificado en el texto intermedio; no puede coincidir con un texto de los jugadores
+_MARCA = '\x00' + secrets.token_hex(8)
+
+
+def codificar(mensaje, compacto=False):
+    """Texto de la trama para el cliente"""
+    insertados = []
+
+    def insertar(valor):
+        if not isinstance(valor, Codificado):
+            raise TypeError(f'{type(valor).__name__} no se puede codificar')
+        insertados.append(valor.texto(compacto))
+        return f'{_MARCA}{len(insertados) - 1}'
+
+    texto = _codificar(mensaje if not compacto else [VERSION, mensaje], compacto, insertar)
+    for posicion, insertado in enumerate(insertados):
+        # json.dumps escapa siempre el carácter nulo de la marca como \u0000
+        marca = json.dumps(f'{_MARCA}{posicion}')
+        texto = texto.replace(marca, insertado, 1)
+    return texto
+
+
+def decodificar(texto):
+    """Mensaje de una trama del cliente, venga en JSON normal o compacto"""
+    datos = json.loads(texto)
+    if not isinstance(datos, list):
+        return datos
+    if len(datos) != 2 or datos[0] != VERSION:
+        raise ValueError(f'Versión del protocolo compacto no soportada: {datos[:1]}')
+    return expandir(datos[1])
+
+
+_totales = {'mensajes': 0, 'tramas': 0, 'comprimidas': 0, 'bytes_originales': 0, 'bytes_enviados': 0}
+
+
+def registrar_envio(sala, mensajes, original, enviado, comprimida):
+    """Cuenta una trama enviada, en total y en la sala (si sigue en memoria)"""
+    contadores = [_totales]
+    if sala is not None:
+        contadores.append(sala.transmision)
+    for contador in contadores:
+        contador['mensajes'] = contador.get('mensajes', 0) + mensajes
+        contador['tramas'] = contador.get('tramas', 0) + 1
+        contador['comprimidas'] = contador.get('comprimidas', 0) + comprimida
+        contador['bytes_originales'] = contador.get('bytes_originales', 0) + original
+        contador['bytes_enviados'] = contador.get('bytes_enviados', 0) + enviado
+
+
+def estadisticas(salas=()):
+    """Bytes ahorrados por la compresión y tramas ahorradas al agrupar, en total y por sala"""
+    def resumen(contador):
+        datos = dict(contador)
+        datos['bytes_ahorrados'] = datos.get('bytes_originales', 0) - datos.get('bytes_enviados', 0)
+        datos['tramas_ahorradas'] = datos.get('mensajes', 0) - datos.get('tramas', 0)
+        return datos
+
+    return {
+        'umbral_compresion': UMBRAL_COMPRESION,
+        'total': resumen(_totales),
+        'salas': {sala.codigo: resumen(sala.transmision) for sala in salas if sala.transmision},
+    }
@@ -0,0 +1,211 @@
+"""
+Reglas de la ronda del juego Blanco, sin base de datos.
+
+Las vistas (con los modelos, a través de estado.Transicion) y el consumer (con
+la sala en memoria) aplican las mismas reglas: las dos capas hacen una Foto
+inmutable de la ronda, le piden aquí el Resultado de la acción y lo aplican
+con aplicar(). Cada regla recorre los jugadores una sola vez.
+
+El Resultado dice qué jugador se elimina o gasta su intento de adivinar, los
+puntos que gana cada uno, si la ronda termina y los códigos del mensaje, que
+mensaje() convierte en texto. Los puntos del 1 vs 1 salen de la tabla
+PUNTOS_1VS1.
+"""
+import re
+import unicodedata
+from collections import namedtuple
+
+# Lo mínimo de cada jugador para las reglas; rol es 'bueno', 'infiltrado', 'impostor' o None
+Jugador = namedtuple('Jugador', 'id rol eliminado ya_intento_adivinar')
+Foto = namedtuple('Foto', 'palabra_impostor ronda_terminada jugadores')
+Resultado = namedtuple(
+    'Resultado', 'eliminado intento correcto puntos ronda_terminada codigos',
+    defaults=(None, None, None, {}, False, ()),
+)
+
+ROLES = ('bueno', 'infiltrado', 'impostor')
+
+# Roles de los dos últimos jugadores (en orden alfabético) -> (puntos por rol, mensaje)
+PUNTOS_1VS1 = {
+    ('bueno', 'bueno'): ({'bueno': 1}, 'Dos buenos, cada uno gana 1 punto.'),
+    ('bueno', 'infiltrado'): ({'infiltrado': 2}, 'Un infiltrado y un bueno, el infiltrado gana 2 puntos.'),
+    ('bueno', 'impostor'): ({'impostor': 3}, 'Un impostor y un bueno: impostor 3 puntos.'),
+    ('impostor', 'infiltrado'): (
+        {'impostor': 3, 'infiltrado': 2}, 'Un impostor y un infiltrado: impostor 3 puntos, infiltrado 2 puntos.'
+    ),
+    ('impostor', 'impostor'): ({'impostor': 3}, 'Dos impostores, cada uno gana 3 puntos.'),
+    ('infiltrado', 'infiltrado'): ({'infiltrado': 2}, 'Dos infiltrados, cada uno gana 2 puntos.'),
+}
+PUNTOS_BUENOS = 1
+PUNTOS_ACIERTO = 3
+
+MENSAJES = {
+    'acierto': '¡Correcto! El impostor ha ganado adivinando la palabra y se lleva 3 puntos.',
+    'fallo': 'Incorrecto. La palabra era "{palabra}".',
+    'otros_impostores': 'Otros impostores eliminados aún pueden intentar adivinar.',
+    'esperan_adivinacion': (
+        'Todos los malos han sido eliminados, pero hay impostores que pueden intentar adivinar la palabra.'
+    ),
+    'esperan_adivinacion_1vs1': (
+        '¡Llegamos a 1 vs 1! Hay impostores eliminados que pueden intentar adivinar la palabra antes de '
+        'asignar puntos.'
+    ),
+    'ganan_buenos': (
+        '¡Los buenos han ganado! Todos los malos han sido eliminados. Los buenos activos ganan 1 punto cada uno.'
+    ),
+    '1vs1': '¡Llegamos a 1 vs 1!',
+    'uno_solo': 'Solo queda 1 jugador.',
+    'continua': 'La ronda continúa.',
+    'terminada': 'La ronda ha terminado.',
+}
+MENSAJES.update({'1vs1_' + '_'.join(roles): texto for roles, (_, texto) in PUNTOS_1VS1.items()})
+
+
+def rol(jugador):
+    """Rol de un GamePlayer o JugadorEstado"""
+    if jugador.es_impostor:
+        return 'impostor'
+    if jugador.es_infiltrado:
+        return 'infiltrado'
+    if jugador.es_bueno:
+        return 'bueno'
+    return None
+
+
+def foto(palabra_impostor, ronda_terminada, jugadores):
+    """Foto de la ronda a partir de los jugadores del modelo o de la sala en memoria"""
+    return Foto(palabra_impostor, ronda_terminada, tuple(
+        Jugador(j.id, rol(j), j.eliminado, j.ya_intento_adivinar) for j in jugadores
+    ))
+
+
+def normalizar_texto(texto):
+    """Normaliza texto: convierte a minúsculas y quita acentos"""
+    # Convertir a minúsculas
+    texto = texto.lower()
+    # Normalizar unicode (quitar acentos)
+    texto = unicodedata.normalize('NFD', texto)
+    # Quitar caracteres diacríticos (acentos)
+    texto = re.sub(r'[^\w\s]', '', texto)
+    # Quitar espacios extra
+    texto = texto.strip()
+    return texto
+
+
+def _recuento(jugadores, eliminado=None, intento=None):
+    """
+    Una pasada por los jugadores, como si `eliminado` ya estuviera eliminado e
+    `intento` ya hubiera intentado adivinar: jugadores activos por rol y
+    cuántos impostores eliminados pueden adivinar todavía.
+    """
+    activos = {r: [] for r in ROLES}
+    total = 0
+    pueden_adivinar = 0
+    for jugador in jugadores:
+        fuera = jugador.eliminado or jugador.id == eliminado
+        if not fuera:
+            total += 1
+            if jugador.rol is not None:
+                activos[jugador.rol].append(jugador.id)
+        elif jugador.rol == 'impostor' and not jugador.ya_intento_adivinar and jugador.id != intento:
+            pueden_adivinar += 1
+    return activos, total, pueden_adivinar
+
+
+def puntos_finales(activos, total):
+    """Puntos del final de la ronda según quién sigue activo: (puntos, códigos)"""
+    if not activos['infiltrado'] and not activos['impostor']:
+        return {jugador_id: PUNTOS_BUENOS for jugador_id in activos['bueno']}, ('ganan_buenos',)
+    if total == 2:
+        roles = tuple(sorted(r for r in ROLES for _ in activos[r]))
+        if roles not in PUNTOS_1VS1:
+            return {}, ('1vs1',)
+        tabla, _ = PUNTOS_1VS1[roles]
+        puntos = {jugador_id: tabla[r] for r, ids in activos.items() if r in tabla for jugador_id in ids}
+        return puntos, ('1vs1', '1vs1_' + '_'.join(roles))
+    return {}, ()
+
+
+def puntos(foto):
+    """Solo los puntos del final de la ronda tal como está, sin esperar a nadie ni cerrarla"""
+    activos, total, _ = _recuento(foto.jugadores)
+    puntos, codigos = puntos_finales(activos, total)
+    return Resultado(puntos=puntos, codigos=codigos)
+
+
+def _fin_de_ronda(activos, total, pueden_adivinar):
+    """(puntos, termina, códigos) tras una eliminación o un intento fallido"""
+    sin_malos = not activos['infiltrado'] and not activos['impostor']
+    if not (sin_malos or total <= 2):
+        return {}, False, ()
+    # Mientras algún impostor eliminado pueda adivinar, los puntos esperan
+    if pueden_adivinar:
+        return {}, False, ('esperan_adivinacion',) if sin_malos else ('esperan_adivinacion_1vs1',)
+    if total < 2 and not sin_malos:
+        return {}, True, ('uno_solo',)
+    puntos, codigos = puntos_finales(activos, total)
+    return puntos, True, codigos
+
+
+def eliminar(foto, jugador_id):
+    """Elimina a un jugador de la ronda; None si no está o la ronda ya ha terminado"""
+    if foto.ronda_terminada:
+        return None
+    if not any(j.id == jugador_id and not j.eliminado for j in foto.jugadores):
+        return None
+    puntos, termina, codigos = _fin_de_ronda(*_recuento(foto.jugadores, eliminado=jugador_id))
+    return Resultado(eliminado=jugador_id, puntos=puntos, ronda_terminada=termina, codigos=codigos)
+
+
+def fin_de_ronda(foto):
+    """Comprueba si la ronda termina tal como está; None si ya había terminado"""
+    if foto.ronda_terminada:
+        return None
+    puntos, termina, codigos = _fin_de_ronda(*_recuento(foto.jugadores))
+    return Resultado(puntos=puntos, ronda_terminada=termina, codigos=codigos)
+
+
+def adivinar(foto, jugador_id, palabra):
+    """Intento de un impostor eliminado de adivinar la palabra; None si no puede intentarlo"""
+    jugador = next((j for j in foto.jugadores if j.id == jugador_id), None)
+    if jugador is None or jugador.rol != 'impostor' or not jugador.eliminado or jugador.ya_intento_adivinar:
+        return None
+
+    activos, total, otros = _recuento(foto.jugadores, intento=jugador_id)
+    if normalizar_texto(palabra) == normalizar_texto(foto.palabra_impostor or ''):
+        if otros:
+            codigos = ('acierto', 'otros_impostores')
+        else:
+            codigos = ('acierto', 'terminada')
+        return Resultado(intento=jugador_id, correcto=True, puntos={jugador_id: PUNTOS_ACIERTO},
+                         ronda_terminada=not otros, codigos=codigos)
+
+    if otros:
+        return Resultado(intento=jugador_id, correcto=False, codigos=('fallo', 'otros_impostores'))
+    puntos, termina, codigos = _fin_de_ronda(activos, total, 0)
+    return Resultado(intento=jugador_id, correcto=False, puntos=puntos, ronda_terminada=termina,
+                     codigos=('fallo',) + codigos + (('terminada',) if termina else ('continua',)))
+
+
+def mensaje(resultado, palabra_impostor=''):
+    """Texto del resultado para los jugadores"""
+    return ' '.join(MENSAJES[codigo].format(palabra=palabra_impostor) for codigo in resultado.codigos)
+
+
+def aplicar(resultado, destino):
+    """
+    Aplica el resultado a una sala en memoria (estado.SalaEstado) o a una
+    transición de la base de datos (estado.Transicion): las dos tienen
+    jugador_por_id, cambiar_jugador, sumar_puntos y cambiar.
+    """
+    if resultado.eliminado is not None:
+        destino.cambiar_jugador(destino.jugador_por_id(resultado.eliminado), eliminado=True)
+    if resultado.intento is not None:
+        destino.cambiar_jugador(destino.jugador_por_id(resultado.intento), ya_intento_adivinar=True)
+    por_puntos = {}
+    for jugador_id, puntos in resultado.puntos.items():
+        por_puntos.setdefault(puntos, []).append(destino.jugador_por_id(jugador_id))
+    for puntos, jugadores in por_puntos.items():
+        destino.sumar_puntos(jugadores, puntos)
+    if resultado.ronda_terminada:
+        destino.cambiar(ronda_terminada=True)
@@ -0,0 +1,79 @@
+"""
+Historial de las pruebas de rendimiento (blanco/tests_rendimiento.py).
+
+Cada ejecución de la suite con BLANCO_RENDIMIENTO_HISTORIAL definido añade al
+fichero JSON una entrada con la fecha, la base de datos y, por operación, sus
+consultas y sus tiempos. comparar() enfrenta la última entrada con la mediana
+de las anteriores de la misma base de datos: los tiempos de SQLite en memoria
+y los de PostgreSQL no son comparables entre sí.
+"""
+import json
+import os
+import statistics
+from datetime import datetime, timezone
+
+from django.conf import settings
+
+HISTORIAL = getattr(settings, 'BLANCO_RENDIMIENTO_HISTORIAL', None)
+# Ejecuciones medidas de cada operación (más una inicial, que cuenta las consultas)
+REPETICIONES = getattr(settings, 'BLANCO_RENDIMIENTO_REPETICIONES', 20)
+# Por debajo de este tiempo las diferencias son ruido y no se comparan
+MINIMO_MS = 0.5
+
+
+def resumir(tiempos, consultas):
+    """Consultas y tiempos (en ms) de las ejecuciones de una operación"""
+    return {
+        'consultas': consultas,
+        'mediana_ms': statistics.median(tiempos) * 1000,
+        'minimo_ms': min(tiempos) * 1000,
+        'repeticiones': len(tiempos),
+    }
+
+
+def cargar(ruta):
+    if not os.path.exists(ruta):
+        return []
+    with open(ruta, encoding='utf-8') as fichero:
+        return json.load(fichero)
+
+
+def registrar(ruta, base_de_datos, resultados):
+    """Añade una ejecución al historial"""
+    historial = cargar(ruta)
+    historial.append({
+        'fecha': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'base_de_datos': base_de_datos,
+        'resultados': resultados,
+    })
+    with open(ruta, 'w', encoding='utf-8') as fichero:
+        json.dump(historial, fichero, indent=2, ensure_ascii=False, sort_keys=True)
+
+
+def comparar(historial, umbral, referencia=5, medida='minimo_ms'):
+    """
+    Compara la última ejecución con la mediana de las `referencia` anteriores
+    de la misma base de datos. Devuelve [(nombre, antes, ahora, cambio, regresion)]
+    con el cambio en tanto por uno; hay regresión si el tiempo sube más del
+    `umbral` por ciento o si hay más consultas.
+    """
+    if not historial:
+        return []
+    ultima = historial[-1]
+    anteriores = [
+        entrada for entrada in historial[:-1] if entrada['base_de_datos'] == ultima['base_de_datos']
+    ][-referencia:]
+    filas = []
+    for nombre, ahora in sorted(ultima['resultados'].items()):
+        previos = [entrada['resultados'][nombre] for entrada in anteriores if nombre in entrada['resultados']]
+        if not previos:
+            filas.append((nombre, None, ahora, None, False))
+            continue
+        antes = {
+            'consultas': min(p['consultas'] for p in previos),
+            medida: statistics.median(p[medida] for p in previos),
+        }
+        cambio = ahora[medida] / antes[medida] - 1 if antes[medida] else 0
+        mas_lenta = cambio * 100 > umbral and ahora[medida] >= MINIMO_MS
+        filas.append((nombre, antes, ahora, cambio, mas_lenta or ahora['consultas'] > antes['consultas']))
+    return filas
@@ -0,0 +1,253 @@
+"""
+Reparto de salas entre procesos Daphne.
+
+Cada sala pertenece a un único trabajador, elegido con un anillo de hash
+consistente sobre su código. Así el estado en memoria de la sala es la única
+copia viva y sus mensajes de grupo no salen del proceso. Si la conexión llega a
+otro trabajador, se le indica al cliente a qué dirección debe conectarse.
+
+Para retirar un trabajador (drenarlo) se avisa a todos por la capa de canales:
+cada proceso lo quita de su anillo y el propio trabajador vuelca sus salas a la
+base de datos y pide a sus clientes que se conecten al nuevo propietario, que
+carga la sala desde la base de datos en la primera conexión. Un trabajador que
+arranca (o se reinicia) pregunta a los demás qué trabajadores están drenados,
+así que todos montan el mismo anillo aunque no oyeran el aviso.
+
+Una conexión nunca se acepta en un trabajador que no es el dueño de su sala:
+habría dos copias vivas de la sala pisándose los cambios. Si tras MAX_SALTOS
+redirecciones sigue sin llegar al dueño (los anillos aún no coinciden), se le
+pide al cliente que vuelva a empezar pasado REINTENTAR_SALTOS_MS.
+
+Sin BLANCO_TRABAJADORES configurado todo se atiende en el proceso actual.
+"""
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import re
+from urllib.parse import parse_qs
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# {'w1': 'ws://host:8001', 'w2': 'ws://host:8002'} y el identificador de este proceso
+TRABAJADORES = getattr(settings, 'BLANCO_TRABAJADORES', {})
+TRABAJADOR = getattr(settings, 'BLANCO_TRABAJADOR', None)
+REPLICAS = getattr(settings, 'BLANCO_REPLICAS_ANILLO', 100)
+# Redirecciones seguidas tras las que el cliente espera antes de volver a intentarlo
+MAX_SALTOS = 2
+REINTENTAR_SALTOS_MS = getattr(settings, 'BLANCO_REINTENTAR_SALTOS_MS', 1000)
+# Segundos que una vista espera a que el dueño de la sala confirme que ha volcado lo pendiente
+ESPERA_VOLCADO = getattr(settings, 'BLANCO_ESPERA_VOLCADO', 0.5)
+# Cada cuánto renovar la suscripción al grupo de trabajadores (caduca en la capa de canales)
+RENOVAR_SUSCRIPCION = 3600
+
+GRUPO_TRABAJADORES = 'trabajadores'
+RUTA_SALA = re.compile(r'^/?ws/partida/(?P<codigo>[A-Z0-9\-]+)/$')
+
+
+def _hash(texto):
+    return int.from_bytes(hashlib.md5(texto.encode()).digest()[:8], 'big')
+
+
+class AnilloConsistente:
+    """Anillo de hash con varias réplicas por nodo: añadir o quitar uno solo mueve sus salas"""
+
+    def __init__(self, nodos=(), replicas=REPLICAS):
+        self.replicas = replicas
+        self.puntos = []
+        self.nodo_de_punto = {}
+        for nodo in nodos:
+            self.agregar(nodo)
+
+    def agregar(self, nodo):
+        for i in range(self.replicas):
+            punto = _hash(f'{nodo}#{i}')
+            if punto not in self.nodo_de_punto:
+                bisect.insort(self.puntos, punto)
+            self.nodo_de_punto[punto] = nodo
+
+    def quitar(self, nodo):
+        for i in range(self.replicas):
+            punto = _hash(f'{nodo}#{i}')
+            if self.nodo_de_punto.get(punto) == nodo:
+                del self.nodo_de_punto[punto]
+                self.puntos.pop(bisect.bisect_left(self.puntos, punto))
+
+    def nodos(self):
+        return set(self.nodo_de_punto.values())
+
+    def propietario(self, clave):
+        if not self.puntos:
+            return None
+        i = bisect.bisect(self.puntos, _hash(clave)) % len(self.puntos)
+        return self.nodo_de_punto[self.puntos[i]]
+
+
+_anillo = AnilloConsistente(TRABAJADORES)
+_drenados = set()
+_escucha = None
+
+
+def activo():
+    """El reparto solo se aplica cuando este proceso es uno de los trabajadores configurados"""
+    return bool(TRABAJADORES) and TRABAJADOR in TRABAJADORES
+
+
+def propietario(codigo):
+    """Trabajador dueño de la sala (None sin reparto configurado)"""
+    if not activo():
+        return None
+    return _anillo.propietario(codigo)
+
+
+def es_local(codigo):
+    return not activo() or propietario(codigo) in (TRABAJADOR, None)
+
+
+def url_websocket(codigo, saltos=0):
+    """Dirección WebSocket del dueño de la sala ('' si se atiende en cualquier proceso)"""
+    destino = propietario(codigo)
+    if destino is None:
+        return ''
+    url = f"{TRABAJADORES[destino].rstrip('/')}/ws/partida/{codigo}/"
+    if saltos:
+        url += f'?salto={saltos}'
+    return url
+
+
+def marcar_drenado(nodo):
+    if nodo in TRABAJADORES and nodo not in _drenados:
+        _drenados.add(nodo)
+        _anillo.quitar(nodo)
+
+
+def marcar_activo(nodo):
+    if nodo in _drenados:
+        _drenados.discard(nodo)
+        _anillo.agregar(nodo)
+
+
+async def traspasar_salas():
+    """Vuelca las salas de este proceso y manda a sus clientes con el nuevo propietario"""
+    from . import estado
+
+    channel_layer = get_channel_layer()
+    for sala in estado.salas_activas():
+        if es_local(sala.codigo):
+            continue
+        await estado.guardar_sala(sala)
+        await channel_layer.group_send(
+            f'partida_{sala.codigo}',
+            {'type': 'sala_trasladada', 'url': url_websocket(sala.codigo)}
+        )
+
+
+async def volcar_sala(codigo):
+    """
+    Escribe lo que la sala tenga pendiente en memoria antes de que una vista lea
+    la partida de la base de datos. Si la sala es de otro trabajador se le pide
+    por la capa de canales y se espera su respuesta como mucho ESPERA_VOLCADO
+    segundos; devuelve False si no ha respondido nadie.
+    """
+    from . import estado
+
+    sala = estado.sala_cargada(codigo)
+    if sala is not None:
+        return await estado.guardar_sala(sala)
+    if es_local(codigo):
+        # Sin la sala en este proceso no hay nada pendiente en ningún otro
+        return True
+    channel_layer = get_channel_layer()
+    canal = await channel_layer.new_channel()
+    await channel_layer.group_send(f'partida_{codigo}', {'type': 'sala_volcar', 'respuesta': canal})
+    try:
+        await asyncio.wait_for(channel_layer.receive(canal), ESPERA_VOLCADO)
+    except asyncio.TimeoutError:
+        return False
+    return True
+
+
+async def _escuchar_trabajadores():
+    """Atiende los avisos de drenado y reactivación que llegan por la capa de canales"""
+    channel_layer = get_channel_layer()
+    canal = await channel_layer.new_channel()
+    await channel_layer.group_add(GRUPO_TRABAJADORES, canal)
+    # Los drenados anunciados antes de arrancar este proceso: los demás responden con los suyos
+    await channel_layer.group_send(GRUPO_TRABAJADORES, {'type': 'trabajador.consultar', 'respuesta': canal})
+    while True:
+        await channel_layer.group_add(GRUPO_TRABAJADORES, canal)
+        try:
+            mensaje = await asyncio.wait_for(channel_layer.receive(canal), RENOVAR_SUSCRIPCION)
+        except asyncio.TimeoutError:
+            continue
+        nodo = mensaje.get('trabajador')
+        if mensaje.get('type') == 'trabajador.drenar':
+            marcar_drenado(nodo)
+        elif mensaje.get('type') == 'trabajador.activar':
+            marcar_activo(nodo)
+        elif mensaje.get('type') == 'trabajador.consultar':
+            if mensaje.get('respuesta') != canal:
+                await channel_layer.send(mensaje['respuesta'], {
+                    'type': 'trabajador.drenados', 'drenados': sorted(_drenados),
+                })
+            continue
+        elif mensaje.get('type') == 'trabajador.drenados':
+            nuevos = set(mensaje.get('drenados', ())) - _drenados
+            if not nuevos:
+                continue
+            for drenado in nuevos:
+                marcar_drenado(drenado)
+        else:
+            continue
+        if nodo == TRABAJADOR:
+            logger.info('Cambio de estado del trabajador %s: %s', nodo, mensaje['type'])
+        # Con el anillo cambiado, las salas que ya no son de este proceso pasan a su nuevo dueño
+        await traspasar_salas()
+
+
+def asegurar_escucha():
+    """Arranca la escucha de los avisos entre trabajadores (ver arranque.py) si no está corriendo"""
+    global _escucha
+    if _escucha is None or _escucha.done():
+        _escucha = asyncio.ensure_future(_escuchar_trabajadores())
+
+
+class EnrutamientoSalas:
+    """Middleware ASGI: las conexiones a una sala de otro trabajador se redirigen a su dueño"""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'websocket' or not activo():
+            return await self.inner(scope, receive, send)
+
+        coincidencia = RUTA_SALA.match(scope['path'])
+        if coincidencia:
+            codigo = coincidencia['codigo']
+            consulta = parse_qs(scope.get('query_string', b'').decode())
+            try:
+                saltos = int(consulta.get('salto', ['0'])[0])
+            except ValueError:
+                saltos = 0
+            if not es_local(codigo):
+                if saltos < MAX_SALTOS:
+                    return await self.redirigir(receive, send, url_websocket(codigo, saltos + 1))
+                # Los trabajadores no se ponen de acuerdo en el dueño: mejor esperar que tener dos copias
+                logger.warning('La sala %s no llega a su dueño tras %d redirecciones', codigo, saltos)
+                return await self.redirigir(receive, send, url_websocket(codigo), REINTENTAR_SALTOS_MS)
+        return await self.inner(scope, receive, send)
+
+    async def redirigir(self, receive, send, url, reintentar=None):
+        # El navegador no sigue redirecciones en el handshake: se acepta y se le indica el destino
+        mensaje = {'type': 'redirigir', 'url': url}
+        if reintentar:
+            mensaje['reintentar'] = reintentar
+        await receive()
+        await send({'type': 'websocket.accept'})
+        await send({'type': 'websocket.send', 'text': json.dumps(mensaje)})
+        await send({'type': 'websocket.close', 'code': 4000})
@@ -0,0 +1,57 @@
+"""
+Reparto de roles según el número de jugadores de la sala.
+
+Con n jugadores hay (n - 1) // 2 malos, la mitad (redondeando hacia abajo)
+impostores y el resto infiltrados; los demás son buenos. Es la tabla que se
+usaba de 4 a 9 jugadores y sigue igual hasta MAX_JUGADORES
+(BLANCO_MAX_JUGADORES, 30). BLANCO_REPARTOS sustituye la fórmula para los
+tamaños que se quieran ajustar, p. ej. tras mirar `manage.py simular_reglas`:
+
+    BLANCO_REPARTOS = {12: (7, 3, 2)}  # buenos, infiltrados, impostores
+
+Cada tamaño se calcula una vez; repartir() copia la lista de roles y la
+baraja una sola vez.
+"""
+import functools
+import random
+
+from django.conf import settings
+
+from .reglas import ROLES
+
+MIN_JUGADORES = 4
+MAX_JUGADORES = getattr(settings, 'BLANCO_MAX_JUGADORES', 30)
+# n -> (buenos, infiltrados, impostores)
+REPARTOS = getattr(settings, 'BLANCO_REPARTOS', {})
+
+
+def formula(n):
+    malos = (n - 1) // 2
+    impostores = malos // 2
+    return n - malos, malos - impostores, impostores
+
+
+@functools.lru_cache(maxsize=None)
+def reparto(n):
+    """(buenos, infiltrados, impostores) de una sala de n jugadores; None si no se admite"""
+    if not MIN_JUGADORES <= n <= MAX_JUGADORES:
+        return None
+    return tuple(REPARTOS.get(n) or formula(n))
+
+
+@functools.lru_cache(maxsize=None)
+def _roles(n):
+    cuantos = reparto(n)
+    if cuantos is None:
+        return None
+    return tuple(rol for rol, veces in zip(ROLES, cuantos) for _ in range(veces))
+
+
+def repartir(n, azar=random):
+    """Roles barajados de una sala de n jugadores, en el orden de los jugadores; None si no se admite"""
+    roles = _roles(n)
+    if roles is None:
+        return None
+    roles = list(roles)
+    azar.shuffle(roles)
+    return roles
@@ -0,0 +1,187 @@
+"""
+Simulación de rondas con las reglas de reglas.py, sin base de datos.
+
+Juega rondas al azar para cada reparto de roles (buenos, infiltrados e
+impostores, con al menos un bueno y un malo) de cada tamaño de sala: el host
+elimina a un jugador activo cualquiera y cada impostor eliminado intenta
+adivinar la palabra en cuanto lo eliminan, y acierta con probabilidad
+`acierto`. Las rondas se reparten en lotes entre procesos
+(ProcessPoolExecutor); cada lote devuelve sus cuentas y simular() las junta:
+
+- puntos que gana cada jugador en la ronda, por rol (histograma),
+- eliminaciones hasta que la ronda termina (histograma),
+- cómo termina (códigos del último Resultado),
+- atascos: rondas en las que ya no se puede hacer nada y ninguna regla las
+  termina, con algunos ejemplos.
+
+La usa `manage.py simular_reglas` para comprobar el equilibrio de los
+repartos (roles.py) y de PUNTOS_1VS1 antes de cambiarlos.
+"""
+import os
+import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from . import reglas
+from .roles import reparto as reparto_del_juego
+
+# Rondas de cada tarea enviada a un proceso
+LOTE = 10000
+# Ejemplos de atascos que se guardan por lote
+EJEMPLOS = 3
+
+
+class Mesa:
+    """Ronda de la simulación: lo que reglas.aplicar() necesita para aplicar un Resultado"""
+
+    def __init__(self, roles, palabra):
+        self.palabra = palabra
+        self.ronda_terminada = False
+        self.jugadores = {i: reglas.Jugador(i, rol, False, False) for i, rol in enumerate(roles)}
+        self.puntos = dict.fromkeys(self.jugadores, 0)
+
+    def foto(self):
+        return reglas.Foto(self.palabra, self.ronda_terminada, tuple(self.jugadores.values()))
+
+    def jugador_por_id(self, jugador_id):
+        return self.jugadores[jugador_id]
+
+    def cambiar_jugador(self, jugador, **campos):
+        self.jugadores[jugador.id] = jugador._replace(**campos)
+
+    def sumar_puntos(self, jugadores, puntos):
+        for jugador in jugadores:
+            self.puntos[jugador.id] += puntos
+
+    def cambiar(self, ronda_terminada):
+        self.ronda_terminada = ronda_terminada
+
+
+def repartos(n):
+    """Todos los repartos (buenos, infiltrados, impostores) de n jugadores con al menos un bueno y un malo"""
+    return [
+        (n - infiltrados - impostores, infiltrados, impostores)
+        for infiltrados in range(n)
+        for impostores in range(n - infiltrados)
+        if 0 < infiltrados + impostores < n
+    ]
+
+
+def jugar_ronda(roles, azar, acierto):
+    """Juega una ronda; devuelve (mesa, eliminaciones, último Resultado) o (mesa, eliminaciones, None) si se atasca"""
+    mesa = Mesa(roles, 'palabra')
+    eliminaciones = 0
+    # Cada acción elimina a alguien o gasta un intento: más que esto solo puede ser un bucle
+    for _ in range(2 * len(roles) + 1):
+        foto = mesa.foto()
+        por_adivinar = [j.id for j in foto.jugadores
+                        if j.eliminado and j.rol == 'impostor' and not j.ya_intento_adivinar]
+        if por_adivinar:
+            palabra = mesa.palabra if azar.random() < acierto else 'otra'
+            resultado = reglas.adivinar(foto, por_adivinar[0], palabra)
+        else:
+            activos = [j.id for j in foto.jugadores if not j.eliminado]
+            if len(activos) < 2:
+                return mesa, eliminaciones, None
+            resultado = reglas.eliminar(foto, azar.choice(activos))
+            eliminaciones += 1
+        if resultado is None:
+            return mesa, eliminaciones, None
+        reglas.aplicar(resultado, mesa)
+        if resultado.ronda_terminada:
+            return mesa, eliminaciones, resultado
+    return mesa, eliminaciones, None
+
+
+def simular_lote(reparto, rondas, semilla, acierto):
+    """Juega `rondas` rondas de un reparto; devuelve sus cuentas (se ejecuta en otro proceso)"""
+    azar = random.Random(semilla)
+    buenos, infiltrados, impostores = reparto
+    roles = ['bueno'] * buenos + ['infiltrado'] * infiltrados + ['impostor'] * impostores
+    puntos = {rol: Counter() for rol in reglas.ROLES}
+    longitud = Counter()
+    finales = Counter()
+    atascos = 0
+    ejemplos = []
+    for _ in range(rondas):
+        azar.shuffle(roles)
+        mesa, eliminaciones, resultado = jugar_ronda(roles, azar, acierto)
+        if resultado is None:
+            atascos += 1
+            if len(ejemplos) < EJEMPLOS:
+                ejemplos.append([tuple(j) for j in mesa.jugadores.values()])
+            continue
+        longitud[eliminaciones] += 1
+        finales['+'.join(resultado.codigos)] += 1
+        for jugador_id, ganados in mesa.puntos.items():
+            puntos[mesa.jugadores[jugador_id].rol][ganados] += 1
+    return {
+        'reparto': reparto,
+        'rondas': rondas,
+        'puntos': puntos,
+        'longitud': longitud,
+        'finales': finales,
+        'atascos': atascos,
+        'ejemplos': ejemplos,
+    }
+
+
+def media(histograma):
+    total = sum(histograma.values())
+    return sum(valor * veces for valor, veces in histograma.items()) / total if total else None
+
+
+def percentil(histograma, p):
+    total = sum(histograma.values())
+    acumulado = 0
+    for valor in sorted(histograma):
+        acumulado += histograma[valor]
+        if acumulado * 100 >= total * p:
+            return valor
+    return None
+
+
+def resumir(cuentas):
+    """Junta las cuentas de varios lotes"""
+    total = {
+        'rondas': 0, 'puntos': {rol: Counter() for rol in reglas.ROLES}, 'longitud': Counter(),
+        'finales': Counter(), 'atascos': 0, 'ejemplos': [],
+    }
+    for lote in cuentas:
+        total['rondas'] += lote['rondas']
+        for rol, histograma in lote['puntos'].items():
+            total['puntos'][rol].update(histograma)
+        total['longitud'].update(lote['longitud'])
+        total['finales'].update(lote['finales'])
+        total['atascos'] += lote['atascos']
+        total['ejemplos'].extend(lote['ejemplos'][:EJEMPLOS - len(total['ejemplos'])])
+    return total
+
+
+def simular(min_jugadores=4, max_jugadores=9, rondas=10000, acierto=0.25, procesos=None, semilla=None,
+            solo_juego=False):
+    """
+    Juega `rondas` rondas de cada reparto de cada tamaño de sala (con
+    solo_juego, solo el que usa el juego). Devuelve (total, por_reparto) con
+    las cuentas de resumir(); por_reparto va por (buenos, infiltrados,
+    impostores). procesos=1 lo hace todo en este proceso.
+    """
+    azar = random.Random(semilla)
+    tareas = []
+    for n in range(min_jugadores, max_jugadores + 1):
+        del_tamano = [reparto_del_juego(n)] if solo_juego else repartos(n)
+        for reparto in filter(None, del_tamano):
+            for inicio in range(0, rondas, LOTE):
+                tareas.append((reparto, min(LOTE, rondas - inicio), azar.getrandbits(64), acierto))
+
+    procesos = procesos or os.cpu_count() or 1
+    if procesos == 1:
+        cuentas = [simular_lote(*tarea) for tarea in tareas]
+    else:
+        with ProcessPoolExecutor(max_workers=procesos) as pool:
+            cuentas = list(pool.map(simular_lote, *zip(*tareas)))
+
+    por_reparto = {}
+    for lote in cuentas:
+        por_reparto.setdefault(lote['reparto'], []).append(lote)
+    return resumir(cuentas), {reparto: resumir(lotes) for reparto, lotes in por_reparto.items()}
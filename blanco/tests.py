@@ -1,3 +1,1650 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import random
+import tempfile
+import threading
+import zlib
+from array import array
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from partygames.capa_red import CapaRed, ConexionResp, codificar_comando
+from partygames.servidor_capa import ServidorCapa
+
+from . import (
+    arranque, carga, difusion, ejecutores, estado, fragmentos, limites, limpieza, metricas, presencia, protocolo,
+    reglas, rendimiento, reparto, roles, simulacion,
+)
+from .estado import JugadorEstado, SalaEstado, Transicion
+from .models import GameSession, GamePlayer, PalabraPar
+from .routing import websocket_urlpatterns
+from .palabras import muestreador, tabla_alias
+from .views import asignar_roles_y_palabras, calcular_puntos_ronda, elegir_palabras
+
+
+def crear_partida(n, codigo='TEST'):
+    """Partida en espera con n jugadores"""
+    usuarios = [User.objects.create_user(f'{codigo}_jugador{i}') for i in range(n)]
+    partida = GameSession.objects.create(codigo=codigo, host=usuarios[0])
+    GamePlayer.objects.bulk_create([GamePlayer(session=partida, user=usuario) for usuario in usuarios])
+    return partida
+
+
+class TransicionRondaTests(TestCase):
+    """Las transiciones de ronda escriben a todos los jugadores con un número fijo de consultas"""
+
+    # SELECT de jugadores, SAVEPOINT, UPDATE de la partida, UPDATE ... CASE de jugadores y RELEASE
+    CONSULTAS_INICIO_RONDA = 5
+
+    def test_asignar_roles_consultas_constantes(self):
+        for n in range(4, 10):
+            with self.subTest(jugadores=n):
+                partida = crear_partida(n, codigo=f'P{n}')
+                with self.assertNumQueries(self.CONSULTAS_INICIO_RONDA):
+                    transicion = Transicion(partida)
+                    ok, _ = asignar_roles_y_palabras(transicion, 'Gato', 'Perro')
+                    transicion.cambiar(estado='en_juego', palabra_impostor='Gato', palabra_buena_actual='Gato',
+                                       palabra_infiltrado_actual='Perro', ronda_terminada=False, ronda_actual=1)
+                    transicion.guardar()
+                self.assertTrue(ok)
+
+                jugadores = GamePlayer.objects.filter(session=partida)
+                self.assertEqual(GameSession.objects.get(id=partida.id).estado, 'en_juego')
+                self.assertEqual(jugadores.filter(es_bueno=True, palabra_secreta='Gato').count()
+                                 + jugadores.filter(es_infiltrado=True, palabra_secreta='Perro').count()
+                                 + jugadores.filter(es_impostor=True).count(), n)
+
+    def test_solo_se_escriben_los_campos_cambiados(self):
+        partida = crear_partida(4)
+        transicion = Transicion(partida)
+        jugador = transicion.jugadores()[0]
+        transicion.cambiar_jugador(jugador, eliminado=True, puntos=jugador.puntos)
+        self.assertEqual(transicion.campos_jugadores, {'eliminado'})
+        # Una sola sentencia no necesita transacción: ni SAVEPOINT ni RELEASE
+        with self.assertNumQueries(1):
+            transicion.guardar()
+        self.assertTrue(GamePlayer.objects.get(id=jugador.id).eliminado)
+
+    def test_puntos_1vs1_en_una_escritura(self):
+        partida = crear_partida(4)
+        jugadores = list(partida.players.order_by('id'))
+        GamePlayer.objects.filter(id__in=[j.id for j in jugadores[:2]]).update(eliminado=True)
+        GamePlayer.objects.filter(id=jugadores[2].id).update(es_impostor=True)
+        GamePlayer.objects.filter(id=jugadores[3].id).update(es_infiltrado=True)
+
+        # SELECT de jugadores y el UPDATE de los puntos
+        with self.assertNumQueries(2):
+            transicion = Transicion(partida)
+            calcular_puntos_ronda(transicion)
+            transicion.guardar()
+        self.assertEqual(GamePlayer.objects.get(id=jugadores[2].id).puntos, 3)
+        self.assertEqual(GamePlayer.objects.get(id=jugadores[3].id).puntos, 2)
+
+    # Sin ejecutores propios: sus hilos no verían la transacción de la prueba
+    @override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+    def test_volcado_de_sala_en_memoria_consultas_constantes(self):
+        for n in range(4, 10):
+            with self.subTest(jugadores=n):
+                partida = crear_partida(n, codigo=f'M{n}')
+                sala = SalaEstado.desde_modelo(partida)
+                self.assertTrue(sala.iniciar_partida('Gato', 'Perro'))
+                # SAVEPOINT, UPDATE de la partida, UPDATE ... CASE de jugadores y RELEASE
+                with self.assertNumQueries(4):
+                    async_to_sync(estado.guardar_sala)(sala)
+                self.assertEqual(GamePlayer.objects.filter(session=partida).exclude(palabra_secreta=None).count(), n)
+
+    @override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+    def test_expulsion_en_el_mismo_volcado(self):
+        partida = crear_partida(5)
+        sala = SalaEstado.desde_modelo(partida)
+        primero, segundo = list(sala.jugadores)[:2]
+        sala.cambiar_jugador(sala.jugadores[primero], eliminado=True)
+        self.assertTrue(sala.expulsar_jugador(segundo))
+        self.assertFalse(sala.expulsar_jugador(segundo))
+        # SAVEPOINT, UPDATE ... CASE del eliminado, DELETE del expulsado y RELEASE
+        with self.assertNumQueries(4):
+            async_to_sync(estado.guardar_sala)(sala)
+        self.assertTrue(GamePlayer.objects.get(id=primero).eliminado)
+        self.assertFalse(GamePlayer.objects.filter(id=segundo).exists())
+
+    @override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+    def test_volcado_fallido_conserva_los_pendientes(self):
+        partida = crear_partida(4)
+        sala = SalaEstado.desde_modelo(partida)
+        jugador = next(iter(sala.jugadores.values()))
+        sala.cambiar(ronda_actual=3)
+        sala.cambiar_jugador(jugador, eliminado=True)
+        sala.sumar_puntos([jugador], 2)
+
+        async def probar():
+            with mock.patch('blanco.estado.escribir_transicion', side_effect=DatabaseError), \
+                    self.assertLogs('blanco.estado', 'ERROR'):
+                self.assertFalse(await estado.guardar_sala(sala))
+            # Sigue pendiente y hay un reintento programado
+            self.assertEqual(sala.pendientes_sala, {'ronda_actual'})
+            self.assertEqual(sala.pendientes_jugadores, {jugador.id: {'eliminado'}})
+            self.assertEqual(sala.pendientes_puntos, {jugador.id: 2})
+            self.assertIsNotNone(sala.guardado_programado)
+            sala.guardado_programado.cancel()
+            self.assertTrue(await estado.guardar_sala(sala))
+
+        async_to_sync(probar)()
+        self.assertEqual(GameSession.objects.get(id=partida.id).ronda_actual, 3)
+        guardado = GamePlayer.objects.get(id=jugador.id)
+        self.assertEqual((guardado.eliminado, guardado.puntos), (True, 2))
+
+    @override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+    def test_la_recarga_no_pisa_lo_escrito_por_una_vista(self):
+        partida = crear_partida(4)
+        sala = async_to_sync(estado.obtener_sala)(partida.codigo)
+        jugador = next(iter(sala.jugadores.values()))
+        # Cambios de la sala en memoria aún sin volcar
+        sala.cambiar(ronda_actual=5, ronda_terminada=True)
+        sala.cambiar_jugador(jugador, eliminado=True, palabra_secreta='Gato')
+
+        # Una vista escribe algunos de esos campos y después invalida la sala
+        transicion = Transicion(GameSession.objects.get(id=partida.id))
+        transicion.cambiar(ronda_actual=2)
+        transicion.cambiar_jugador(transicion.jugador_por_id(jugador.id), palabra_secreta='Perro')
+        transicion.guardar()
+        estado.invalidar_sala(partida.codigo, escritos=transicion.escritos())
+
+        recargada = async_to_sync(estado.obtener_sala)(partida.codigo)
+        estado.descartar_sala(partida.codigo)
+        guardada = GameSession.objects.get(id=partida.id)
+        self.assertEqual((guardada.ronda_actual, guardada.ronda_terminada), (2, True))
+        guardado = GamePlayer.objects.get(id=jugador.id)
+        self.assertEqual((guardado.palabra_secreta, guardado.eliminado), ('Perro', True))
+        self.assertEqual((recargada.ronda_actual, recargada.ronda_terminada), (2, True))
+
+    @override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+    def test_la_recarga_espera_al_volcado_en_curso(self):
+        partida = crear_partida(4)
+        escrituras = []
+
+        def escritura_lenta(funcion):
+            # Como un hilo de escritura ocupado: la transacción tarda en confirmarse
+            async def llamada(*args):
+                escrituras.append(args)
+                await asyncio.sleep(0.05)
+                return await sync_to_async(funcion)(*args)
+            return llamada
+
+        async def probar():
+            sala = await estado.obtener_sala(partida.codigo)
+            jugador = next(iter(sala.jugadores.values()))
+            sala.cambiar_jugador(jugador, eliminado=True)
+            volcado = asyncio.ensure_future(estado.guardar_sala(sala))
+            while not escrituras:
+                await asyncio.sleep(0)
+            # Una vista invalida la sala mientras el volcado aún no ha terminado
+            estado.invalidar_sala(partida.codigo)
+            recargada = await estado.obtener_sala(partida.codigo)
+            self.assertTrue(volcado.done())
+            estado.descartar_sala(partida.codigo)
+            return recargada, jugador.id
+
+        with mock.patch.object(estado, 'de_escritura', escritura_lenta):
+            recargada, jugador_id = async_to_sync(probar)()
+        # La recarga ve la eliminación y no publica un delta que la deshaga
+        self.assertTrue(recargada.jugadores[jugador_id].eliminado)
+        self.assertNotIn(jugador_id, recargada.delta_jugadores)
+        self.assertEqual(len(escrituras), 1)
+
+
+# La base de datos de pruebas (SQLite en memoria compartida) bloquea tablas enteras entre conexiones:
+# las cargas y los volcados de salas distintas no pueden ir en hilos a la vez
+@override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+class ConcurrenciaRondaTests(TransactionTestCase):
+    """Adivinaciones y eliminaciones simultáneas dejan puntos coherentes"""
+
+    SALAS = 5
+
+    def preparar_sala(self, codigo):
+        """Tres buenos, un impostor eliminado que aún puede adivinar y un infiltrado activo"""
+        partida = crear_partida(5, codigo=codigo)
+        partida.estado = 'en_juego'
+        partida.palabra_impostor = 'Gato'
+        partida.save()
+        jugadores = list(partida.players.select_related('user').order_by('id'))
+        GamePlayer.objects.filter(id__in=[j.id for j in jugadores[:3]]).update(es_bueno=True, palabra_secreta='Gato')
+        GamePlayer.objects.filter(id=jugadores[3].id).update(es_impostor=True, eliminado=True)
+        GamePlayer.objects.filter(id=jugadores[4].id).update(es_infiltrado=True, palabra_secreta='Perro')
+        return partida, jugadores
+
+    def test_adivinar_y_eliminar_a_la_vez(self):
+        salas = [self.preparar_sala(f'C{i}') for i in range(self.SALAS)]
+        aplicacion = URLRouter(websocket_urlpatterns)
+
+        async def jugar(partida, jugadores):
+            host = WebsocketCommunicator(aplicacion, f'/ws/partida/{partida.codigo}/')
+            host.scope['user'] = jugadores[0].user
+            impostor = WebsocketCommunicator(aplicacion, f'/ws/partida/{partida.codigo}/')
+            impostor.scope['user'] = jugadores[3].user
+            for comunicador in (host, impostor):
+                conectado, _ = await comunicador.connect()
+                self.assertTrue(conectado)
+
+            # El host elimina al infiltrado mientras el impostor adivina (dos veces)
+            await asyncio.gather(
+                impostor.send_json_to({'type': 'adivinar_palabra', 'palabra_adivinada': 'gato'}),
+                host.send_json_to({'type': 'eliminar_jugador', 'jugador_id': jugadores[4].id}),
+                impostor.send_json_to({'type': 'adivinar_palabra', 'palabra_adivinada': 'gato'}),
+                host.send_json_to({'type': 'eliminar_jugador', 'jugador_id': jugadores[4].id}),
+            )
+            await asyncio.sleep(0.3)
+            sala = estado.sala_en_memoria(partida.codigo)
+            puntos = {j.id: j.puntos for j in sala.jugadores.values()}
+            for comunicador in (host, impostor):
+                await comunicador.disconnect()
+            return puntos
+
+        async def jugar_todas():
+            return await asyncio.gather(*(jugar(partida, jugadores) for partida, jugadores in salas))
+
+        en_memoria = async_to_sync(jugar_todas)()
+
+        for (partida, jugadores), puntos in zip(salas, en_memoria):
+            with self.subTest(sala=partida.codigo):
+                self.assertTrue(GameSession.objects.get(id=partida.id).ronda_terminada)
+                en_base = dict(GamePlayer.objects.filter(session=partida).values_list('id', 'puntos'))
+                self.assertEqual(en_base, puntos)
+                # Solo puntúa el impostor, una vez: los buenos no ganan porque el impostor acertó
+                self.assertEqual(en_base, {j.id: 3 if j == jugadores[3] else 0 for j in jugadores})
+
+
+class CargaTests(TransactionTestCase):
+    """La simulación de carga juega partidas completas y mide lo que debe"""
+
+    # Con la sala en memoria y las escrituras agrupadas, la media queda por debajo de esto
+    CONSULTAS_POR_ACCION = 4
+
+    def test_simulacion_de_varias_salas(self):
+        resumen = async_to_sync(carga.simular)(salas=3, rondas=2, pausa=0, semilla=1)
+
+        self.assertEqual(resumen['sin_respuesta'], 0)
+        self.assertTrue(4 * 3 <= resumen['jugadores'] <= 9 * 3)
+        self.assertEqual(resumen['acciones_por_tipo']['iniciar_partida'], 3)
+        self.assertEqual(resumen['acciones_por_tipo']['nueva_ronda'], 3)
+        self.assertEqual(resumen['acciones_por_tipo']['terminar_partida'], 3)
+        self.assertGreater(resumen['acciones_por_tipo']['eliminar_jugador'], 0)
+        self.assertLessEqual(resumen['latencia_p50_ms'], resumen['latencia_p99_ms'])
+        self.assertGreater(resumen['mensajes_por_segundo'], 0)
+        self.assertGreater(resumen['memoria_sala_kb'], 0)
+        self.assertLess(resumen['consultas_por_accion'], self.CONSULTAS_POR_ACCION)
+        # Las partidas y usuarios de la simulación no se quedan en la base de datos
+        self.assertFalse(GameSession.objects.exists())
+        self.assertFalse(User.objects.exists())
+
+    def test_prueba_carga(self):
+        opciones = {'salas': 1, 'min_jugadores': 4, 'max_jugadores': 4, 'rondas': 1, 'pausa': 0, 'semilla': 1}
+        salida = StringIO()
+        call_command('prueba_carga', json=True, stdout=salida, **opciones)
+        resumen = json.loads(salida.getvalue())
+        self.assertEqual((resumen['salas'], resumen['jugadores'], resumen['sin_respuesta']), (1, 4, 0))
+
+        salida = StringIO()
+        call_command('prueba_carga', stdout=salida, **opciones)
+        texto = salida.getvalue()
+        self.assertTrue(texto.startswith('1 salas, 4 jugadores, '))
+        self.assertIn('Latencia acción → difusión: p50 ', texto)
+        self.assertNotIn('sin difusión', texto)
+        self.assertFalse(GameSession.objects.exists())
+
+    def test_percentil(self):
+        valores = list(range(1, 101))
+        self.assertEqual(carga.percentil(valores, 50), 50)
+        self.assertEqual(carga.percentil(valores, 99), 99)
+        self.assertEqual(carga.percentil([7], 99), 7)
+        self.assertIsNone(carga.percentil([], 50))
+
+
+@override_settings(BLANCO_HILOS_LECTURA=1, BLANCO_HILOS_ESCRITURA=1)
+class EjecutoresTests(TransactionTestCase):
+    """Lecturas y escrituras no se esperan entre sí y lo no urgente cede el paso"""
+
+    def test_escrituras_libres_con_lecturas_saturadas(self):
+        soltar = threading.Event()
+
+        async def probar():
+            bloqueada = asyncio.ensure_future(ejecutores.de_lectura(soltar.wait)(5))
+            await asyncio.sleep(0.05)
+            self.assertTrue(ejecutores.LECTURA.saturado())
+            hilo = await ejecutores.de_escritura(lambda: threading.current_thread().name)()
+            self.assertTrue(hilo.startswith('blanco-escritura'))
+            self.assertFalse(await ejecutores.LECTURA.hueco(0.05))
+            soltar.set()
+            await bloqueada
+            self.assertTrue(await ejecutores.LECTURA.hueco(0.05))
+
+        async_to_sync(probar)()
+
+    def test_refresh_request_con_lecturas_saturadas(self):
+        partida = crear_partida(4)
+        soltar = threading.Event()
+
+        async def recibir(comunicador, espera=1):
+            """El siguiente mensaje que no sea de presencia (que llega cuando le toca)"""
+            while True:
+                mensaje = await comunicador.receive_json_from(timeout=espera)
+                if mensaje['type'] != 'presencia':
+                    return mensaje
+
+        async def probar():
+            comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/partida/{partida.codigo}/')
+            comunicador.scope['user'] = partida.host
+            conectado, _ = await comunicador.connect()
+            self.assertTrue(conectado)
+            await recibir(comunicador)
+
+            bloqueada = asyncio.ensure_future(ejecutores.de_lectura(soltar.wait)(5))
+            await asyncio.sleep(0.05)
+            # Aplazado hasta ESPERA_APLAZABLE y después rechazado: el cliente lo repetirá más tarde
+            await comunicador.send_json_to({'type': 'refresh_request', 'version': 0})
+            respuesta = await recibir(comunicador, ejecutores.ESPERA_APLAZABLE + 1)
+            self.assertEqual(respuesta, {'type': 'ocupado', 'reintentar': ejecutores.REINTENTAR_MS})
+
+            soltar.set()
+            await bloqueada
+            await comunicador.send_json_to({'type': 'refresh_request', 'version': 0})
+            respuesta = await recibir(comunicador)
+            self.assertEqual(respuesta['type'], 'partida_updated')
+            self.assertIn('fragmentos', respuesta)
+            await comunicador.disconnect()
+
+        async_to_sync(probar)()
+
+
+class LimitesTests(TransactionTestCase):
+    """Los mensajes de más se descartan y los refresh_request repetidos se funden"""
+
+    def test_cubo_por_conexion_y_por_sala(self):
+        por_segundo, rafaga = limites.limites('latido')['conexion']
+        conexion = {}
+        admitidos = sum(limites.admitir('latido', conexion) for _ in range(rafaga + 3))
+        self.assertEqual(admitidos, rafaga)
+        self.assertGreater(limites.reintentar_ms('latido', conexion), 0)
+
+        # El cubo de la sala lo comparten todas sus conexiones
+        por_segundo, rafaga = limites.limites('refresh_request')['sala']
+        sala = {}
+        admitidos = sum(limites.admitir('refresh_request', {}, sala) for _ in range(rafaga + 3))
+        self.assertEqual(admitidos, rafaga)
+
+    def test_refresh_request_en_bucle(self):
+        partida = crear_partida(4)
+        enviados = 20
+        antes = limites.estadisticas()
+
+        async def probar():
+            comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), f'/ws/partida/{partida.codigo}/')
+            comunicador.scope['user'] = partida.host
+            conectado, _ = await comunicador.connect()
+            self.assertTrue(conectado)
+            for _ in range(enviados):
+                await comunicador.send_json_to({'type': 'refresh_request', 'version': 0})
+            recibidos = []
+            while not await comunicador.receive_nothing(timeout=0.3):
+                mensaje = await comunicador.receive_json_from()
+                recibidos.extend(mensaje['mensajes'] if mensaje['type'] == 'lote' else [mensaje])
+            await comunicador.disconnect()
+            return recibidos
+
+        tipos = [mensaje['type'] for mensaje in async_to_sync(probar)()]
+        despues = limites.estadisticas()
+        colapsados = despues['colapsados'].get('refresh_request', 0) - antes['colapsados'].get('refresh_request', 0)
+        descartados = sum(despues['descartados'].values()) - sum(antes['descartados'].values())
+        # El primer snapshot es el de la conexión; de los pedidos, como mucho la ráfaga de la conexión
+        snapshots = tipos.count('partida_updated') - 1
+        self.assertLessEqual(snapshots, limites.limites('refresh_request')['conexion'][1])
+        self.assertEqual(tipos.count('ocupado'), descartados)
+        self.assertEqual(snapshots + colapsados + descartados, enviados)
+        self.assertGreater(colapsados + descartados, 0)
+
+
+class DifusionTests(TransactionTestCase):
+    """Los cambios de cada sala salen en un solo delta por vaciado, también los que escriben las vistas"""
+
+    async def escuchar(self, codigo, user_id):
+        """Canal unido al grupo de la sala y registrado en ella, como el de un consumer"""
+        capa = get_channel_layer()
+        canal = await capa.new_channel()
+        await capa.group_add(f'partida_{codigo}', canal)
+        sala = await estado.conectar(codigo, user_id, canal)
+        return capa, canal, sala
+
+    def test_varios_cambios_un_solo_delta(self):
+        partida = crear_partida(4, 'DIFU')
+
+        async def probar():
+            capa, canal, sala = await self.escuchar('DIFU', partida.host_id)
+            antes = difusion.estadisticas()['deltas_publicados']
+            sala.cambiar(ronda_actual=2)
+            difusion.anotar_cambios('DIFU')
+            sala.cambiar(ronda_terminada=True)
+            difusion.anotar_cambios('DIFU')
+            jugador = next(iter(sala.jugadores.values()))
+            sala.cambiar_jugador(jugador, eliminado=True)
+            difusion.anotar_cambios('DIFU')
+            recibido = asyncio.ensure_future(capa.receive(canal))
+            await difusion.vaciar('DIFU')
+
+            mensaje = await asyncio.wait_for(recibido, 2)
+            self.assertEqual(mensaje['type'], 'partida_delta')
+            delta = mensaje['delta']
+            self.assertEqual(delta['version'], 1)
+            self.assertEqual((delta['partida']['ronda_actual'], delta['partida']['ronda_terminada']), (2, True))
+            # Con una capa en red las claves llegan como texto (JSON)
+            jugadores = {str(jugador_id): cambios for jugador_id, cambios in delta['jugadores'].items()}
+            self.assertEqual(jugadores[str(jugador.id)]['eliminado'], True)
+            self.assertEqual(difusion.estadisticas()['deltas_publicados'], antes + 1)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(capa.receive(canal), 0.1)
+            await estado.desconectar('DIFU', partida.host_id, canal)
+
+        async_to_sync(probar)()
+
+    def test_sala_obsoleta_se_recarga_antes_de_publicar(self):
+        partida = crear_partida(4, 'OBSO')
+
+        async def probar():
+            capa, canal, sala = await self.escuchar('OBSO', partida.host_id)
+            await sync_to_async(GameSession.objects.filter(pk=partida.pk).update)(ronda_actual=3)
+            estado.invalidar_sala('OBSO')
+            difusion.anotar_cambios('OBSO')
+            recibido = asyncio.ensure_future(capa.receive(canal))
+            await difusion.vaciar('OBSO')
+
+            mensaje = await asyncio.wait_for(recibido, 2)
+            self.assertEqual(mensaje['type'], 'partida_delta')
+            self.assertEqual(mensaje['delta']['partida'], {'ronda_actual': 3})
+            recargada = estado.sala_en_memoria('OBSO')
+            self.assertIsNot(recargada, sala)
+            self.assertEqual(recargada.canales, {partida.host_id: {canal}})
+            await estado.desconectar('OBSO', partida.host_id, canal)
+
+        async_to_sync(probar)()
+
+    @staticmethod
+    async def recibir(comunicador):
+        """Los mensajes de la siguiente trama que no sean de presencia"""
+        while True:
+            mensaje = await comunicador.receive_json_from(timeout=2)
+            mensajes = mensaje['mensajes'] if mensaje['type'] == 'lote' else [mensaje]
+            mensajes = [m for m in mensajes if m['type'] != 'presencia']
+            if mensajes:
+                return mensajes
+
+    def test_post_de_la_vista_llega_como_delta(self):
+        partida = crear_partida(4, 'VIST')
+        self.client.force_login(partida.host)
+
+        async def probar():
+            comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/partida/VIST/')
+            comunicador.scope['user'] = partida.host
+            conectado, _ = await comunicador.connect()
+            self.assertTrue(conectado)
+            await self.recibir(comunicador)
+
+            respuesta = await sync_to_async(self.client.post)(
+                reverse('blanco:partida', args=['VIST']), {'empezar_partida': '1'}
+            )
+            self.assertLess(respuesta.status_code, 400)
+            deltas = [m for m in await self.recibir(comunicador) if m['type'] == 'partida_delta']
+            self.assertEqual(len(deltas), 1)
+            self.assertEqual(deltas[0]['partida']['estado'], 'en_juego')
+            self.assertIn('privado', deltas[0])
+            await comunicador.disconnect()
+
+        async_to_sync(probar)()
+
+    def test_jugador_nuevo_desde_la_vista_de_otro_proceso(self):
+        partida = crear_partida(4, 'UNIR')
+        nuevo = User.objects.create_user('UNIR_nuevo')
+        self.client.force_login(nuevo)
+
+        async def probar():
+            comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/partida/UNIR/')
+            comunicador.scope['user'] = partida.host
+            conectado, _ = await comunicador.connect()
+            self.assertTrue(conectado)
+            await self.recibir(comunicador)
+
+            # La vista se atiende en otro proceso: la sala de este solo se entera por el grupo
+            with mock.patch('blanco.views.invalidar_sala'):
+                respuesta = await sync_to_async(self.client.get)(reverse('blanco:partida', args=['UNIR']))
+            self.assertEqual(respuesta.status_code, 200)
+            deltas = [m for m in await self.recibir(comunicador) if m['type'] == 'partida_delta']
+            self.assertEqual(len(deltas), 1)
+            sala = estado.sala_en_memoria('UNIR')
+            jugador = sala.jugador_de_usuario(nuevo.id)
+            self.assertIsNotNone(jugador)
+            jugadores = {str(jugador_id): datos for jugador_id, datos in deltas[0]['jugadores'].items()}
+            self.assertEqual(jugadores[str(jugador.id)]['username'], 'UNIR_nuevo')
+            # Al empezar, el reparto de roles cuenta con el jugador nuevo
+            await comunicador.send_json_to({'type': 'iniciar_partida'})
+            await self.recibir(comunicador)
+            self.assertEqual(sum(j.palabra_secreta is not None for j in sala.jugadores.values()), 5)
+            await comunicador.disconnect()
+
+        async_to_sync(probar)()
+
+    @staticmethod
+    async def recibir_todo(comunicador, espera=0.5):
+        """Todos los mensajes que lleguen hasta que pase espera sin recibir nada"""
+        mensajes = []
+        # Un receive que caduca cancela la aplicación: se comprueba antes con receive_nothing
+        while not await comunicador.receive_nothing(espera):
+            mensaje = await comunicador.receive_json_from()
+            mensajes.extend(mensaje['mensajes'] if mensaje['type'] == 'lote' else [mensaje])
+        return mensajes
+
+    @classmethod
+    def secretos(cls, valor):
+        """Valores de palabra_secreta en cualquier parte de un mensaje, salvo el HTML de los fragmentos"""
+        if isinstance(valor, dict):
+            for clave, dentro in valor.items():
+                if clave == 'palabra_secreta':
+                    yield dentro
+                elif clave != 'fragmentos':
+                    yield from cls.secretos(dentro)
+        elif isinstance(valor, list):
+            for dentro in valor:
+                yield from cls.secretos(dentro)
+
+    def test_nadie_recibe_la_palabra_de_otro(self):
+        partida = crear_partida(4, 'SECR')
+        host, otro = partida.host, User.objects.get(username='SECR_jugador1')
+
+        async def probar():
+            comunicadores = {}
+            for usuario in (host, otro):
+                comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/partida/SECR/')
+                comunicador.scope['user'] = usuario
+                conectado, _ = await comunicador.connect()
+                self.assertTrue(conectado)
+                comunicadores[usuario.id] = comunicador
+            recibidos = {usuario_id: await self.recibir_todo(c) for usuario_id, c in comunicadores.items()}
+
+            # Palabras distintas para los dos: el host es bueno y el otro impostor
+            sala = estado.sala_en_memoria('SECR')
+            roles = ['impostor' if j.user_id == otro.id else 'bueno' for j in sala.jugadores.values()]
+            with mock.patch('blanco.estado.repartir', return_value=roles):
+                await comunicadores[host.id].send_json_to({'type': 'iniciar_partida'})
+                for usuario_id, comunicador in comunicadores.items():
+                    recibidos[usuario_id] += await self.recibir_todo(comunicador)
+            # Un delta con la eliminación de un jugador y un snapshot completo con fragmentos
+            eliminado = next(j for j in sala.jugadores.values() if j.user_id not in comunicadores)
+            await comunicadores[host.id].send_json_to({'type': 'eliminar_jugador', 'jugador_id': eliminado.id})
+            for usuario_id, comunicador in comunicadores.items():
+                await comunicador.send_json_to({'type': 'refresh_request'})
+            for usuario_id, comunicador in comunicadores.items():
+                recibidos[usuario_id] += await self.recibir_todo(comunicador)
+
+            palabras = {usuario_id: sala.palabra_secreta(usuario_id) for usuario_id in comunicadores}
+            self.assertNotEqual(palabras[host.id], palabras[otro.id])
+            for usuario_id, mensajes in recibidos.items():
+                with self.subTest(usuario=usuario_id):
+                    propia = palabras[usuario_id]
+                    ajena = palabras[otro.id if usuario_id == host.id else host.id]
+                    tipos = {mensaje['type'] for mensaje in mensajes}
+                    self.assertLessEqual({'partida_updated', 'partida_delta'}, tipos)
+                    secretos = [secreto for mensaje in mensajes for secreto in self.secretos(mensaje)]
+                    self.assertIn(propia, secretos)
+                    self.assertLessEqual(set(secretos), {propia, '', None})
+                    renderizados = [html for m in mensajes for html in m.get('fragmentos', {}).values()]
+                    self.assertTrue(any(propia in html for html in renderizados))
+                    self.assertFalse(any(ajena in html for html in renderizados))
+            for comunicador in comunicadores.values():
+                await comunicador.disconnect()
+
+        async_to_sync(probar)()
+
+    def test_la_vista_vuelca_la_sala_antes_de_calcular(self):
+        partida = crear_partida(4, 'VOLC')
+        GameSession.objects.filter(pk=partida.pk).update(estado='en_juego', ronda_actual=1)
+        self.client.force_login(partida.host)
+
+        async def probar():
+            capa, canal, sala = await self.escuchar('VOLC', partida.host_id)
+            # Fin de ronda por WebSocket, aún sin volcar: la vista tiene que verlo para empezar otra
+            sala.cambiar(ronda_terminada=True)
+            respuesta = await sync_to_async(self.client.post)(
+                reverse('blanco:partida', args=['VOLC']), {'nueva_ronda': '1'}
+            )
+            self.assertEqual(respuesta.status_code, 200)
+            guardada = await sync_to_async(GameSession.objects.get)(pk=partida.pk)
+            self.assertEqual((guardada.ronda_actual, guardada.ronda_terminada), (2, False))
+            await estado.desconectar('VOLC', partida.host_id, canal)
+
+        async_to_sync(probar)()
+
+    def test_el_dueno_de_la_sala_vuelca_cuando_se_lo_piden(self):
+        partida = crear_partida(4, 'REMO')
+
+        async def probar():
+            comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/partida/REMO/')
+            comunicador.scope['user'] = partida.host
+            conectado, _ = await comunicador.connect()
+            self.assertTrue(conectado)
+            await self.recibir(comunicador)
+            sala = estado.sala_en_memoria('REMO')
+            sala.cambiar(ronda_actual=4)
+
+            # La vista se atiende en otro trabajador: no tiene la sala y se lo pide a su dueño
+            with mock.patch('blanco.reparto.es_local', return_value=False), \
+                    mock.patch('blanco.estado.sala_cargada', side_effect=[None, sala]):
+                self.assertTrue(await reparto.volcar_sala('REMO'))
+            guardada = await sync_to_async(GameSession.objects.get)(pk=partida.pk)
+            self.assertEqual(guardada.ronda_actual, 4)
+            await comunicador.disconnect()
+
+            # Sin nadie que responda, la vista no espera más de ESPERA_VOLCADO
+            with mock.patch('blanco.reparto.es_local', return_value=False), \
+                    mock.patch.object(reparto, 'ESPERA_VOLCADO', 0.05):
+                self.assertFalse(await reparto.volcar_sala('REMO'))
+
+        async_to_sync(probar)()
+
+
+class CapaRedTests(SimpleTestCase):
+    """La capa de canales en red contra el servidor local, en un puerto libre"""
+
+    def probar(self, prueba, **config):
+        async def ejecutar():
+            self.almacen = ServidorCapa()
+            servidor = await asyncio.start_server(self.almacen.atender, '127.0.0.1', 0)
+            puerto = servidor.sockets[0].getsockname()[1]
+            capa = CapaRed(url=f'redis://127.0.0.1:{puerto}/0', **config)
+            try:
+                await prueba(capa, puerto)
+            finally:
+                await capa.close()
+                servidor.close()
+                await servidor.wait_closed()
+
+        async_to_sync(ejecutar)()
+
+    async def nada(self, capa, canal, espera=0.2):
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(capa.receive(canal), espera)
+
+    def test_enviar_y_recibir(self):
+        async def prueba(capa, puerto):
+            await capa.send('sala.uno', {'type': 'hola', 'n': 1})
+            self.assertEqual(await asyncio.wait_for(capa.receive('sala.uno'), 2), {'type': 'hola', 'n': 1})
+            canal = await capa.new_channel()
+            recibido = asyncio.ensure_future(capa.receive(canal))
+            await capa.send(canal, {'type': 'privado'})
+            self.assertEqual(await asyncio.wait_for(recibido, 2), {'type': 'privado'})
+
+        self.probar(prueba)
+
+    def test_grupos(self):
+        async def prueba(capa, puerto):
+            primero, segundo = await capa.new_channel(), await capa.new_channel()
+            await capa.group_add('partida_RED', primero)
+            await capa.group_add('partida_RED', segundo)
+            recibidos = [asyncio.ensure_future(capa.receive(canal)) for canal in (primero, segundo)]
+            await capa.group_send('partida_RED', {'type': 'aviso'})
+            self.assertEqual(await asyncio.wait_for(asyncio.gather(*recibidos), 2), [{'type': 'aviso'}] * 2)
+
+            await capa.group_discard('partida_RED', primero)
+            await capa.group_send('partida_RED', {'type': 'otro'})
+            self.assertEqual(await asyncio.wait_for(capa.receive(segundo), 2), {'type': 'otro'})
+            await self.nada(capa, primero)
+
+        self.probar(prueba)
+
+    def test_los_mensajes_caducan(self):
+        async def prueba(capa, puerto):
+            await capa.send('sala.caduca', {'type': 'viejo'})
+            await asyncio.sleep(0.3)
+            await capa.send('sala.caduca', {'type': 'nuevo'})
+            self.assertEqual(await asyncio.wait_for(capa.receive('sala.caduca'), 2), {'type': 'nuevo'})
+
+        self.probar(prueba, expiry=0.2)
+
+    def test_canal_lleno(self):
+        async def prueba(capa, puerto):
+            for n in range(2):
+                await capa.send('sala.llena', {'type': 'x', 'n': n})
+            with self.assertRaises(ChannelFull):
+                await capa.send('sala.llena', {'type': 'x', 'n': 2})
+            # El mensaje rechazado no se queda en la lista
+            conexion = ConexionResp('127.0.0.1', puerto)
+            self.assertEqual(await conexion.comando('LLEN', capa._clave_canal('sala.llena')), 2)
+            await conexion.cerrar()
+            self.assertEqual(await asyncio.wait_for(capa.receive('sala.llena'), 2), {'type': 'x', 'n': 0})
+
+        self.probar(prueba, capacity=2)
+
+    def test_blpop_de_un_cliente_cerrado_no_se_queda_mensajes(self):
+        async def prueba(capa, puerto):
+            conexion = ConexionResp('127.0.0.1', puerto)
+            await conexion.abrir()
+            # Con más comandos detrás en la tubería, como los que manda el lector de los canales del proceso
+            clave = capa._clave_canal('sala.espera')
+            conexion.writer.write(codificar_comando('BLPOP', clave, 5) + codificar_comando('LRANGE', clave, 0, 10))
+            await conexion.writer.drain()
+            await asyncio.sleep(0.05)
+            await conexion.cerrar()
+            await asyncio.sleep(0.05)
+            await capa.send('sala.espera', {'type': 'x'})
+            self.assertEqual(await asyncio.wait_for(capa.receive('sala.espera'), 2), {'type': 'x'})
+
+        self.probar(prueba)
+
+    def test_un_lector_para_los_canales_del_proceso(self):
+        async def prueba(capa, puerto):
+            canales = [await capa.new_channel() for _ in range(3)]
+            self.assertEqual(len({capa._clave_canal(canal) for canal in canales}), 1)
+            recibidos = [asyncio.ensure_future(capa.receive(canal)) for canal in canales]
+            for n, canal in reversed(list(enumerate(canales))):
+                await capa.send(canal, {'type': 'x', 'n': n})
+            mensajes = await asyncio.wait_for(asyncio.gather(*recibidos), 2)
+            self.assertEqual([mensaje['n'] for mensaje in mensajes], [0, 1, 2])
+            self.assertEqual(len(capa._lectores), 1)
+
+        self.probar(prueba)
+
+    def test_la_capacidad_es_de_cada_canal(self):
+        async def prueba(capa, puerto):
+            lento, otro = await capa.new_channel(), await capa.new_channel()
+            await capa.group_add('partida_LLENA', lento)
+            await capa.group_add('partida_LLENA', otro)
+            for n in range(2):
+                await capa.send(lento, {'type': 'x', 'n': n})
+            with self.assertRaises(ChannelFull):
+                await capa.send(lento, {'type': 'x', 'n': 2})
+            # Los canales del mismo proceso comparten lista, pero no capacidad
+            await capa.send(otro, {'type': 'x', 'n': 0})
+            await capa.group_send('partida_LLENA', {'type': 'aviso'})
+            self.assertEqual(await asyncio.wait_for(capa.receive(otro), 2), {'type': 'x', 'n': 0})
+            self.assertEqual(await asyncio.wait_for(capa.receive(otro), 2), {'type': 'aviso'})
+
+            # El aviso no cabía en el canal lleno; al recoger sus mensajes vuelve a tener hueco
+            for n in range(2):
+                self.assertEqual(await asyncio.wait_for(capa.receive(lento), 2), {'type': 'x', 'n': n})
+            await asyncio.sleep(0.05)
+            await capa.send(lento, {'type': 'x', 'n': 3})
+            self.assertEqual(await asyncio.wait_for(capa.receive(lento), 2), {'type': 'x', 'n': 3})
+            await self.nada(capa, lento)
+
+        self.probar(prueba, capacity=2)
+
+    def test_lectura_por_lotes_y_mensajes_antes_del_receptor(self):
+        async def prueba(capa, puerto):
+            primero, segundo = await capa.new_channel(), await capa.new_channel()
+            # Sin nadie leyendo, los mensajes se acumulan en la lista del proceso
+            for n in range(150):
+                await capa.send(segundo, {'type': 'x', 'n': n})
+            with mock.patch.object(self.almacen, 'cmd_blpop', wraps=self.almacen.cmd_blpop) as blpop:
+                # El lector arranca para el primer canal y guarda los del segundo hasta que alguien los pida
+                recibido = asyncio.ensure_future(capa.receive(primero))
+                await capa.send(primero, {'type': 'ya'})
+                self.assertEqual(await asyncio.wait_for(recibido, 2), {'type': 'ya'})
+                # Un viaje del lector por cada LOTE_LECTURA mensajes, no uno por mensaje
+                self.assertLessEqual(blpop.call_count, 3)
+            mensajes = [await asyncio.wait_for(capa.receive(segundo), 2) for _ in range(150)]
+            self.assertEqual([mensaje['n'] for mensaje in mensajes], list(range(150)))
+
+        self.probar(prueba, capacity=200)
+
+    def test_group_send_en_un_viaje(self):
+        async def prueba(capa, puerto):
+            canales = [await capa.new_channel() for _ in range(5)]
+            for canal in canales:
+                await capa.group_add('partida_VIAJE', canal)
+            recibidos = [asyncio.ensure_future(capa.receive(canal)) for canal in canales]
+            conexion = capa._conexion()
+            with mock.patch.object(conexion, 'tuberia', wraps=conexion.tuberia) as tuberia:
+                await capa.group_send('partida_VIAJE', {'type': 'aviso'})
+                # Uno para leer los miembros y otro para enviar a todos
+                self.assertEqual(tuberia.call_count, 2)
+            self.assertEqual(await asyncio.wait_for(asyncio.gather(*recibidos), 2), [{'type': 'aviso'}] * 5)
+
+        self.probar(prueba)
+
+
+class RepartoTests(SimpleTestCase):
+    """Cada sala tiene un solo trabajador y las conexiones que llegan a otro se redirigen"""
+
+    CODIGOS = [f'S{i}' for i in range(2000)]
+
+    def duenos(self, anillo):
+        return {codigo: anillo.propietario(codigo) for codigo in self.CODIGOS}
+
+    def test_anadir_o_quitar_un_nodo_solo_mueve_sus_salas(self):
+        anillo = reparto.AnilloConsistente(['w1', 'w2', 'w3', 'w4'])
+        antes = self.duenos(anillo)
+
+        anillo.agregar('w5')
+        despues = self.duenos(anillo)
+        movidas = [codigo for codigo in self.CODIGOS if antes[codigo] != despues[codigo]]
+        self.assertEqual({despues[codigo] for codigo in movidas}, {'w5'})
+        # Más o menos la quinta parte de las salas
+        self.assertLess(abs(len(movidas) / len(self.CODIGOS) - 1 / 5), 0.1)
+
+        anillo.quitar('w5')
+        self.assertEqual(self.duenos(anillo), antes)
+        anillo.quitar('w2')
+        sin_w2 = self.duenos(anillo)
+        movidas = {codigo for codigo in self.CODIGOS if antes[codigo] != sin_w2[codigo]}
+        self.assertEqual(movidas, {codigo for codigo in self.CODIGOS if antes[codigo] == 'w2'})
+        self.assertNotIn('w2', sin_w2.values())
+
+    def trabajadores(self, este='w1'):
+        trabajadores = {'w1': 'ws://uno:8001', 'w2': 'ws://dos:8002/'}
+        return mock.patch.multiple(reparto, TRABAJADORES=trabajadores, TRABAJADOR=este,
+                                   _anillo=reparto.AnilloConsistente(trabajadores))
+
+    async def conectar(self, ruta):
+        """Primer mensaje que recibe el cliente a través de EnrutamientoSalas"""
+        async def local(scope, receive, send):
+            await receive()
+            await send({'type': 'websocket.accept'})
+            await send({'type': 'websocket.send', 'text': json.dumps({'type': 'local'})})
+            await receive()
+
+        comunicador = WebsocketCommunicator(reparto.EnrutamientoSalas(local), ruta)
+        conectado, _ = await comunicador.connect()
+        self.assertTrue(conectado)
+        mensaje = await comunicador.receive_json_from()
+        if mensaje['type'] == 'redirigir':
+            self.assertEqual((await comunicador.receive_output())['code'], 4000)
+        await comunicador.disconnect()
+        return mensaje
+
+    def test_redirige_las_salas_de_otro_trabajador(self):
+        with self.trabajadores():
+            ajena = next(codigo for codigo in self.CODIGOS if reparto.propietario(codigo) == 'w2')
+            propia = next(codigo for codigo in self.CODIGOS if reparto.propietario(codigo) == 'w1')
+            self.assertEqual(async_to_sync(self.conectar)(f'/ws/partida/{ajena}/'), {
+                'type': 'redirigir', 'url': f'ws://dos:8002/ws/partida/{ajena}/?salto=1',
+            })
+            self.assertEqual(async_to_sync(self.conectar)(f'/ws/partida/{propia}/'), {'type': 'local'})
+            # Tras MAX_SALTOS redirecciones no se acepta fuera del dueño: el cliente vuelve a empezar más tarde
+            ruta = f'/ws/partida/{ajena}/?salto={reparto.MAX_SALTOS}'
+            with self.assertLogs('blanco.reparto', 'WARNING'):
+                self.assertEqual(async_to_sync(self.conectar)(ruta), {
+                    'type': 'redirigir', 'url': f'ws://dos:8002/ws/partida/{ajena}/',
+                    'reintentar': reparto.REINTENTAR_SALTOS_MS,
+                })
+            self.assertEqual(reparto.url_websocket(propia), f'ws://uno:8001/ws/partida/{propia}/')
+
+    def test_los_drenados_se_consultan_al_arrancar(self):
+        async def probar():
+            capa = get_channel_layer()
+            otro = await capa.new_channel()
+            await capa.group_add(reparto.GRUPO_TRABAJADORES, otro)
+            escucha = asyncio.ensure_future(reparto._escuchar_trabajadores())
+            try:
+                # Otro trabajador, que ya sabía que w2 está drenado, responde a la consulta
+                consulta = await asyncio.wait_for(capa.receive(otro), 2)
+                self.assertEqual(consulta['type'], 'trabajador.consultar')
+                await capa.send(consulta['respuesta'], {'type': 'trabajador.drenados', 'drenados': ['w2']})
+                for _ in range(100):
+                    if reparto._drenados:
+                        break
+                    await asyncio.sleep(0.01)
+                self.assertEqual(reparto._drenados, {'w2'})
+                self.assertEqual({reparto.propietario(codigo) for codigo in self.CODIGOS[:50]}, {'w1'})
+
+                # Y responde a su vez a los que arrancan después
+                await capa.group_send(reparto.GRUPO_TRABAJADORES, {'type': 'trabajador.consultar', 'respuesta': otro})
+                respuesta = await asyncio.wait_for(capa.receive(otro), 2)
+                while respuesta['type'] != 'trabajador.drenados':
+                    respuesta = await asyncio.wait_for(capa.receive(otro), 2)
+                self.assertEqual(respuesta['drenados'], ['w2'])
+            finally:
+                escucha.cancel()
+                await capa.group_discard(reparto.GRUPO_TRABAJADORES, otro)
+
+        with self.trabajadores(), mock.patch.object(reparto, '_drenados', set()), \
+                mock.patch.object(estado, 'salas_activas', return_value=[]):
+            async_to_sync(probar)()
+
+    def test_las_tareas_de_fondo_arrancan_con_el_proceso(self):
+        async def http(scope, receive, send):
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def probar():
+            aplicacion = arranque.TareasDeFondo(http)
+            ciclo = ApplicationCommunicator(aplicacion, {'type': 'lifespan'})
+            await ciclo.send_input({'type': 'lifespan.startup'})
+            self.assertEqual(await ciclo.receive_output(1), {'type': 'lifespan.startup.complete'})
+            self.assertEqual((escucha.call_count, limpiar.call_count), (1, 1))
+            await ciclo.send_input({'type': 'lifespan.shutdown'})
+            self.assertEqual(await ciclo.receive_output(1), {'type': 'lifespan.shutdown.complete'})
+
+            # Sin lifespan (Daphne), con la primera petición, aunque sea HTTP
+            peticion = ApplicationCommunicator(aplicacion, {'type': 'http', 'method': 'GET', 'path': '/'})
+            await peticion.send_input({'type': 'http.request'})
+            self.assertEqual((await peticion.receive_output(1))['status'], 200)
+            self.assertEqual((escucha.call_count, limpiar.call_count), (2, 2))
+
+        with self.trabajadores(), mock.patch.object(reparto, 'asegurar_escucha') as escucha, \
+                mock.patch.object(limpieza, 'asegurar_limpieza') as limpiar:
+            async_to_sync(probar)()
+
+
+class ConsultasTests(TestCase):
+    """Las consultas de cada acción usan índices (manage.py explicar_consultas)"""
+
+    def test_explicar_consultas(self):
+        crear_partida(4, 'EXPL')
+        salida = StringIO()
+        call_command('explicar_consultas', plan=True, sin_seqscan=True, stdout=salida)
+        lineas = [linea for linea in salida.getvalue().splitlines() if linea.endswith('usa índice')]
+        self.assertEqual(len(lineas), 5)
+
+    def test_recorridos_completos(self):
+        from .management.commands.explicar_consultas import recorridos_completos
+
+        self.assertEqual(recorridos_completos('Seq Scan on blanco_gameplayer  (cost=0.00..1.05 rows=1)'),
+                         ['blanco_gameplayer'])
+        self.assertEqual(recorridos_completos('SCAN blanco_gamesession\nSEARCH blanco_gameplayer USING INDEX x'),
+                         ['blanco_gamesession'])
+        self.assertEqual(recorridos_completos('SCAN blanco_gameplayer USING INDEX blanco_jugadores_activos'), [])
+
+        with mock.patch('blanco.management.commands.explicar_consultas.recorridos_completos',
+                        return_value=['blanco_gameplayer']):
+            with self.assertRaisesMessage(CommandError, '5 consulta(s) sin índice'):
+                call_command('explicar_consultas', stdout=StringIO())
+
+
+class LimpiezaTests(TestCase):
+    """Se borran las partidas vacías y las expiradas, pero no las abiertas en ningún proceso"""
+
+    def partida(self, codigo, estado='esperando', edad=0, inactividad=0, jugadores=1):
+        if jugadores:
+            partida = crear_partida(jugadores, codigo)
+        else:
+            partida = GameSession.objects.create(codigo=codigo)
+        ahora = timezone.now()
+        GameSession.objects.filter(id=partida.id).update(
+            estado=estado, creado=ahora - timedelta(seconds=edad), actualizado=ahora - timedelta(seconds=inactividad)
+        )
+        return partida
+
+    def antigua(self, codigo, **campos):
+        """Partida más vieja que EDAD_MAXIMA y sin marca de actividad reciente"""
+        return self.partida(codigo, edad=limpieza.EDAD_MAXIMA + 60, inactividad=limpieza.PRESENCIA + 60, **campos)
+
+    def test_borrar_partidas_vacias(self):
+        self.partida('VACIA', jugadores=0)
+        self.partida('LLENA')
+        self.assertEqual(limpieza.borrar_partidas_vacias(), 1)
+        self.assertEqual(list(GameSession.objects.values_list('codigo', flat=True)), ['LLENA'])
+
+    def test_partidas_expiradas(self):
+        self.antigua('VIEJA')
+        self.antigua('TERM', estado='terminada')
+        self.partida('INACT', inactividad=limpieza.INACTIVIDAD_MAXIMA + 60)
+        self.antigua('JUEGO', estado='en_juego')
+        self.partida('NUEVA')
+        # Antigua pero marcada hace poco por el proceso que la tiene abierta
+        self.partida('ABIERTA', edad=limpieza.EDAD_MAXIMA + 60)
+        self.assertEqual(set(limpieza.partidas_expiradas().values_list('codigo', flat=True)),
+                         {'VIEJA', 'TERM', 'INACT'})
+
+    def test_expirar_partidas_por_lotes_sin_tocar_las_abiertas(self):
+        for i in range(3):
+            self.antigua(f'VIEJA{i}')
+        abierta = self.antigua('ABIERTA')
+        sala = SalaEstado.desde_modelo(abierta)
+        with mock.patch.object(estado, 'salas_activas', return_value=[sala]):
+            self.assertEqual(limpieza.expirar_partidas(lote=2), 3)
+        self.assertEqual(list(GameSession.objects.values_list('codigo', flat=True)), ['ABIERTA'])
+
+    def test_la_marca_protege_las_salas_abiertas_en_otro_proceso(self):
+        abierta = self.antigua('ABIERTA')
+        self.antigua('VIEJA')
+        # El proceso que tiene la sala abierta hace su pasada y la marca
+        with mock.patch.object(estado, 'salas_activas', return_value=[SalaEstado.desde_modelo(abierta)]):
+            self.assertEqual(limpieza.limpiar(), (0, 1))
+        # Otro proceso (o el cron) no la tiene en memoria y aun así no la expira
+        self.assertEqual(limpieza.limpiar(), (0, 0))
+        self.assertTrue(GameSession.objects.filter(codigo='ABIERTA').exists())
+
+
+@mock.patch.multiple(presencia, GRACIA=0.1, VENTANA=0.05)
+class PresenciaTests(TransactionTestCase):
+    """Las recargas no se anuncian y las entradas y salidas de una sala salen en un solo aviso"""
+
+    async def aviso(self, capa, canal, espera=1):
+        mensaje = await asyncio.wait_for(capa.receive(canal), espera)
+        self.assertEqual(mensaje['type'], 'partida_message')
+        return mensaje['message']
+
+    def test_dos_conexiones_del_mismo_usuario(self):
+        async def probar():
+            self.assertTrue(presencia.entrar('PRES1', 1, 'ana', 'canal.a'))
+            self.assertFalse(presencia.entrar('PRES1', 1, 'ana', 'canal.b'))
+            presencia.salir('PRES1', 1, 'canal.a')
+            self.assertIsNone(presencia._presencias['PRES1'][1].salida)
+            # Sin conexiones sigue presente durante la gracia
+            presencia.salir('PRES1', 1, 'canal.b')
+            self.assertTrue(presencia.esta_presente('PRES1', 1))
+            await asyncio.sleep(presencia.GRACIA + 0.05)
+            self.assertFalse(presencia.esta_presente('PRES1', 1))
+            self.assertEqual(presencia.presentes('PRES1'), [])
+
+        async_to_sync(probar)()
+
+    def test_aviso_agrupado_y_periodo_de_gracia(self):
+        async def probar():
+            capa = get_channel_layer()
+            canal = await capa.new_channel()
+            await capa.group_add('partida_PRES2', canal)
+            recibido = asyncio.ensure_future(self.aviso(capa, canal))
+            presencia.entrar('PRES2', 1, 'ana', 'canal.a')
+            presencia.entrar('PRES2', 2, 'bea', 'canal.b')
+            self.assertEqual(await recibido, {
+                'type': 'presencia', 'conectados': ['ana', 'bea'], 'desconectados': [], 'presentes': [1, 2],
+            })
+
+            # Una recarga (sale y vuelve antes de la gracia) no se anuncia
+            presencia.salir('PRES2', 1, 'canal.a')
+            presencia.entrar('PRES2', 1, 'ana', 'canal.a2')
+            with self.assertRaises(asyncio.TimeoutError):
+                await self.aviso(capa, canal, presencia.GRACIA + presencia.VENTANA + 0.1)
+
+            recibido = asyncio.ensure_future(self.aviso(capa, canal))
+            presencia.salir('PRES2', 2, 'canal.b')
+            self.assertEqual(await recibido, {
+                'type': 'presencia', 'conectados': [], 'desconectados': ['bea'], 'presentes': [1],
+            })
+            presencia.salir('PRES2', 1, 'canal.a2')
+            await asyncio.sleep(presencia.GRACIA + 0.05)
+
+        async_to_sync(probar)()
+
+    def test_presentes_en_el_snapshot(self):
+        partida = crear_partida(4, 'PRES3')
+
+        async def probar():
+            comunicador = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/partida/PRES3/')
+            comunicador.scope['user'] = partida.host
+            conectado, _ = await comunicador.connect()
+            self.assertTrue(conectado)
+            mensaje = await comunicador.receive_json_from()
+            mensajes = mensaje['mensajes'] if mensaje['type'] == 'lote' else [mensaje]
+            snapshot = next(m for m in mensajes if m['type'] == 'partida_updated')
+            self.assertEqual(snapshot['data']['presentes'], [partida.host_id])
+            await comunicador.disconnect()
+            await asyncio.sleep(presencia.GRACIA + 0.05)
+
+        async_to_sync(probar)()
+
+
+class ReglasTests(SimpleTestCase):
+    """Las reglas de la ronda, sin base de datos, con casos fijos y fotos al azar"""
+
+    @staticmethod
+    def foto(*roles, eliminados=(), intentaron=(), palabra='Árbol'):
+        return reglas.Foto(palabra, False, tuple(
+            reglas.Jugador(i, rol, i in eliminados, i in intentaron) for i, rol in enumerate(roles)
+        ))
+
+    def test_1vs1_segun_la_tabla(self):
+        for roles, (tabla, _) in reglas.PUNTOS_1VS1.items():
+            with self.subTest(roles=roles):
+                resultado = reglas.eliminar(self.foto('bueno', *roles), 0)
+                self.assertTrue(resultado.ronda_terminada)
+                self.assertEqual(resultado.puntos, {i: tabla[r] for i, r in enumerate(roles, 1) if r in tabla})
+
+    def test_ganan_los_buenos(self):
+        resultado = reglas.eliminar(self.foto('bueno', 'bueno', 'bueno', 'infiltrado'), 3)
+        self.assertEqual(resultado.puntos, {0: 1, 1: 1, 2: 1})
+        self.assertEqual(resultado.codigos, ('ganan_buenos',))
+
+    def test_el_impostor_eliminado_puede_adivinar_antes_de_los_puntos(self):
+        foto = self.foto('bueno', 'bueno', 'bueno', 'impostor')
+        resultado = reglas.eliminar(foto, 3)
+        self.assertEqual((resultado.puntos, resultado.ronda_terminada), ({}, False))
+        self.assertEqual(resultado.codigos, ('esperan_adivinacion',))
+
+        foto = self.foto('bueno', 'bueno', 'bueno', 'impostor', eliminados={3})
+        # Sin distinguir mayúsculas ni acentos
+        acierto = reglas.adivinar(foto, 3, ' arbol ')
+        self.assertEqual((acierto.correcto, acierto.puntos, acierto.ronda_terminada), (True, {3: 3}, True))
+        fallo = reglas.adivinar(foto, 3, 'Casa')
+        self.assertEqual((fallo.correcto, fallo.puntos, fallo.ronda_terminada), (False, {0: 1, 1: 1, 2: 1}, True))
+        self.assertEqual(
+            reglas.mensaje(fallo, 'Árbol'),
+            'Incorrecto. La palabra era "Árbol". ' + reglas.MENSAJES['ganan_buenos'] + ' La ronda ha terminado.',
+        )
+        # Solo una vez, y solo los impostores eliminados
+        self.assertIsNone(reglas.adivinar(self.foto('bueno', 'impostor', eliminados={1}, intentaron={1}), 1, 'x'))
+        self.assertIsNone(reglas.adivinar(foto, 0, 'Árbol'))
+
+    def test_acciones_rechazadas(self):
+        foto = self.foto('bueno', 'bueno', 'infiltrado', eliminados={1})
+        self.assertIsNone(reglas.eliminar(foto, 1))
+        self.assertIsNone(reglas.eliminar(foto, 7))
+        self.assertIsNone(reglas.eliminar(foto._replace(ronda_terminada=True), 0))
+
+    def test_fotos_al_azar(self):
+        azar = random.Random(22)
+        for _ in range(2000):
+            n = azar.randint(3, 12)
+            roles = [azar.choice(reglas.ROLES + (None,)) for _ in range(n)]
+            eliminados = {i for i in range(n) if azar.random() < 0.3}
+            intentaron = {i for i in eliminados if azar.random() < 0.5}
+            foto = self.foto(*roles, eliminados=eliminados, intentaron=intentaron)
+            activos = [i for i in range(n) if i not in eliminados]
+            if not activos:
+                continue
+            objetivo = azar.choice(activos)
+            with self.subTest(roles=roles, eliminados=eliminados, intentaron=intentaron, objetivo=objetivo):
+                resultado = reglas.eliminar(foto, objetivo)
+                # Las reglas no dependen de nada más que de la foto
+                self.assertEqual(resultado, reglas.eliminar(foto, objetivo))
+                quedan = [i for i in activos if i != objetivo]
+                self.assertEqual(resultado.eliminado, objetivo)
+                # Solo puntúan los que siguen activos
+                self.assertLessEqual(set(resultado.puntos), set(quedan))
+                pueden_adivinar = any(
+                    roles[i] == 'impostor' and i not in intentaron for i in eliminados | {objetivo}
+                )
+                sin_malos = not any(roles[i] in ('impostor', 'infiltrado') for i in quedan)
+                final = sin_malos or len(quedan) <= 2
+                self.assertEqual(resultado.ronda_terminada, final and not pueden_adivinar)
+                if not resultado.ronda_terminada:
+                    self.assertEqual(resultado.puntos, {})
+                self.assertTrue(reglas.mensaje(resultado, 'Árbol') or not resultado.codigos)
+
+
+def crear_sala(n=5):
+    jugadores = [
+        JugadorEstado(id=i, user_id=i, username=f'jugador{i}', puntos=0, ronda_actual=1, eliminado=False,
+                      es_impostor=False, es_infiltrado=False, es_bueno=True, ya_intento_adivinar=False,
+                      palabra_secreta='Gato')
+        for i in range(1, n + 1)
+    ]
+    return SalaEstado(id=1, codigo='SNAP', host_id=1, jugadores=jugadores, estado='en_juego', ronda_actual=1,
+                      ronda_terminada=False, palabra_impostor='Gato')
+
+
+class SnapshotTests(SimpleTestCase):
+    """La parte pública del snapshot se codifica una vez por versión de la sala"""
+
+    def test_misma_version_mismo_texto(self):
+        sala = crear_sala()
+        primero = sala.snapshot_publico()
+        texto = primero.texto(compacto=True)
+        self.assertIs(sala.snapshot_publico(), primero)
+        # Las copias con los datos de cada jugador comparten el texto ya codificado
+        sala.snapshot_publico().con(palabra_secreta='Gato').texto(compacto=True)
+        self.assertIs(primero.textos[True], texto)
+
+    def test_los_cambios_invalidan(self):
+        sala = crear_sala()
+        anterior = sala.snapshot_publico()
+        sala.cambiar_jugador(sala.jugadores[2], eliminado=True)
+        # Sin publicar, la versión no ha cambiado: no se reutiliza ni se guarda
+        pendiente = sala.snapshot_publico()
+        self.assertIsNot(pendiente, anterior)
+        self.assertIsNot(sala.snapshot_publico(), pendiente)
+        self.assertTrue(pendiente.valor['jugadores'][1]['eliminado'])
+        sala.publicar()
+        nuevo = sala.snapshot_publico()
+        self.assertEqual(nuevo.valor['version'], anterior.valor['version'] + 1)
+        self.assertIs(sala.snapshot_publico(), nuevo)
+
+    def test_misma_trama_que_sin_cache(self):
+        sala = crear_sala()
+        for compacto in (False, True):
+            with self.subTest(compacto=compacto):
+                mensajes = [{'type': 'partida_updated', 'data': sala.snapshot_publico().con(
+                    palabra_secreta=sala.palabra_secreta(user_id), presentes=[1, 2],
+                )} for user_id in (1, 99)]
+                lote = {'type': 'lote', 'mensajes': mensajes}
+                self.assertEqual(protocolo.decodificar(protocolo.codificar(lote, compacto)), {
+                    'type': 'lote',
+                    'mensajes': [
+                        {'type': 'partida_updated', 'data': dict(sala.datos(1), presentes=[1, 2])},
+                        {'type': 'partida_updated', 'data': dict(sala.datos(99), presentes=[1, 2])},
+                    ],
+                })
+
+    def test_con_da_el_mismo_json_que_json_dumps(self):
+        valor = crear_sala().datos_publicos()
+        extra = {'palabra_secreta': 'Gato "negro"', 'presentes': [1, 2]}
+        casos = [(valor, extra), (valor, {}), ({}, extra), ({}, {})]
+        for base, anadido in casos:
+            with self.subTest(base=bool(base), extra=bool(anadido)):
+                unido = dict(base, **anadido)
+                texto = protocolo.Codificado(base).con(**anadido).texto(compacto=False)
+                self.assertEqual(texto, json.dumps(unido))
+                self.assertEqual(json.loads(texto), unido)
+                compacto = protocolo.Codificado(base).con(**anadido).texto(compacto=True)
+                self.assertEqual(compacto, json.dumps(protocolo.compactar(unido), separators=(',', ':'),
+                                                      ensure_ascii=False))
+
+
+class ProtocoloTests(SimpleTestCase):
+    """Formato compacto de las tramas del WebSocket"""
+
+    def snapshot(self):
+        return crear_sala().datos(1)
+
+    def test_compactar_y_expandir_un_snapshot(self):
+        datos = self.snapshot()
+        compacto = protocolo.compactar(datos)
+        # Los jugadores van por columnas y los booleanos como 1 y 0
+        jugadores = compacto[protocolo.ABREVIATURAS['jugadores']]
+        self.assertEqual(set(jugadores), {'#', '='})
+        self.assertEqual(len(jugadores['=']), len(datos['jugadores']))
+        self.assertNotIn(True, [v for fila in jugadores['='] for v in fila if type(v) is bool])
+        self.assertEqual(protocolo.expandir(compacto), datos)
+        mensaje = {'type': 'partida_updated', 'data': datos}
+        self.assertEqual(protocolo.decodificar(protocolo.codificar(mensaje, compacto=True)), mensaje)
+
+    def test_claves_que_parecen_abreviaturas(self):
+        # Claves desconocidas que coinciden con una abreviatura, con las marcas de columnas o con el escape
+        valor = {
+            'a': 1, 'b': [1, 2], '#': 'almohadilla', '=': 'igual', '~': 'tilde', '~a': 'escapada',
+            'desconocida': {'#': [1], '=': [[2]]},
+            'filas': [{'a': 1, '~b': True}, {'a': 2, '~b': False}],
+            'type': 'no_es_un_tipo', 'eliminado': True, 'otro': True,
+        }
+        compacto = protocolo.compactar(valor)
+        self.assertIn('~a', compacto)
+        self.assertIn('~~a', compacto)
+        self.assertIn('~#', compacto)
+        self.assertEqual(protocolo.expandir(compacto), valor)
+        self.assertEqual(protocolo.expandir(json.loads(json.dumps(compacto))), valor)
+
+    def test_listas_que_no_van_por_columnas(self):
+        for lista in ([], [{'id': 1}], [{'id': 1}, {'user_id': 2}], [{'id': 1}, 2], [[1, 2], [3]]):
+            with self.subTest(lista=lista):
+                valor = {'jugadores': lista}
+                self.assertEqual(protocolo.expandir(protocolo.compactar(valor)), valor)
+
+    def test_decodificar(self):
+        mensaje = {'type': 'eliminar_jugador', 'jugador_id': 3}
+        self.assertEqual(protocolo.decodificar(json.dumps(mensaje)), mensaje)
+        self.assertEqual(protocolo.decodificar(json.dumps([protocolo.VERSION, protocolo.compactar(mensaje)])),
+                         mensaje)
+        for trama in ([protocolo.VERSION + 1, {}], [0, {}], [protocolo.VERSION], [protocolo.VERSION, {}, {}]):
+            with self.subTest(trama=trama):
+                with self.assertRaises(ValueError):
+                    protocolo.decodificar(json.dumps(trama))
+
+
+    def test_negociar(self):
+        compacto, json_ = protocolo.SUBPROTOCOLO, protocolo.SUBPROTOCOLO_JSON
+        casos = [
+            ([], (None, False, False)),
+            (['otro', 'blanco.compacto.0'], (None, False, False)),
+            ([compacto], (compacto, True, False)),
+            ([json_], (json_, False, False)),
+            ([f'{compacto}+deflate', compacto], (f'{compacto}+deflate', True, True)),
+            ([f'{json_}+deflate'], (f'{json_}+deflate', False, True)),
+            ([f'{compacto}+gzip', json_], (json_, False, False)),
+        ]
+        for ofrecidos, esperado in casos:
+            with self.subTest(ofrecidos=ofrecidos):
+                self.assertEqual(protocolo.negociar(ofrecidos), esperado)
+
+    def test_negociar_sin_compresion(self):
+        compacto = protocolo.SUBPROTOCOLO
+        with mock.patch.object(protocolo, 'COMPRIMIR', False):
+            # Se salta la extensión y se elige el siguiente ofrecido, sin comprimir
+            self.assertEqual(protocolo.negociar([f'{compacto}+deflate', compacto]), (compacto, True, False))
+            self.assertEqual(protocolo.negociar([f'{compacto}+deflate']), (None, False, False))
+            self.assertIsNone(protocolo.esquema()['compresion'])
+
+    def test_comprimir_es_deflate_sin_cabecera(self):
+        texto = protocolo.codificar({'type': 'partida_updated', 'data': crear_sala(20).datos(1)}, compacto=True)
+        comprimido = protocolo.comprimir(texto)
+        self.assertLess(len(comprimido), len(texto.encode()))
+        descompresor = zlib.decompressobj(-15)
+        self.assertEqual(descompresor.decompress(comprimido) + descompresor.flush(), texto.encode())
+        self.assertTrue(descompresor.eof)
+        # Sin cabecera zlib: zlib.decompress con cabecera no lo acepta
+        with self.assertRaises(zlib.error):
+            zlib.decompress(comprimido)
+        # Cada trama se comprime por separado
+        self.assertEqual(protocolo.comprimir(texto), comprimido)
+
+    def test_medir_protocolo(self):
+        salida = StringIO()
+        call_command('medir_protocolo', min=4, max=5, repeticiones=1, stdout=salida)
+        lineas = salida.getvalue().splitlines()
+        # Cabecera, cinco mensajes por tamaño de sala y las dos notas finales
+        self.assertEqual(len(lineas), 1 + 2 * 5 + 2)
+        filas = [linea.split() for linea in lineas[1:-2]]
+        self.assertEqual([fila[0] for fila in filas], ['4'] * 5 + ['5'] * 5)
+        # Los bytes de cada mensaje en compacto son menos que en JSON
+        for fila in filas:
+            json_b, compacto_b = int(fila[-6]), int(fila[-5])
+            self.assertLess(compacto_b, json_b)
+
+
+class RolesTests(SimpleTestCase):
+    """Un solo reparto de roles para empezar partida y nueva ronda, de 4 a 30 jugadores"""
+
+    def test_tabla_de_4_a_9_jugadores(self):
+        tabla = {4: (3, 1, 0), 5: (3, 1, 1), 6: (4, 1, 1), 7: (4, 2, 1), 8: (5, 2, 1), 9: (5, 2, 2)}
+        self.assertEqual({n: roles.reparto(n) for n in tabla}, tabla)
+
+    def test_salas_grandes(self):
+        self.assertIsNone(roles.reparto(roles.MIN_JUGADORES - 1))
+        self.assertIsNone(roles.reparto(roles.MAX_JUGADORES + 1))
+        for n in range(10, roles.MAX_JUGADORES + 1):
+            with self.subTest(n=n):
+                buenos, infiltrados, impostores = roles.reparto(n)
+                self.assertEqual(buenos + infiltrados + impostores, n)
+                # Siempre hay más buenos que malos y al menos un malo de cada tipo
+                self.assertGreater(buenos, infiltrados + impostores)
+                self.assertGreaterEqual(min(infiltrados, impostores), 1)
+
+    def test_repartir(self):
+        repartidos = roles.repartir(30, random.Random(1))
+        self.assertEqual(tuple(repartidos.count(rol) for rol in reglas.ROLES), roles.reparto(30))
+        # Cada llamada baraja su propia copia
+        self.assertIsNot(repartidos, roles.repartir(30))
+        self.assertIsNone(roles.repartir(3))
+
+
+class ComparacionRendimientoTests(SimpleTestCase):
+    """manage.py comparar_rendimiento avisa de las operaciones más lentas o con más consultas"""
+
+    def historial(self, *ejecuciones):
+        """Fichero temporal con una ejecución por cada {operación: (consultas, mínimo en ms)}"""
+        directorio = tempfile.TemporaryDirectory()
+        self.addCleanup(directorio.cleanup)
+        ruta = os.path.join(directorio.name, 'rendimiento.json')
+        for resultados in ejecuciones:
+            rendimiento.registrar(ruta, 'sqlite', {
+                nombre: {'consultas': consultas, 'minimo_ms': ms, 'mediana_ms': ms, 'repeticiones': 1}
+                for nombre, (consultas, ms) in resultados.items()
+            })
+        return ruta
+
+    def comparar(self, ruta, **opciones):
+        salida = StringIO()
+        call_command('comparar_rendimiento', historial=ruta, stdout=salida, **opciones)
+        return salida.getvalue()
+
+    def test_sin_regresiones(self):
+        ruta = self.historial({'vista': (3, 10.0)}, {'vista': (3, 11.0), 'nueva': (1, 2.0)})
+        salida = self.comparar(ruta, umbral=20)
+        self.assertIn('Sin regresiones', salida)
+        self.assertRegex(salida, r'nueva\s+1\s+-\s+2\.00\s+nueva')
+
+    def test_mas_lenta_o_mas_consultas(self):
+        ruta = self.historial({'lenta': (3, 10.0), 'consultas': (3, 10.0)},
+                              {'lenta': (3, 15.0), 'consultas': (4, 10.0)})
+        with self.assertRaisesMessage(CommandError, '2 operación(es) más lentas de un 20%'):
+            self.comparar(ruta, umbral=20)
+        self.assertIn('Sin regresiones', self.comparar(self.historial({'lenta': (3, 10.0)}, {'lenta': (3, 15.0)}),
+                                                       umbral=60))
+
+    def test_sin_historial(self):
+        with self.assertRaisesMessage(CommandError, '--historial'):
+            self.comparar('')
+        with self.assertRaisesMessage(CommandError, 'No hay ejecuciones'):
+            self.comparar(os.path.join(tempfile.gettempdir(), 'no_existe_rendimiento.json'))
+
+
+class SimulacionTests(SimpleTestCase):
+    """La simulación juega todos los repartos y ninguna ronda se queda sin final"""
+
+    def test_todos_los_repartos_terminan(self):
+        total, por_reparto = simulacion.simular(min_jugadores=4, max_jugadores=6, rondas=300, procesos=1, semilla=1)
+
+        self.assertEqual(set(por_reparto), {r for n in (4, 5, 6) for r in simulacion.repartos(n)})
+        self.assertEqual(total['rondas'], 300 * len(por_reparto))
+        self.assertEqual(total['atascos'], 0)
+        self.assertEqual(sum(total['longitud'].values()), total['rondas'])
+        # Cada jugador gana los puntos de su rol o ninguno
+        for rol, puntos in (('bueno', 1), ('infiltrado', 2), ('impostor', 3)):
+            self.assertLessEqual(set(total['puntos'][rol]), {0, puntos})
+        # Sin impostores no hay aciertos
+        self.assertFalse(any('acierto' in f for f in por_reparto[3, 1, 0]['finales']))
+
+    def test_simular_reglas(self):
+        opciones = {'min_jugadores': 4, 'max_jugadores': 5, 'rondas': 50, 'procesos': 1, 'semilla': 1}
+        salida = StringIO()
+        call_command('simular_reglas', json=True, stdout=salida, **opciones)
+        resumen = json.loads(salida.getvalue())
+        repartos = {'-'.join(map(str, r)) for n in (4, 5) for r in simulacion.repartos(n)}
+        self.assertEqual(set(resumen['repartos']), repartos)
+        self.assertEqual(resumen['total']['rondas'], 50 * len(repartos))
+        self.assertEqual(resumen['total']['atascos'], 0)
+
+        salida = StringIO()
+        call_command('simular_reglas', juego=True, detalle=True, stdout=salida, **opciones)
+        texto = salida.getvalue()
+        self.assertTrue(texto.startswith('100 rondas de 2 repartos en '))
+        self.assertIn('Todas las rondas han terminado con alguna regla', texto)
+        # En el detalle, los repartos del juego van marcados
+        self.assertEqual(texto.count('* '), 2)
+
+    def test_misma_semilla_mismo_resultado(self):
+        uno = simulacion.simular_lote((5, 2, 2), 200, 7, 0.25)
+        otro = simulacion.simular_lote((5, 2, 2), 200, 7, 0.25)
+        self.assertEqual(uno, otro)
+
+
+class PalabrasTests(TestCase):
+    """Índice de pares en memoria: sorteo con pesos y mazo de cada partida"""
+
+    def setUp(self):
+        PalabraPar.objects.bulk_create([
+            PalabraPar(palabra_buena=f'Buena{i}', palabra_infiltrado=f'Infiltrado{i}', categoria=categoria)
+            for i, categoria in enumerate(['animales'] * 3 + ['comida'] * 2)
+        ])
+        muestreador.invalidar()
+        # El índice no se entera de que la transacción de la prueba se deshace
+        self.addCleanup(muestreador.invalidar)
+
+    @staticmethod
+    def probabilidades(probabilidad, alias):
+        """Probabilidad exacta de cada índice con una tabla de alias"""
+        n = len(probabilidad)
+        resultado = [p / n for p in probabilidad]
+        for i, p in enumerate(probabilidad):
+            resultado[alias[i]] += (1 - p) / n
+        return resultado
+
+    def test_tabla_alias(self):
+        for pesos in ([1, 2, 3, 4], [5, 1, 1, 1, 1, 1], [0, 3, 0, 1], [7], [2, 2, 2]):
+            with self.subTest(pesos=pesos):
+                probabilidad, alias = tabla_alias(pesos)
+                esperadas = [peso / sum(pesos) for peso in pesos]
+                for calculada, esperada in zip(self.probabilidades(probabilidad, alias), esperadas):
+                    self.assertAlmostEqual(calculada, esperada)
+        self.assertEqual(tabla_alias([7]), ([1], [0]))
+
+    def test_frecuencias_del_sorteo_con_pesos(self):
+        azar = random.Random(7)
+        veces = 60000
+        with mock.patch('blanco.palabras.PESOS_CATEGORIAS', {'animales': 1, 'comida': 3}):
+            muestreador.cargar()
+            categorias = [muestreador.pares[muestreador.sortear(azar=azar)][3] for _ in range(veces)]
+        # Cada par de comida pesa 3: 2 * 3 frente a 3 * 1
+        self.assertAlmostEqual(categorias.count('comida') / veces, 6 / 9, delta=0.01)
+
+    def test_pesos_cero_y_una_sola_palabra(self):
+        azar = random.Random(3)
+        with mock.patch('blanco.palabras.PESOS_CATEGORIAS', {'animales': 0}):
+            muestreador.cargar()
+            self.assertEqual({muestreador.pares[muestreador.sortear(azar=azar)][3] for _ in range(2000)}, {'comida'})
+            # Con la categoría pedida se sortea dentro de ella aunque pese 0
+            self.assertEqual(muestreador.pares[muestreador.sortear('animales', azar)][3], 'animales')
+
+        with mock.patch('blanco.palabras.PESOS_CATEGORIAS', {'animales': 0, 'comida': 0}):
+            muestreador.cargar()
+            self.assertIsNone(muestreador.sortear(azar=azar))
+
+        PalabraPar.objects.exclude(palabra_buena='Buena0').delete()
+        muestreador.cargar()
+        self.assertEqual({muestreador.sortear(azar=azar) for _ in range(100)}, {0})
+        self.assertEqual(muestreador.robar(None, 0)[0], ('Buena0', 'Infiltrado0'))
+
+    def test_el_mazo_no_repite_hasta_agotarse_y_se_vuelve_a_barajar(self):
+        mazo, posicion, ultimas = None, 0, ()
+        robados = []
+        for _ in range(5):
+            palabras, mazo, posicion = muestreador.robar(mazo, posicion, ultimas)
+            robados.append(palabras)
+            ultimas = palabras
+        self.assertEqual(len(set(robados)), 5)
+        self.assertEqual(posicion, 5)
+
+        barajados = muestreador.barajados
+        palabras, nuevo, posicion = muestreador.robar(mazo, posicion, ultimas)
+        self.assertEqual(muestreador.barajados, barajados + 1)
+        self.assertEqual(posicion, 1)
+        # El primer par del mazo nuevo no repite el de la ronda anterior
+        self.assertNotEqual(palabras, ultimas)
+        self.assertEqual(len(nuevo), len(mazo))
+
+    def test_aplazar_una_carta_no_copia_el_mazo(self):
+        muestreador.cargar()
+        ids = [par[0] for par in muestreador.pares]
+        mazo = bytearray(array('I', ids))
+        excluir = muestreador.pares[0][1:3]
+        palabras, nuevo, posicion = muestreador.robar(mazo, 0, excluir)
+        # La carta recién usada se cambia en su sitio por la última del mazo
+        self.assertIs(nuevo, mazo)
+        self.assertEqual(palabras, muestreador.pares[4][1:3])
+        self.assertEqual(list(array('I', bytes(nuevo))), [ids[4], ids[1], ids[2], ids[3], ids[0]])
+        self.assertEqual(posicion, 1)
+
+        # Un mazo guardado (bytes) se copia una sola vez para poder cambiarlo
+        palabras, nuevo, _ = muestreador.robar(bytes(array('I', ids)), 0, excluir)
+        self.assertIsInstance(nuevo, bytearray)
+        self.assertEqual(palabras, muestreador.pares[4][1:3])
+
+    @override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+    def test_el_mazo_se_guarda_con_la_partida(self):
+        partida = crear_partida(4)
+        # Desde una vista: se escribe con la transición
+        transicion = Transicion(partida)
+        primero = elegir_palabras(transicion)
+        transicion.guardar()
+        guardada = GameSession.objects.get(id=partida.id)
+        self.assertEqual(guardada.posicion_mazo, 1)
+        self.assertEqual(len(bytes(guardada.mazo_palabras)), 5 * 4)
+
+        # Desde la sala en memoria: se vuelca con el resto de pendientes y sigue donde iba
+        sala = estado.cargar_sala(partida.codigo)
+        palabras, mazo, posicion = muestreador.robar(sala.mazo_palabras, sala.posicion_mazo, primero)
+        self.assertEqual(bytes(mazo), bytes(guardada.mazo_palabras))
+        sala.cambiar(mazo_palabras=mazo, posicion_mazo=posicion)
+        async_to_sync(estado.guardar_sala)(sala)
+        recargada = estado.cargar_sala(partida.codigo)
+        self.assertEqual(recargada.posicion_mazo, 2)
+        self.assertEqual(bytes(recargada.mazo_palabras), bytes(guardada.mazo_palabras))
+        siguiente, _, _ = muestreador.robar(recargada.mazo_palabras, recargada.posicion_mazo, palabras)
+        self.assertNotIn(siguiente, (primero, palabras))
+
+    def test_estadisticas_solo_staff(self):
+        partida = crear_partida(4)
+        self.client.force_login(partida.host)
+        url = reverse('blanco:estadisticas_palabras')
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        User.objects.filter(id=partida.host_id).update(is_staff=True)
+        muestreador.robar(None, 0)
+        respuesta = self.client.get(url)
+        self.assertEqual(respuesta.status_code, 200)
+        datos = respuesta.json()
+        self.assertEqual(datos['pares'], 5)
+        self.assertEqual(datos['categorias'], {'animales': 3, 'comida': 2})
+        # Robar del mazo no necesita la tabla de alias: solo se construye al sortear
+        self.assertEqual(datos['tabla_alias'], 0)
+        self.assertGreaterEqual(datos['mazos_barajados'], 1)
+
+        muestreador.sortear()
+        self.assertEqual(self.client.get(url).json()['tabla_alias'], 5)
+
+
+class FragmentosTests(TestCase):
+    """La vista de fragmentos devuelve renderizadas las partes pedidas de la página para cada jugador"""
+
+    def pedir(self, usuario, *nombres):
+        self.client.force_login(usuario)
+        return self.client.get(reverse('blanco:fragmentos', args=['FRAG']), {'f': nombres} if nombres else {})
+
+    def test_controles_solo_para_el_host(self):
+        partida = crear_partida(4, 'FRAG')
+        otro = User.objects.get(username='FRAG_jugador1')
+
+        respuesta = self.pedir(partida.host, 'controles', 'estado')
+        self.assertEqual(respuesta.status_code, 200)
+        datos = respuesta.json()
+        self.assertEqual(datos['version'], 0)
+        self.assertEqual(set(datos['fragmentos']), {'controles', 'estado'})
+        self.assertIn('Terminar partida', datos['fragmentos']['controles'])
+        self.assertIn('Empezar partida', datos['fragmentos']['controles'])
+
+        controles = self.pedir(otro, 'controles').json()['fragmentos']['controles']
+        self.assertNotIn('Terminar partida', controles)
+        self.assertNotIn('Empezar partida', controles)
+        self.assertEqual(controles.strip(), '<!-- Controles del host -->')
+
+        # Sin ?f= se devuelven todos; los desconocidos se ignoran
+        self.assertEqual(set(self.pedir(otro).json()['fragmentos']), set(fragmentos.FRAGMENTOS))
+        self.assertEqual(self.pedir(otro, 'nada').json()['fragmentos'], {})
+
+    def test_palabra_de_cada_jugador_y_ajenos(self):
+        partida = crear_partida(4, 'FRAG')
+        otro = User.objects.get(username='FRAG_jugador1')
+        GameSession.objects.filter(pk=partida.pk).update(estado='en_juego', ronda_actual=1, ronda_terminada=True)
+        GamePlayer.objects.filter(session=partida).update(palabra_secreta='Gato', es_bueno=True)
+        GamePlayer.objects.filter(session=partida, user=otro).update(palabra_secreta='Perro', es_bueno=False,
+                                                                    es_infiltrado=True)
+
+        anfitrion = self.pedir(partida.host, 'palabra', 'controles').json()['fragmentos']
+        self.assertIn('Gato', anfitrion['palabra'])
+        self.assertIn('Nueva ronda de palabras', anfitrion['controles'])
+        del_otro = self.pedir(otro, 'palabra', 'controles').json()['fragmentos']
+        self.assertIn('Perro', del_otro['palabra'])
+        self.assertNotIn('Gato', del_otro['palabra'])
+        self.assertNotIn('Nueva ronda de palabras', del_otro['controles'])
+
+        # Solo los jugadores de la partida
+        self.assertEqual(self.pedir(User.objects.create_user('ajeno'), 'palabra').status_code, 403)
+
+
+@skipUnless(metricas.ACTIVAS, 'Métricas desactivadas (BLANCO_METRICAS)')
+class MetricasTests(TestCase):
+    """Las vistas quedan medidas con sus consultas y se exponen solo al staff"""
+
+    def test_metricas_de_vistas(self):
+        partida = crear_partida(4)
+        self.client.force_login(partida.host)
+        self.client.get(reverse('blanco:partida', args=[partida.codigo]))
+        self.assertEqual(self.client.get(reverse('blanco:metricas')).status_code, 403)
+
+        User.objects.filter(id=partida.host_id).update(is_staff=True)
+        respuesta = self.client.get(reverse('blanco:metricas'))
+        self.assertEqual(respuesta.status_code, 200)
+        texto = respuesta.content.decode()
+        self.assertIn('blanco_vista_segundos_count{vista="blanco:partida",metodo="GET"}', texto)
+        serie = metricas.VISTAS.consultas.series[('blanco:partida', 'GET')]
+        # Las consultas de la vista se han contado (la suma de la serie)
+        self.assertGreater(serie[-2], 0)
@@ -0,0 +1,414 @@
+"""
+Pruebas de rendimiento de las vistas, de los handlers de PartidaConsumer, del
+traspaso de salas al drenar un trabajador (reparto.py) y de las reglas de la
+ronda (reglas.py), estas sin base de datos.
+
+Cada operación se ejecuta en salas de 4, 9 y 30 jugadores con el mismo
+número fijo de consultas (assertNumQueries), así que una consulta dentro de
+un bucle sobre los jugadores hace fallar la prueba. Después se cronometra
+REPETICIONES veces; los tiempos de cada tamaño muestran cómo crece el coste
+de cada acción (y de su difusión a todos los jugadores) con la sala. Con BLANCO_RENDIMIENTO_HISTORIAL definido, los tiempos se
+añaden a ese fichero al terminar y `manage.py comparar_rendimiento` avisa de
+las operaciones que se han vuelto más lentas:
+
+    BLANCO_RENDIMIENTO_HISTORIAL=rendimiento.json python manage.py test blanco.tests_rendimiento
+    python manage.py comparar_rendimiento --historial rendimiento.json --umbral 20
+
+Los tiempos son los de la base de datos configurada: SQLite en memoria por
+defecto o PostgreSQL si DATABASE_URL apunta a uno (p. ej. uno local en Docker).
+"""
+import asyncio
+import itertools
+import json
+import time
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from . import difusion, estado, reglas, rendimiento, reparto
+from .consumers import PartidaConsumer
+from .models import GameSession, GamePlayer, PalabraPar
+from .palabras import muestreador
+
+# Los extremos de las salas de 4 a 9 jugadores y las más grandes que admite roles.py
+TAMANOS = (4, 9, 30)
+
+_codigos = itertools.count()
+_resultados = {}
+
+
+def tearDownModule():
+    if rendimiento.HISTORIAL and _resultados:
+        rendimiento.registrar(rendimiento.HISTORIAL, connection.vendor, _resultados)
+
+
+async def descartar(mensaje):
+    """base_send de los consumers de prueba: lo que se enviaría al cliente se tira"""
+
+
+async def cronometrar(operacion, argumentos):
+    inicio = time.perf_counter()
+    await operacion(*argumentos)
+    return time.perf_counter() - inicio
+
+
+class RendimientoTestCase(TestCase):
+
+    def setUp(self):
+        PalabraPar.objects.bulk_create([
+            PalabraPar(palabra_buena=f'Buena{i}', palabra_infiltrado=f'Infiltrada{i}') for i in range(20)
+        ])
+        muestreador.cargar()
+
+    def tearDown(self):
+        muestreador.invalidar()
+        async_to_sync(get_channel_layer().flush)()
+
+    def crear_sala(self, n, en_juego=False):
+        """Partida con n jugadores; en juego: el último es el impostor, el penúltimo el infiltrado"""
+        codigo = f'R{next(_codigos):05d}'
+        usuarios = User.objects.bulk_create([User(username=f'{codigo}_{i}') for i in range(n)])
+        partida = GameSession.objects.create(codigo=codigo, host=usuarios[0])
+        jugadores = GamePlayer.objects.bulk_create([GamePlayer(session=partida, user=u) for u in usuarios])
+        if en_juego:
+            GameSession.objects.filter(id=partida.id).update(
+                estado='en_juego', palabra_impostor='Gato', palabra_buena_actual='Gato',
+                palabra_infiltrado_actual='Perro',
+            )
+            partida.refresh_from_db()
+            GamePlayer.objects.filter(id__in=[j.id for j in jugadores[:-2]]).update(
+                es_bueno=True, palabra_secreta='Gato'
+            )
+            GamePlayer.objects.filter(id=jugadores[-2].id).update(es_infiltrado=True, palabra_secreta='Perro')
+            GamePlayer.objects.filter(id=jugadores[-1].id).update(es_impostor=True)
+        return partida, usuarios
+
+    def consumer(self, partida, usuario):
+        """PartidaConsumer de un jugador ya conectado, sin conexión real"""
+        consumer = PartidaConsumer()
+        consumer.scope = {'type': 'websocket', 'user': usuario, 'url_route': {'kwargs': {'codigo': partida.codigo}}}
+        consumer.codigo = partida.codigo
+        consumer.room_group_name = f'partida_{partida.codigo}'
+        consumer.channel_layer = get_channel_layer()
+        consumer.channel_name = f'rendimiento.{partida.codigo}'
+        consumer.salida = []
+        consumer.compacto = consumer.comprimido = False
+        consumer.base_send = descartar
+        async_to_sync(estado.conectar)(partida.codigo, usuario.id, consumer.channel_name)
+        # Los demás jugadores también están conectados: la difusión llega a todos
+        for user_id in partida.players.exclude(user=usuario).values_list('user_id', flat=True):
+            async_to_sync(estado.conectar)(partida.codigo, user_id, f'{consumer.channel_name}.{user_id}')
+        self.addCleanup(estado.descartar_sala, partida.codigo)
+        return consumer
+
+    def medir(self, nombre, consultas, preparar, operacion):
+        """
+        Ejecuta la operación con cada tamaño de sala: la primera vez comprueba sus
+        consultas y las REPETICIONES siguientes la cronometran. preparar(n) devuelve
+        los argumentos de cada ejecución y no cuenta en el tiempo.
+        """
+        for n in TAMANOS:
+            with self.subTest(operacion=nombre, jugadores=n):
+                tiempos = []
+                for repeticion in range(rendimiento.REPETICIONES + 1):
+                    argumentos = preparar(n)
+                    if repeticion == 0:
+                        with self.assertNumQueries(consultas):
+                            self.ejecutar(operacion, argumentos)
+                    else:
+                        tiempos.append(self.ejecutar(operacion, argumentos))
+                _resultados[f'{nombre} [{n}]'] = rendimiento.resumir(tiempos, consultas)
+
+    def ejecutar(self, operacion, argumentos):
+        if asyncio.iscoroutinefunction(operacion):
+            # Solo la corrutina: crear el bucle de eventos no es parte de la operación
+            return async_to_sync(cronometrar)(operacion, argumentos)
+        inicio = time.perf_counter()
+        operacion(*argumentos)
+        return time.perf_counter() - inicio
+
+
+class VistasRendimientoTests(RendimientoTestCase):
+    """Consultas y tiempo de las vistas (sesión y usuario incluidos)"""
+
+    def entrar(self, usuario):
+        self.client.force_login(usuario)
+
+    def test_crear_partida(self):
+        def preparar(n):
+            self.entrar(User.objects.create(username=f'creador{next(_codigos)}'))
+            return ()
+
+        # Sesión, usuario, INSERT de la partida y del jugador
+        self.medir('crear_partida', 4, preparar, lambda: self.client.get(reverse('blanco:crear')))
+
+    def test_unirse_partida(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n)
+            self.entrar(User.objects.create(username=f'invitado{next(_codigos)}'))
+            return (partida.codigo,)
+
+        def unirse(codigo):
+            respuesta = self.client.post(reverse('blanco:unirse'), {'codigo': codigo})
+            self.assertEqual(respuesta.status_code, 302)
+
+        # Sesión, usuario y partida por código
+        self.medir('unirse_partida', 3, preparar, unirse)
+
+    def test_partida_get(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n)
+            self.entrar(usuarios[0])
+            return (partida.codigo,)
+
+        def ver(codigo):
+            respuesta = self.client.get(reverse('blanco:partida', args=[codigo]))
+            self.assertEqual(respuesta.status_code, 200)
+
+        self.medir('partida GET', 8, preparar, ver)
+
+    def test_partida_post_empezar(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n)
+            self.entrar(usuarios[0])
+            return (partida.codigo,)
+
+        def empezar(codigo):
+            self.client.post(reverse('blanco:partida', args=[codigo]), {'empezar_partida': '1'})
+
+        self.medir('partida POST empezar_partida', 17, preparar, empezar)
+
+    def test_partida_post_eliminar(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n, en_juego=True)
+            self.entrar(usuarios[0])
+            return (partida.codigo, usuarios[1].id)
+
+        def eliminar(codigo, user_id):
+            self.client.post(reverse('blanco:partida', args=[codigo]), {'eliminar_ronda': str(user_id)})
+
+        self.medir('partida POST eliminar_ronda', 15, preparar, eliminar)
+
+    def test_partida_post_adivinar(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n, en_juego=True)
+            GamePlayer.objects.filter(session=partida, user=usuarios[-1]).update(eliminado=True)
+            self.entrar(usuarios[-1])
+            return (partida.codigo,)
+
+        def adivinar(codigo):
+            self.client.post(reverse('blanco:partida', args=[codigo]),
+                             {'adivinar_palabra': '1', 'palabra_adivinada': 'gato'})
+
+        self.medir('partida POST adivinar_palabra', 17, preparar, adivinar)
+
+    def test_logout(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n)
+            self.entrar(usuarios[-1])
+            return ()
+
+        self.medir('logout_view', 7, preparar, lambda: self.client.get(reverse('logout')))
+
+
+@override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+class HandlersRendimientoTests(RendimientoTestCase):
+    """
+    Consultas y tiempo de cada handle_* de PartidaConsumer con la sala ya en
+    memoria, incluidos la difusión agrupada y la escritura que dejan pendientes.
+    Las consultas van por el hilo de channels: los de ejecutores.py no verían
+    la transacción de la prueba.
+    """
+
+    @staticmethod
+    async def accion(consumer, tipo, datos):
+        async with estado.candado(consumer.codigo):
+            await consumer.atender(tipo, datos)
+        # Lo que el handler deja para el siguiente tick es parte del coste de la acción
+        await difusion.vaciar(consumer.codigo)
+        await consumer.vaciar_salida()
+        sala = estado.sala_en_memoria(consumer.codigo)
+        if sala is not None:
+            if sala.guardado_programado is not None:
+                sala.guardado_programado.cancel()
+            await estado.guardar_sala(sala)
+
+    def medir_handler(self, tipo, consultas, preparar):
+        def preparar_consumer(n):
+            consumer, datos = preparar(n)
+            return consumer, tipo, datos
+
+        self.medir(f'PartidaConsumer.handle_{tipo}', consultas, preparar_consumer, self.accion)
+
+    def test_handle_iniciar_partida(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n)
+            return self.consumer(partida, usuarios[0]), {}
+
+        self.medir_handler('iniciar_partida', 4, preparar)
+
+    def test_handle_eliminar_jugador(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n, en_juego=True)
+            jugador = GamePlayer.objects.get(session=partida, user=usuarios[1])
+            return self.consumer(partida, usuarios[0]), {'jugador_id': jugador.id}
+
+        # Un único UPDATE ... CASE de los jugadores, sin transacción
+        self.medir_handler('eliminar_jugador', 1, preparar)
+
+    def test_handle_adivinar_palabra(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n, en_juego=True)
+            GamePlayer.objects.filter(session=partida, user=usuarios[-1]).update(eliminado=True)
+            return self.consumer(partida, usuarios[-1]), {'palabra_adivinada': 'Gato'}
+
+        self.medir_handler('adivinar_palabra', 5, preparar)
+
+    def test_handle_nueva_ronda(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n, en_juego=True)
+            GameSession.objects.filter(id=partida.id).update(ronda_terminada=True)
+            return self.consumer(partida, usuarios[0]), {}
+
+        self.medir_handler('nueva_ronda', 4, preparar)
+
+    def test_handle_terminar_partida(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n, en_juego=True)
+            return self.consumer(partida, usuarios[0]), {}
+
+        # Un único UPDATE de la partida, sin transacción
+        self.medir_handler('terminar_partida', 1, preparar)
+
+    def test_handle_expulsar_jugador(self):
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n)
+            return self.consumer(partida, usuarios[0]), {'user_id': usuarios[-1].id}
+
+        # Solo el DELETE del jugador: lo demás ya está en memoria
+        self.medir_handler('expulsar_jugador', 1, preparar)
+
+    def test_enviar_snapshot(self):
+        """El snapshot con fragmentos que responde a un refresh_request, con la sala en memoria"""
+        async def snapshot(consumer):
+            await consumer.enviar_snapshot(con_fragmentos=True)
+            await consumer.vaciar_salida()
+
+        def preparar(n):
+            partida, usuarios = self.crear_sala(n, en_juego=True)
+            return (self.consumer(partida, usuarios[0]),)
+
+        self.medir('PartidaConsumer.enviar_snapshot', 0, preparar, snapshot)
+
+
+@override_settings(BLANCO_HILOS_LECTURA=0, BLANCO_HILOS_ESCRITURA=0)
+class TraspasoRendimientoTests(RendimientoTestCase):
+    """
+    Drenado de un trabajador (reparto.traspasar_salas): cada sala se vuelca a la
+    base de datos antes de mandar a sus clientes con el nuevo dueño, que la
+    carga desde ahí. Este proceso es w1 y, al drenarlo, todas pasan a w2.
+    """
+
+    TRABAJADORES = {'w1': 'ws://uno:8001', 'w2': 'ws://dos:8002'}
+
+    def setUp(self):
+        super().setUp()
+        trabajadores = mock.patch.multiple(
+            reparto, TRABAJADORES=self.TRABAJADORES, TRABAJADOR='w1',
+            _anillo=reparto.AnilloConsistente(self.TRABAJADORES), _drenados=set(),
+        )
+        trabajadores.start()
+        self.addCleanup(trabajadores.stop)
+
+    @staticmethod
+    async def escuchar(codigo):
+        """Canal unido al grupo de la sala, como el de un cliente conectado"""
+        capa = get_channel_layer()
+        canal = await capa.new_channel()
+        await capa.group_add(f'partida_{codigo}', canal)
+        return canal
+
+    def sala_por_drenar(self, n):
+        """Sala en memoria con un cambio sin volcar, en w1 justo antes de drenarlo"""
+        for sala in estado.salas_activas():
+            estado.descartar_sala(sala.codigo)
+        reparto.marcar_activo('w1')
+        partida, usuarios = self.crear_sala(n)
+        consumer = self.consumer(partida, usuarios[0])
+        canal = async_to_sync(self.escuchar)(partida.codigo)
+        estado.sala_en_memoria(partida.codigo).cambiar(ronda_actual=2)
+        reparto.marcar_drenado('w1')
+        return partida, usuarios, consumer, canal
+
+    def test_traspasar_salas(self):
+        async def traspasar(codigo, canal):
+            await reparto.traspasar_salas()
+            mensaje = await get_channel_layer().receive(canal)
+            self.assertEqual(mensaje, {'type': 'sala_trasladada', 'url': f'ws://dos:8002/ws/partida/{codigo}/'})
+
+        def preparar(n):
+            partida, _, _, canal = self.sala_por_drenar(n)
+            return partida.codigo, canal
+
+        # El UPDATE de lo pendiente de la sala
+        self.medir('reparto.traspasar_salas', 1, preparar, traspasar)
+
+    def test_vuelca_antes_de_mandar_al_nuevo_dueno(self):
+        partida, usuarios, consumer, canal = self.sala_por_drenar(4)
+        sala = estado.sala_en_memoria(partida.codigo)
+        capa = get_channel_layer()
+        group_send = capa.group_send
+        pendientes_al_avisar = []
+
+        async def anotar(grupo, mensaje):
+            pendientes_al_avisar.append(bool(sala.pendientes_sala))
+            await group_send(grupo, mensaje)
+
+        with mock.patch.object(capa, 'group_send', anotar):
+            async_to_sync(reparto.traspasar_salas)()
+        self.assertEqual(pendientes_al_avisar, [False])
+        self.assertEqual(GameSession.objects.get(id=partida.id).ronda_actual, 2)
+
+        # El consumer pasa el aviso a su cliente y cierra para que se reconecte al nuevo dueño
+        enviados = []
+
+        async def enviar(mensaje):
+            enviados.append(mensaje)
+
+        consumer.base_send = enviar
+        async_to_sync(consumer.sala_trasladada)(async_to_sync(capa.receive)(canal))
+        url = f'ws://dos:8002/ws/partida/{partida.codigo}/'
+        self.assertEqual(json.loads(enviados[0]['text']), {'type': 'redirigir', 'url': url})
+        self.assertEqual(enviados[-1], {'type': 'websocket.close', 'code': 4000})
+
+        # En w2 la sala es local y se carga de la base de datos con lo que volcó w1
+        estado.descartar_sala(partida.codigo)
+        with mock.patch.object(reparto, 'TRABAJADOR', 'w2'):
+            self.assertTrue(reparto.es_local(partida.codigo))
+            self.assertEqual(reparto.url_websocket(partida.codigo), url)
+            nueva = async_to_sync(estado.conectar)(partida.codigo, usuarios[0].id, 'nuevo')
+        self.assertIsNot(nueva, sala)
+        self.assertEqual(nueva.ronda_actual, 2)
+
+
+class ReglasRendimientoTests(RendimientoTestCase):
+    """Las reglas solo recorren la foto: ninguna consulta y tiempo lineal en los jugadores"""
+
+    @staticmethod
+    def foto(n, eliminados=()):
+        """Como crear_sala en juego: el último es el impostor y el penúltimo el infiltrado"""
+        roles = ['bueno'] * (n - 2) + ['infiltrado', 'impostor']
+        return reglas.Foto('Gato', False, tuple(
+            reglas.Jugador(i, rol, i in eliminados, False) for i, rol in enumerate(roles)
+        ))
+
+    def test_eliminar(self):
+        self.medir('reglas.eliminar', 0, lambda n: (self.foto(n), 0), reglas.eliminar)
+
+    def test_adivinar(self):
+        self.medir('reglas.adivinar', 0, lambda n: (self.foto(n, eliminados={n - 1}), n - 1, 'gato'), reglas.adivinar)
@@ -8,4 +8,9 @@ urlpatterns = [
     path('crear/', views.crear_partida, name='crear'),
     path('unirse/', views.unirse_partida, name='unirse'),
     path('partida/<str:codigo>/', views.partida, name='partida'),
+    path('partida/<str:codigo>/fragmentos/', views.partida_fragmentos, name='fragmentos'),
+    path('palabras/estadisticas/', views.estadisticas_palabras, name='estadisticas_palabras'),
+    path('difusion/estadisticas/', views.estadisticas_difusion, name='estadisticas_difusion'),
+    path('protocolo/estadisticas/', views.estadisticas_protocolo, name='estadisticas_protocolo'),
+    path('metricas/', views.metricas_prometheus, name='metricas'),
 ]
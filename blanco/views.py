@@ -1,6 +1,11 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import HttpResponse
-from .models import GameSession, GamePlayer, PalabraPar
+from django.http import HttpResponse, JsonResponse, HttpResponseForbidden, HttpResponseNotFound
+from .models import GameSession, GamePlayer
+from .estado import invalidar_sala, sala_en_memoria, salas_activas, SalaEstado, Transicion
+from . import difusion, fragmentos, metricas, protocolo, reglas, reparto
+from .palabras import muestreador
+from .limpieza import borrar_partidas_vacias
+from .roles import repartir
 import secrets
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth import login
@@ -9,40 +14,26 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.auth import logout as auth_logout
 from django.views.decorators.http import require_POST
-import random
 from django.contrib import messages
-import unicodedata
-import re
+from django.db import transaction
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
 import json
 
 # Create your views here.
 
-def normalizar_texto(texto):
-    """Normaliza texto: convierte a minúsculas y quita acentos"""
-    # Convertir a minúsculas
-    texto = texto.lower()
-    # Normalizar unicode (quitar acentos)
-    texto = unicodedata.normalize('NFD', texto)
-    # Quitar caracteres diacríticos (acentos)
-    texto = re.sub(r'[^\w\s]', '', texto)
-    # Quitar espacios extra
-    texto = texto.strip()
-    return texto
+def enviar_actualizacion_websocket(codigo_partida, escritos=None):
+    """Avisa a los clientes conectados de que la partida ha cambiado desde una vista.
 
-def enviar_actualizacion_websocket(codigo_partida, tipo_mensaje, datos=None):
-    """Envía una actualización a todos los clientes conectados a la partida"""
+    Los consumidores recargan la sala y publican las diferencias como un delta versionado.
+    escritos son los campos que ha escrito la vista (Transicion.escritos).
+    """
+    marca = secrets.token_hex(8)
+    invalidar_sala(codigo_partida, marca, escritos)
     channel_layer = get_channel_layer()
     async_to_sync(channel_layer.group_send)(
         f'partida_{codigo_partida}',
-        {
-            'type': 'partida_message',
-            'message': {
-                'type': tipo_mensaje,
-                'data': datos
-            }
-        }
+        {'type': 'sala_modificada', 'marca': marca, 'escritos': escritos}
     )
 
 @login_required
@@ -71,112 +62,55 @@ def unirse_partida(request):
         return redirect('blanco:partida', codigo=partida.codigo)
     return render(request, 'blanco/unirse.html')
 
-def asignar_roles_y_palabras(partida, palabra_buena, palabra_infiltrado):
+def elegir_palabras(transicion):
+    """Saca el siguiente par del mazo de la partida, evitando las palabras de la ronda actual.
+
+    El mazo y su posición se guardan con el resto de cambios de la transición.
+    """
+    partida = transicion.partida
+    ultimas = [p for p in (partida.palabra_buena_actual, partida.palabra_infiltrado_actual) if p]
+    palabras, mazo, posicion = muestreador.robar(partida.mazo_palabras, partida.posicion_mazo, ultimas)
+    transicion.cambiar(mazo_palabras=mazo, posicion_mazo=posicion)
+    return palabras or ("Gato", "Perro")
+
+def asignar_roles_y_palabras(transicion, palabra_buena, palabra_infiltrado):
     """Asigna roles y palabras a todos los jugadores de la partida"""
-    players = list(partida.players.all())
+    partida = transicion.partida
+    players = transicion.jugadores()
     n = len(players)
     
-    # Definir distribución de roles según número de jugadores
-    if n == 4:
-        roles = ['bueno']*3 + ['infiltrado']
-    elif n == 5:
-        roles = ['bueno']*3 + ['infiltrado'] + ['impostor']
-    elif n == 6:
-        roles = ['bueno']*4 + ['infiltrado'] + ['impostor']
-    elif n == 7:
-        roles = ['bueno']*4 + ['infiltrado']*2 + ['impostor']
-    elif n == 8:
-        roles = ['bueno']*5 + ['infiltrado']*2 + ['impostor']
-    elif n == 9:
-        roles = ['bueno']*5 + ['infiltrado']*2 + ['impostor']*2
-    else:
+    # Roles ya barajados según el número de jugadores (roles.py)
+    roles = repartir(n)
+    if roles is None:
         return False, "Número de jugadores no soportado."
     
-    random.shuffle(roles)
-    
+    # Solo se anotan los campos que cambian; se escriben todos juntos al guardar la transición
     for player, rol in zip(players, roles):
-        player.eliminado = False
-        player.es_impostor = False
-        player.es_infiltrado = False
-        player.es_bueno = False
-        player.ya_intento_adivinar = False  # Resetear el intento de adivinación
-        
         if rol == 'bueno':
-            player.palabra_secreta = palabra_buena
-            player.es_bueno = True
+            palabra_secreta = palabra_buena
         elif rol == 'infiltrado':
-            player.palabra_secreta = palabra_infiltrado
-            player.es_infiltrado = True
+            palabra_secreta = palabra_infiltrado
         else:  # impostor
-            player.palabra_secreta = "Tú no tienes palabra, eres el impostor."
-            player.es_impostor = True
+            palabra_secreta = "Tú no tienes palabra, eres el impostor."
         
-        player.ronda_actual = partida.ronda_actual
-        player.save()
+        transicion.cambiar_jugador(
+            player,
+            eliminado=False,
+            es_impostor=rol == 'impostor',
+            es_infiltrado=rol == 'infiltrado',
+            es_bueno=rol == 'bueno',
+            ya_intento_adivinar=False,  # Resetear el intento de adivinación
+            palabra_secreta=palabra_secreta,
+            ronda_actual=partida.ronda_actual,
+        )
     
     return True, "Roles asignados correctamente."
 
-def calcular_puntos_ronda(partida):
-    """Calcula y asigna puntos según el resultado de la ronda"""
-    jugadores_activos = [p for p in partida.players.all() if not p.eliminado]
-    
-    # Contar roles de los jugadores activos
-    buenos_activos = [p for p in jugadores_activos if p.es_bueno]
-    infiltrados_activos = [p for p in jugadores_activos if p.es_infiltrado]
-    impostores_activos = [p for p in jugadores_activos if p.es_impostor]
-    
-    # Lógica de puntos según el resultado
-    if len(jugadores_activos) == 2:  # Llegaron a 1 vs 1
-        # Asignar puntos según la combinación en el 1 vs 1
-        if len(impostores_activos) == 2:
-            # Dos impostores en el 1 vs 1, cada uno gana 3 puntos
-            for player in impostores_activos:
-                player.puntos += 3
-                player.save()
-            return f"Puntos asignados. Dos impostores, cada uno gana 3 puntos."
-        elif len(impostores_activos) == 1 and len(infiltrados_activos) == 1:
-            # Un impostor y un infiltrado en el 1 vs 1
-            for player in impostores_activos:
-                player.puntos += 3
-                player.save()
-            for player in infiltrados_activos:
-                player.puntos += 2
-                player.save()
-            return f"Puntos asignados. Un impostor y un infiltrado: impostor 3 puntos, infiltrado 2 puntos."
-        elif len(impostores_activos) == 1 and len(buenos_activos) == 1:
-            # Un impostor y un bueno en el 1 vs 1
-            for player in impostores_activos:
-                player.puntos += 3
-                player.save()
-            return f"Puntos asignados. Un impostor y un bueno: impostor 3 puntos."
-        elif len(infiltrados_activos) == 2:
-            # Dos infiltrados en el 1 vs 1, cada uno gana 2 puntos
-            for player in infiltrados_activos:
-                player.puntos += 2
-                player.save()
-            return f"Puntos asignados. Dos infiltrados, cada uno gana 2 puntos."
-        elif len(infiltrados_activos) == 1 and len(buenos_activos) == 1:
-            # Un infiltrado y un bueno, el infiltrado gana 2 puntos, el bueno 0
-            for player in infiltrados_activos:
-                player.puntos += 2
-                player.save()
-            return f"Puntos asignados. Un infiltrado y un bueno, el infiltrado gana 2 puntos."
-        elif len(buenos_activos) == 2:
-            # Dos buenos en el 1 vs 1, cada uno gana 1 punto
-            for player in buenos_activos:
-                player.puntos += 1
-                player.save()
-            return f"Puntos asignados. Dos buenos, cada uno gana 1 punto."
-    else:  # No llegaron a 1 vs 1
-        # Los buenos ganan si eliminaron a todos los infiltrados e impostores
-        if len(infiltrados_activos) == 0 and len(impostores_activos) == 0:
-            # Buenos ganan 1 punto cada uno
-            for player in buenos_activos:
-                player.puntos += 1
-                player.save()
-            return f"Puntos asignados. Solo quedan buenos, cada uno gana 1 punto."
-    
-    return f"Puntos asignados. Buenos activos: {len(buenos_activos)}, Infiltrados activos: {len(infiltrados_activos)}, Impostores activos: {len(impostores_activos)}"
+def calcular_puntos_ronda(transicion):
+    """Calcula y asigna puntos según los jugadores que siguen activos"""
+    resultado = reglas.puntos(transicion.foto())
+    reglas.aplicar(resultado, transicion)
+    return f"Puntos asignados. {reglas.mensaje(resultado)}".strip()
 
 @login_required
 def partida(request, codigo):
@@ -199,314 +133,188 @@ def partida(request, codigo):
         gameplayer.puntos = 0
         gameplayer.ronda_actual = partida.ronda_actual
         gameplayer.save()
+        # La sala puede estar en memoria en otro trabajador: el aviso llega a su dueño por la capa de canales
+        enviar_actualizacion_websocket(partida.codigo)
     
-    jugadores = partida.players.select_related('user').all()
     es_host = partida.host == request.user
     puede_empezar = es_host and partida.players.count() >= 4 and partida.estado != 'en_juego'
     mensaje = None
     
-    # Obtener palabras aleatorias de la base de datos
-    try:
-        par_palabras = PalabraPar.objects.order_by('?').first()
-        palabra_buena = par_palabras.palabra_buena if par_palabras else "Gato"
-        palabra_infiltrado = par_palabras.palabra_infiltrado if par_palabras else "Perro"
-    except:
-        palabra_buena = "Gato"
-        palabra_infiltrado = "Perro"
-    
     if request.method == 'POST':
-        # Expulsar jugador de la sala (solo antes del juego)
-        if 'expulsar' in request.POST and es_host and partida.estado != 'en_juego':
-            user_id = request.POST.get('expulsar')
-            if user_id and str(request.user.id) != user_id:
-                GamePlayer.objects.filter(session=partida, user_id=user_id).delete()
-                mensaje = 'Jugador expulsado de la sala.'
-                # Enviar actualización WebSocket
-                enviar_actualizacion_websocket(partida.codigo, 'partida_updated')
+        # Las acciones por WebSocket se vuelcan con retardo: lo que la sala tenga pendiente en memoria
+        # se escribe antes de leer la partida para que las reglas se calculen sobre el estado real
+        async_to_sync(reparto.volcar_sala)(partida.codigo)
+        # Bloquear la fila de la partida: las acciones concurrentes sobre la misma sala se aplican
+        # de una en una y cada una ve los puntos y eliminaciones que ha dejado la anterior
+        with transaction.atomic():
+            partida = GameSession.objects.select_for_update().get(id=partida.id)
+            es_host = partida.host_id == request.user.id
+            puede_empezar = es_host and partida.players.count() >= 4 and partida.estado != 'en_juego'
+            
+            # Los jugadores se leen una vez y los cambios de la acción se escriben juntos al final
+            transicion = Transicion(partida)
+            notificar = False
         
-        # Eliminar jugador de la ronda (durante el juego)
-        elif 'eliminar_ronda' in request.POST and es_host and partida.estado == 'en_juego' and not partida.ronda_terminada:
-            user_id = request.POST.get('eliminar_ronda')
-            if user_id:
-                player_to_eliminate = GamePlayer.objects.get(session=partida, user_id=user_id)
-                player_to_eliminate.eliminado = True
-                player_to_eliminate.save()
-                
-                # Determinar el rol del jugador eliminado para el mensaje
-                rol_eliminado = ""
-                if player_to_eliminate.es_impostor:
-                    rol_eliminado = "impostor"
-                elif player_to_eliminate.es_infiltrado:
-                    rol_eliminado = "infiltrado"
-                elif player_to_eliminate.es_bueno:
-                    rol_eliminado = "bueno"
-                
-                mensaje = f'{player_to_eliminate.user.username} eliminado de la ronda. Era {rol_eliminado}.'
-                
-                # Verificar si llegamos a 1 vs 1 o si se acabó la ronda
-                jugadores_activos = [p for p in partida.players.all() if not p.eliminado]
-                
-                # Verificar si se eliminaron todos los malos (infiltrados e impostores)
-                infiltrados_activos = [p for p in jugadores_activos if p.es_infiltrado]
-                impostores_activos = [p for p in jugadores_activos if p.es_impostor]
-                
-                # Verificar si hay impostores eliminados que pueden adivinar
-                impostores_eliminados = [p for p in partida.players.all() if p.eliminado and p.es_impostor and not p.ya_intento_adivinar]
-                
-                if len(infiltrados_activos) == 0 and len(impostores_activos) == 0:
-                    if len(impostores_eliminados) > 0:
-                        # Hay impostores eliminados que pueden adivinar, no terminar la ronda aún
-                        mensaje += f' Todos los malos han sido eliminados, pero hay impostores que pueden intentar adivinar la palabra.'
-                    else:
-                        # No hay impostores que puedan adivinar, los buenos ganan
-                        buenos_activos = [p for p in jugadores_activos if p.es_bueno]
-                        for player in buenos_activos:
-                            player.puntos += 1
-                            player.save()
-                        partida.ronda_terminada = True
-                        partida.save()
-                        mensaje += f' ¡Los buenos han ganado! Todos los malos han sido eliminados. Los buenos activos ganan 1 punto cada uno.'
-                        # Enviar actualización WebSocket
-                        enviar_actualizacion_websocket(partida.codigo, 'partida_updated')
-                elif len(jugadores_activos) == 2:
-                    # Verificar si hay impostores eliminados que pueden adivinar
-                    impostores_eliminados = [p for p in partida.players.all() if p.eliminado and p.es_impostor and not p.ya_intento_adivinar]
-                    
-                    if len(impostores_eliminados) > 0:
-                        # Hay impostores eliminados que pueden adivinar, no terminar la ronda aún
-                        mensaje += f' ¡Llegamos a 1 vs 1! Hay impostores eliminados que pueden intentar adivinar la palabra antes de asignar puntos.'
-                    else:
-                        # No hay impostores que puedan adivinar, calcular puntos y terminar ronda
-                        puntos_msg = calcular_puntos_ronda(partida)
-                        partida.ronda_terminada = True
-                        partida.save()
-                        mensaje += f' ¡Llegamos a 1 vs 1! {puntos_msg}'
-                elif len(jugadores_activos) == 1:
-                    # Solo queda uno, calcular puntos y terminar ronda
-                    puntos_msg = calcular_puntos_ronda(partida)
-                    partida.ronda_terminada = True
-                    partida.save()
-                    mensaje += f' ¡Solo queda un jugador! {puntos_msg}'
+            # Expulsar jugador de la sala (solo antes del juego)
+            if 'expulsar' in request.POST and es_host and partida.estado != 'en_juego':
+                user_id = request.POST.get('expulsar')
+                if user_id and str(request.user.id) != user_id:
+                    GamePlayer.objects.filter(session=partida, user_id=user_id).delete()
+                    mensaje = 'Jugador expulsado de la sala.'
+                    notificar = True
         
-        # Terminar partida
-        elif 'terminar' in request.POST and es_host:
-            partida.delete()
-            return redirect('home')
+            # Eliminar jugador de la ronda (durante el juego)
+            elif 'eliminar_ronda' in request.POST and es_host and partida.estado == 'en_juego' and not partida.ronda_terminada:
+                user_id = request.POST.get('eliminar_ronda')
+                player_to_eliminate = transicion.jugador_de_usuario(user_id) if user_id else None
+                resultado = reglas.eliminar(transicion.foto(), player_to_eliminate.id) if player_to_eliminate else None
+                if resultado is not None:
+                    # Las mismas reglas que la sala en memoria: eliminación, fin de ronda y puntos
+                    reglas.aplicar(resultado, transicion)
+                    rol_eliminado = reglas.rol(player_to_eliminate) or ''
+                    mensaje = f'{player_to_eliminate.user.username} eliminado de la ronda. Era {rol_eliminado}.'
+                    if resultado.codigos:
+                        mensaje += ' ' + reglas.mensaje(resultado)
+                    notificar = True
         
-        # Empezar partida
-        elif 'empezar_partida' in request.POST and puede_empezar:
-            # Obtener nuevas palabras para la primera ronda
-            try:
-                par_palabras = PalabraPar.objects.order_by('?').first()
-                palabra_buena = par_palabras.palabra_buena if par_palabras else "Gato"
-                palabra_infiltrado = par_palabras.palabra_infiltrado if par_palabras else "Perro"
-            except:
-                palabra_buena = "Gato"
-                palabra_infiltrado = "Perro"
-            
-            # Asignar roles y palabras
-            success, msg = asignar_roles_y_palabras(partida, palabra_buena, palabra_infiltrado)
-            if not success:
-                mensaje = msg
-                return render(request, 'blanco/partida.html', {
-                    'partida': partida,
-                    'jugadores': jugadores,
-                    'es_host': es_host,
-                    'puede_empezar': puede_empezar,
-                    'mensaje': mensaje,
-                })
-            
-            partida.estado = 'en_juego'
-            partida.palabra_impostor = palabra_buena
-            partida.palabra_buena_actual = palabra_buena
-            partida.palabra_infiltrado_actual = palabra_infiltrado
-            partida.ronda_terminada = False
-            partida.ronda_actual = 1
-            partida.save()
-            mensaje = '¡La partida ha comenzado!'
-            # Enviar actualización WebSocket
-            enviar_actualizacion_websocket(partida.codigo, 'partida_updated')
+            # Terminar partida
+            elif 'terminar' in request.POST and es_host:
+                partida.delete()
+                enviar_actualizacion_websocket(codigo)
+                return redirect('home')
         
-        # Nueva ronda de palabras
-        elif 'nueva_ronda' in request.POST and es_host and partida.ronda_terminada:
-            # Obtener nuevas palabras
-            try:
-                par_palabras = PalabraPar.objects.order_by('?').first()
-                palabra_buena = par_palabras.palabra_buena if par_palabras else "Gato"
-                palabra_infiltrado = par_palabras.palabra_infiltrado if par_palabras else "Perro"
-            except:
-                palabra_buena = "Gato"
-                palabra_infiltrado = "Perro"
+            # Empezar partida
+            elif 'empezar_partida' in request.POST and puede_empezar:
+                # Obtener nuevas palabras para la primera ronda
+                palabra_buena, palabra_infiltrado = elegir_palabras(transicion)
             
-            # Asignar roles y palabras
-            success, msg = asignar_roles_y_palabras(partida, palabra_buena, palabra_infiltrado)
-            if not success:
-                mensaje = msg
-                return render(request, 'blanco/partida.html', {
-                    'partida': partida,
-                    'jugadores': jugadores,
-                    'es_host': es_host,
-                    'puede_empezar': puede_empezar,
-                    'mensaje': mensaje,
-                })
-            
-            partida.palabra_impostor = palabra_buena
-            partida.palabra_buena_actual = palabra_buena
-            partida.palabra_infiltrado_actual = palabra_infiltrado
-            partida.ronda_terminada = False
-            partida.ronda_actual += 1
-            partida.save()
-            mensaje = f'¡Nueva ronda comenzada! (Ronda {partida.ronda_actual})'
-            # Enviar actualización WebSocket
-            enviar_actualizacion_websocket(partida.codigo, 'partida_updated')
+                # Asignar roles y palabras
+                success, msg = asignar_roles_y_palabras(transicion, palabra_buena, palabra_infiltrado)
+                if not success:
+                    mensaje = msg
+                else:
+                    transicion.cambiar(
+                        estado='en_juego',
+                        palabra_impostor=palabra_buena,
+                        palabra_buena_actual=palabra_buena,
+                        palabra_infiltrado_actual=palabra_infiltrado,
+                        ronda_terminada=False,
+                        ronda_actual=1,
+                    )
+                    mensaje = '¡La partida ha comenzado!'
+                    notificar = True
         
-        # Adivinar palabra (impostor eliminado)
-        elif 'adivinar_palabra' in request.POST:
-            mi_gameplayer = GamePlayer.objects.get(session=partida, user=request.user)
+            # Nueva ronda de palabras
+            elif 'nueva_ronda' in request.POST and es_host and partida.ronda_terminada:
+                # Obtener nuevas palabras
+                palabra_buena, palabra_infiltrado = elegir_palabras(transicion)
             
-            # Verificar que sea impostor eliminado y que no haya intentado adivinar antes
-            if not mi_gameplayer.es_impostor or not mi_gameplayer.eliminado or mi_gameplayer.ya_intento_adivinar:
-                pass
-            else:
-                palabra_adivinada = request.POST.get('palabra_adivinada', '').strip()
-                palabra_correcta = partida.palabra_impostor
-                
-                # Normalizar ambas palabras para comparación
-                palabra_adivinada_norm = normalizar_texto(palabra_adivinada)
-                palabra_correcta_norm = normalizar_texto(palabra_correcta)
-                
-                # Marcar que ya intentó adivinar
-                mi_gameplayer.ya_intento_adivinar = True
-                mi_gameplayer.save()
-                
-                if palabra_adivinada_norm == palabra_correcta_norm:
-                    # Impostor gana 3 puntos
-                    mi_gameplayer.puntos += 3
-                    mi_gameplayer.save()
-                    mensaje = '¡Correcto! El impostor ha ganado adivinando la palabra y se lleva 3 puntos.'
-                    
-                    # Verificar si hay otros impostores eliminados que puedan adivinar
-                    otros_impostores_eliminados = [p for p in partida.players.all() if p.eliminado and p.es_impostor and not p.ya_intento_adivinar and p != mi_gameplayer]
-                    
-                    if len(otros_impostores_eliminados) == 0:
-                        # No hay más impostores que puedan adivinar, terminar la ronda
-                        partida.ronda_terminada = True
-                        partida.save()
-                        mensaje += ' La ronda ha terminado.'
-                    else:
-                        mensaje += ' Otros impostores eliminados aún pueden intentar adivinar.'
+                # Asignar roles y palabras
+                success, msg = asignar_roles_y_palabras(transicion, palabra_buena, palabra_infiltrado)
+                if not success:
+                    mensaje = msg
                 else:
-                    mensaje = f'Incorrecto. La palabra era "{partida.palabra_impostor}". El impostor ha perdido.'
-                    
-                    # Verificar si hay otros impostores eliminados que puedan adivinar
-                    otros_impostores_eliminados = [p for p in partida.players.all() if p.eliminado and p.es_impostor and not p.ya_intento_adivinar and p != mi_gameplayer]
-                    
-                    if len(otros_impostores_eliminados) == 0:
-                        # No hay más impostores que puedan adivinar, verificar si la ronda debe terminar
-                        jugadores_activos = [p for p in partida.players.all() if not p.eliminado]
-                        infiltrados_activos = [p for p in jugadores_activos if p.es_infiltrado]
-                        impostores_activos = [p for p in jugadores_activos if p.es_impostor]
-                        buenos_activos = [p for p in jugadores_activos if p.es_bueno]
-                        
-                        # La ronda solo termina si solo quedan buenos o si llegamos a 1 vs 1
-                        if len(infiltrados_activos) == 0 and len(impostores_activos) == 0:
-                            # Solo quedan buenos, ganan 1 punto cada uno
-                            for player in buenos_activos:
-                                player.puntos += 1
-                                player.save()
-                            partida.ronda_terminada = True
-                            partida.save()
-                            mensaje += ' ¡Los buenos han ganado! Todos los malos han sido eliminados. Los buenos activos ganan 1 punto cada uno. La ronda ha terminado.'
-                        elif len(jugadores_activos) == 2:
-                            # Llegamos a 1 vs 1, asignar puntos según la combinación
-                            if len(impostores_activos) == 2:
-                                # Dos impostores en el 1 vs 1, cada uno gana 3 puntos
-                                for player in impostores_activos:
-                                    player.puntos += 3
-                                    player.save()
-                                mensaje += ' ¡Llegamos a 1 vs 1! Dos impostores, cada uno gana 3 puntos.'
-                            elif len(impostores_activos) == 1 and len(infiltrados_activos) == 1:
-                                # Un impostor y un infiltrado en el 1 vs 1
-                                for player in impostores_activos:
-                                    player.puntos += 3
-                                    player.save()
-                                for player in infiltrados_activos:
-                                    player.puntos += 2
-                                    player.save()
-                                mensaje += ' ¡Llegamos a 1 vs 1! Un impostor y un infiltrado: impostor 3 puntos, infiltrado 2 puntos.'
-                            elif len(impostores_activos) == 1 and len(buenos_activos) == 1:
-                                # Un impostor y un bueno en el 1 vs 1
-                                for player in impostores_activos:
-                                    player.puntos += 3
-                                    player.save()
-                                mensaje += ' ¡Llegamos a 1 vs 1! Un impostor y un bueno: impostor 3 puntos.'
-                            elif len(infiltrados_activos) == 2:
-                                # Dos infiltrados en el 1 vs 1, cada uno gana 2 puntos
-                                for player in infiltrados_activos:
-                                    player.puntos += 2
-                                    player.save()
-                                mensaje += ' ¡Llegamos a 1 vs 1! Dos infiltrados, cada uno gana 2 puntos.'
-                            elif len(infiltrados_activos) == 1 and len(buenos_activos) == 1:
-                                # Un infiltrado y un bueno, el infiltrado gana 2 puntos, el bueno 0
-                                for player in infiltrados_activos:
-                                    player.puntos += 2
-                                    player.save()
-                                mensaje += ' ¡Llegamos a 1 vs 1! Un infiltrado y un bueno, el infiltrado gana 2 puntos.'
-                            elif len(buenos_activos) == 2:
-                                # Dos buenos en el 1 vs 1, cada uno gana 1 punto
-                                for player in buenos_activos:
-                                    player.puntos += 1
-                                    player.save()
-                                mensaje += ' ¡Llegamos a 1 vs 1! Dos buenos, cada uno gana 1 punto.'
-                            
-                            partida.ronda_terminada = True
-                            partida.save()
-                            mensaje += ' La ronda ha terminado.'
-                        else:
-                            # La ronda continúa normalmente
-                            mensaje += ' La ronda continúa.'
+                    transicion.cambiar(
+                        palabra_impostor=palabra_buena,
+                        palabra_buena_actual=palabra_buena,
+                        palabra_infiltrado_actual=palabra_infiltrado,
+                        ronda_terminada=False,
+                        ronda_actual=partida.ronda_actual + 1,
+                    )
+                    mensaje = f'¡Nueva ronda comenzada! (Ronda {partida.ronda_actual})'
+                    notificar = True
+        
+            # Adivinar palabra (impostor eliminado)
+            elif 'adivinar_palabra' in request.POST:
+                mi_gameplayer = transicion.jugador_de_usuario(request.user.id)
+                palabra_adivinada = request.POST.get('palabra_adivinada', '').strip()
+                # None si no es un impostor eliminado o ya lo ha intentado antes
+                resultado = reglas.adivinar(
+                    transicion.foto(), mi_gameplayer.id if mi_gameplayer else None, palabra_adivinada
+                )
+                if resultado is not None:
+                    reglas.aplicar(resultado, transicion)
+                    mensaje = reglas.mensaje(resultado, partida.palabra_impostor)
+                    notificar = True
+    
+            # Todos los cambios de la acción se escriben juntos antes de soltar el bloqueo
+            transicion.guardar()
+        # Esta vista escribe directamente en la base de datos: la sala en memoria debe recargarse
+        # sin volcar encima de lo que se acaba de escribir
+        if notificar:
+            enviar_actualizacion_websocket(partida.codigo, transicion.escritos())
+        else:
+            invalidar_sala(partida.codigo, escritos=transicion.escritos())
     
     # Si no quedan jugadores, eliminar la partida
     if partida.players.count() == 0:
         partida.delete()
         return redirect('home')
     
-    # Obtener información del jugador actual
-    mi_gameplayer = GamePlayer.objects.get(session=partida, user=request.user)
-    palabra = mi_gameplayer.palabra_secreta if partida.estado == 'en_juego' and not mi_gameplayer.eliminado else None
-    
-    # Contar jugadores activos en la ronda
-    jugadores_activos = [gp for gp in jugadores if not gp.eliminado]
-    jugadores_eliminados = [gp for gp in jugadores if gp.eliminado]
-    
-    # Contar roles para mostrar información (solo para el host o si la ronda terminó)
-    buenos_activos = [p for p in jugadores_activos if p.es_bueno]
-    infiltrados_activos = [p for p in jugadores_activos if p.es_infiltrado]
-    impostores_activos = [p for p in jugadores_activos if p.es_impostor]
-    
-    return render(request, 'blanco/partida.html', {
-        'partida': partida,
-        'jugadores': jugadores,
-        'jugadores_activos': jugadores_activos,
-        'jugadores_eliminados': jugadores_eliminados,
-        'buenos_activos': buenos_activos,
-        'infiltrados_activos': infiltrados_activos,
-        'impostores_activos': impostores_activos,
-        'es_host': es_host,
-        'puede_empezar': puede_empezar,
-        'mensaje': mensaje,
-        'palabra': palabra,
-        'mi_gameplayer': mi_gameplayer,
+    # La página se renderiza con las mismas plantillas que los fragmentos que se envían por WebSocket
+    contexto = fragmentos.contexto(sala_de_partida(partida), request.user.id)
+    contexto['mensaje'] = mensaje
+    # Conectar directamente con el trabajador dueño de la sala
+    contexto['ws_url'] = reparto.url_websocket(partida.codigo)
+    contexto['esquema_protocolo'] = protocolo.esquema()
+    return render(request, 'blanco/partida.html', contexto)
+
+def sala_de_partida(partida):
+    """Estado de la sala: el que hay en memoria si está activa o, si no, el de la base de datos"""
+    return sala_en_memoria(partida.codigo) or SalaEstado.desde_modelo(partida)
+
+@login_required
+def partida_fragmentos(request, codigo):
+    """Devuelve renderizadas solo las partes de la página de partida indicadas con ?f=..."""
+    partida = get_object_or_404(GameSession, codigo=codigo)
+    sala = sala_de_partida(partida)
+    if sala.jugador_de_usuario(request.user.id) is None:
+        return HttpResponseForbidden('No formas parte de esta partida.')
+    nombres = request.GET.getlist('f') or None
+    return JsonResponse({
+        'version': sala.version,
+        'fragmentos': fragmentos.renderizar(sala, request.user.id, nombres),
     })
 
+@login_required
+def estadisticas_palabras(request):
+    """Tamaño del índice de palabras y latencia de los sorteos (solo staff)"""
+    if not request.user.is_staff:
+        return HttpResponseForbidden('Solo para administradores.')
+    return JsonResponse(muestreador.estadisticas())
+
+@login_required
+def estadisticas_difusion(request):
+    """Mensajes agrupados por vaciado de las colas de las salas (solo staff)"""
+    if not request.user.is_staff:
+        return HttpResponseForbidden('Solo para administradores.')
+    return JsonResponse(difusion.estadisticas())
+
+@login_required
+def estadisticas_protocolo(request):
+    """Bytes ahorrados por la compresión y tramas ahorradas al agrupar, por sala (solo staff)"""
+    if not request.user.is_staff:
+        return HttpResponseForbidden('Solo para administradores.')
+    return JsonResponse(protocolo.estadisticas(salas_activas()))
+
+@login_required
+def metricas_prometheus(request):
+    """Métricas de vistas y consumer en formato de texto de Prometheus (solo staff)"""
+    if not request.user.is_staff:
+        return HttpResponseForbidden('Solo para administradores.')
+    if not metricas.ACTIVAS:
+        return HttpResponseNotFound('Métricas desactivadas (BLANCO_METRICAS).')
+    return HttpResponse(metricas.exponer(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 # Vista personalizada de logout para limpiar GamePlayer
 @login_required
 def logout_view(request):
+    codigos = list(GamePlayer.objects.filter(user=request.user).values_list('session__codigo', flat=True))
     GamePlayer.objects.filter(user=request.user).delete()
-    # Eliminar partidas sin jugadores
-    for partida in GameSession.objects.all():
-        if partida.players.count() == 0:
-            partida.delete()
+    for codigo in codigos:
+        enviar_actualizacion_websocket(codigo)
+    # Eliminar partidas sin jugadores (las antiguas o inactivas las borra la limpieza periódica)
+    borrar_partidas_vacias()
     auth_logout(request)
     return redirect('login')
 
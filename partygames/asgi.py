@@ -13,14 +13,20 @@ from django.core.asgi import get_asgi_application
 from channels.routing import ProtocolTypeRouter, URLRouter
 from channels.auth import AuthMiddlewareStack
 from blanco.routing import websocket_urlpatterns
+from blanco.arranque import TareasDeFondo
+from blanco.reparto import EnrutamientoSalas
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'partygames.settings')
 
-application = ProtocolTypeRouter({
+# Las tareas de fondo (avisos entre trabajadores, limpieza de partidas) arrancan con el proceso, no con el primer WebSocket
+application = TareasDeFondo(ProtocolTypeRouter({
     "http": get_asgi_application(),
-    "websocket": AuthMiddlewareStack(
-        URLRouter(
-            websocket_urlpatterns
+    # Cada sala se atiende en un único trabajador; las conexiones que llegan a otro se redirigen
+    "websocket": EnrutamientoSalas(
+        AuthMiddlewareStack(
+            URLRouter(
+                websocket_urlpatterns
+            )
         )
     ),
-})
+}))
@@ -0,0 +1,423 @@
+"""
+Capa de canales en red para Django Channels.
+
+Habla el protocolo de Redis (RESP) con un conjunto pequeño de comandos, así
+que funciona contra un Redis real o contra el servidor local en Python de
+partygames/servidor_capa.py. Permite repartir las conexiones WebSocket entre
+varios procesos Daphne: los grupos y los mensajes entre canales pasan por el
+servidor en lugar de quedarse en la memoria de un solo proceso.
+
+Modelo de datos en el servidor:
+
+- Cada canal es una lista (RPUSH para enviar, BLPOP para recibir). Los canales
+  creados con new_channel() de un mismo proceso comparten una lista y un único
+  lector, que la vacía por lotes y reparte los mensajes en colas locales.
+- La capacidad de esos canales se cuenta por canal con un contador en el
+  servidor: el emisor lo sube al enviar y se baja cuando el consumidor recoge
+  el mensaje de su cola local, así que un consumidor lento solo llena su propio
+  canal.
+- Cada grupo es un conjunto ordenado cuyo score es el momento del group_add,
+  para poder caducar los miembros antiguos.
+- Los mensajes llevan su instante de caducidad y los que llegan tarde se descartan.
+
+Configuración en settings.CHANNEL_LAYERS:
+
+    'BACKEND': 'partygames.capa_red.CapaRed',
+    'CONFIG': {'url': 'redis://localhost:6379/0', 'expiry': 60, 'capacity': 100},
+"""
+import asyncio
+import json
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlparse
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+# Mensajes que el lector de los canales del proceso saca de su lista en cada viaje
+LOTE_LECTURA = 100
+
+
+class ErrorResp(Exception):
+    """Error devuelto por el servidor"""
+
+
+def codificar_comando(*args):
+    partes = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        elif not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        partes.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+    return b''.join(partes)
+
+
+async def leer_respuesta(reader):
+    linea = await reader.readline()
+    if not linea:
+        raise ConnectionError('Conexión cerrada por el servidor')
+    tipo, resto = linea[:1], linea[1:-2]
+    if tipo == b'+':
+        return resto.decode()
+    if tipo == b'-':
+        raise ErrorResp(resto.decode())
+    if tipo == b':':
+        return int(resto)
+    if tipo == b'$':
+        longitud = int(resto)
+        if longitud < 0:
+            return None
+        datos = await reader.readexactly(longitud + 2)
+        return datos[:-2]
+    if tipo == b'*':
+        longitud = int(resto)
+        if longitud < 0:
+            return None
+        return [await leer_respuesta(reader) for _ in range(longitud)]
+    raise ErrorResp(f'Respuesta no válida: {linea!r}')
+
+
+class ConexionResp:
+    """
+    Conexión RESP mínima; los comandos de una misma conexión se ejecutan de uno
+    en uno. tuberia() manda varios comandos en una sola escritura y lee todas
+    las respuestas después: un solo viaje de ida y vuelta.
+    """
+
+    def __init__(self, host, port, db=0, password=None):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def abrir(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            await self._ejecutar('AUTH', self.password)
+        if self.db:
+            await self._ejecutar('SELECT', self.db)
+
+    async def _ejecutar(self, *args):
+        self.writer.write(codificar_comando(*args))
+        await self.writer.drain()
+        return await leer_respuesta(self.reader)
+
+    async def _ejecutar_varios(self, comandos):
+        self.writer.write(b''.join(codificar_comando(*args) for args in comandos))
+        await self.writer.drain()
+        respuestas = []
+        error = None
+        # Se leen todas las respuestas aunque alguna sea un error, para no desalinear la conexión
+        for _ in comandos:
+            try:
+                respuestas.append(await leer_respuesta(self.reader))
+            except ErrorResp as e:
+                error = error or e
+                respuestas.append(None)
+        if error is not None:
+            raise error
+        return respuestas
+
+    async def _con_reintento(self, ejecutar, *args):
+        async with self.lock:
+            if self.writer is None or self.writer.is_closing():
+                await self.abrir()
+            try:
+                return await ejecutar(*args)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Reintentar una vez con una conexión nueva
+                await self.abrir()
+                return await ejecutar(*args)
+
+    async def comando(self, *args):
+        return await self._con_reintento(self._ejecutar, *args)
+
+    async def tuberia(self, *comandos):
+        """Ejecuta varios comandos (tuplas de argumentos) en un viaje; devuelve sus respuestas en orden"""
+        return await self._con_reintento(self._ejecutar_varios, comandos)
+
+    async def cerrar(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+            self.writer = None
+
+
+class CapaRed(BaseChannelLayer):
+    """Capa de canales que guarda canales y grupos en un servidor compatible con Redis"""
+
+    extensions = ['groups', 'flush']
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='asgi', expiry=60, group_expiry=86400,
+                 capacity=100, channel_capacity=None):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity)
+        partes = urlparse(url)
+        self.host = partes.hostname or 'localhost'
+        self.port = partes.port or 6379
+        self.db = int(partes.path.lstrip('/') or 0)
+        self.password = partes.password
+        self.prefix = prefix
+        self.group_expiry = group_expiry
+        # Los canales de este proceso comparten una lista en el servidor: "specific.<id>!"
+        self.id_cliente = uuid.uuid4().hex
+        # Recursos por bucle de eventos (async_to_sync puede usar bucles distintos)
+        self._conexiones = {}
+        self._lectores = {}
+        # Cola local de cada canal de este proceso, con (caducidad, mensaje)
+        self._colas = {}
+        # Receptores esperando en cada cola y último mensaje llegado a cada una
+        self._esperando = Counter()
+        self._ultima_entrada = {}
+        # Mensajes recogidos por los consumidores que aún no se han descontado de su contador
+        self._recogidos = Counter()
+
+    # Utilidades
+
+    def _clave_canal(self, channel):
+        if '!' in channel:
+            channel = self.non_local_name(channel) + '!'
+        return f'{self.prefix}:canal:{channel}'
+
+    def _clave_cuenta(self, channel):
+        return f'{self.prefix}:cuenta:{channel}'
+
+    def _clave_grupo(self, group):
+        return f'{self.prefix}:grupo:{group}'
+
+    def _nueva_conexion(self):
+        return ConexionResp(self.host, self.port, self.db, self.password)
+
+    def _conexion(self):
+        loop = asyncio.get_running_loop()
+        conexion = self._conexiones.get(loop)
+        if conexion is None:
+            conexion = self._conexiones[loop] = self._nueva_conexion()
+        return conexion
+
+    @staticmethod
+    def _codificar(channel, message, expira):
+        return json.dumps({'canal': channel, 'expira': expira, 'mensaje': message})
+
+    @staticmethod
+    def _decodificar(datos):
+        sobre = json.loads(datos)
+        if sobre['expira'] < time.time():
+            return None, None
+        return sobre['canal'], sobre['mensaje']
+
+    # Canales
+
+    def _comandos_envio(self, channel, datos):
+        """
+        Comandos que envían `datos` a un canal. El primero devuelve cuántos
+        mensajes tiene el canal contando este: la longitud de su lista o, en los
+        canales de un proceso (que comparten lista), su contador.
+        """
+        clave = self._clave_canal(channel)
+        caducidad = int(self.expiry) + 1
+        comandos = []
+        if '!' in channel:
+            cuenta = self._clave_cuenta(channel)
+            comandos += [('INCR', cuenta), ('EXPIRE', cuenta, caducidad)]
+        return comandos + [('RPUSH', clave, datos), ('EXPIRE', clave, caducidad)]
+
+    def _comandos_deshacer(self, channel, datos):
+        """Quita de la lista el mensaje rechazado por estar el canal lleno (y lo descuenta)"""
+        comandos = [('LREM', self._clave_canal(channel), -1, datos)]
+        if '!' in channel:
+            comandos.append(('DECR', self._clave_cuenta(channel)))
+        return comandos
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_channel_name(channel)
+        datos = self._codificar(channel, message, time.time() + self.expiry)
+        conexion = self._conexion()
+        # Se añade sin mirar antes cuántos hay: si se ha pasado de la capacidad, se quita este
+        # mismo mensaje (LREM del final). Así lo normal es un viaje
+        ocupados = (await conexion.tuberia(*self._comandos_envio(channel, datos)))[0]
+        if ocupados > self.get_capacity(channel):
+            await conexion.tuberia(*self._comandos_deshacer(channel, datos))
+            raise ChannelFull()
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        if '!' not in channel:
+            return await self._recibir_directo(channel)
+
+        # Canal de este proceso: esperar en su cola local, que llena el lector compartido
+        cola = self._colas.get(channel)
+        if cola is None:
+            cola = self._colas[channel] = asyncio.Queue()
+        self._asegurar_lector()
+        self._esperando[channel] += 1
+        try:
+            while True:
+                expira, mensaje = await cola.get()
+                self._descontar(channel)
+                if expira >= time.time():
+                    return mensaje
+        except asyncio.CancelledError:
+            # El consumidor ha terminado: sus mensajes ya no tienen destinatario
+            if cola.empty():
+                self._colas.pop(channel, None)
+            raise
+        finally:
+            self._esperando[channel] -= 1
+            if not self._esperando[channel]:
+                del self._esperando[channel]
+
+    async def _recibir_directo(self, channel):
+        clave = self._clave_canal(channel)
+        conexion = self._nueva_conexion()
+        try:
+            while True:
+                respuesta = await conexion.comando('BLPOP', clave, 1)
+                if respuesta is None:
+                    continue
+                _, mensaje = self._decodificar(respuesta[1])
+                if mensaje is not None:
+                    return mensaje
+        finally:
+            await conexion.cerrar()
+
+    def _asegurar_lector(self):
+        loop = asyncio.get_running_loop()
+        lector = self._lectores.get(loop)
+        if lector is None or lector.done():
+            self._lectores[loop] = loop.create_task(self._leer_canales_locales())
+
+    def _descontar(self, channel, cuantos=1):
+        """Anota mensajes que ya no ocupan el canal; se descuentan juntos en el servidor"""
+        if not self._recogidos:
+            asyncio.ensure_future(self._enviar_descuentos())
+        self._recogidos[channel] += cuantos
+
+    async def _enviar_descuentos(self):
+        # Lo recogido en este paso del bucle va en un solo viaje
+        await asyncio.sleep(0)
+        recogidos, self._recogidos = self._recogidos, Counter()
+        if not recogidos:
+            return
+        try:
+            await self._conexion().tuberia(
+                *[('DECRBY', self._clave_cuenta(canal), n) for canal, n in recogidos.items()]
+            )
+        except (ConnectionError, OSError, ErrorResp):
+            # El contador caduca con el canal: como mucho, el canal parece lleno hasta entonces
+            pass
+
+    async def _leer_canales_locales(self):
+        """
+        Reparte los mensajes de la lista de este proceso entre las colas de sus
+        canales. Cada viaje espera al primer mensaje (BLPOP) y se lleva los
+        siguientes LOTE_LECTURA - 1 de una vez.
+        """
+        clave = self._clave_canal(f'specific.{self.id_cliente}!')
+        conexion = self._nueva_conexion()
+        try:
+            while self._colas:
+                primero, resto, _ = await conexion.tuberia(
+                    ('BLPOP', clave, 1),
+                    ('LRANGE', clave, 0, LOTE_LECTURA - 2),
+                    ('LTRIM', clave, LOTE_LECTURA - 1, -1),
+                )
+                for datos in ([primero[1]] if primero else []) + (resto or []):
+                    self._repartir(datos)
+                self._purgar_colas()
+        finally:
+            await conexion.cerrar()
+
+    def _repartir(self, datos):
+        sobre = json.loads(datos)
+        canal = sobre['canal']
+        cola = self._colas.get(canal)
+        if cola is None:
+            # Puede llegar antes de que su consumidor empiece a esperar: se guarda hasta entonces
+            cola = self._colas[canal] = asyncio.Queue()
+        cola.put_nowait((sobre['expira'], sobre['mensaje']))
+        self._ultima_entrada[canal] = time.monotonic()
+
+    def _purgar_colas(self):
+        """Olvida las colas sin receptor cuyo último mensaje ya ha caducado (su consumidor se fue)"""
+        limite = time.monotonic() - self.expiry
+        for canal, llegada in list(self._ultima_entrada.items()):
+            if llegada >= limite or self._esperando.get(canal):
+                continue
+            del self._ultima_entrada[canal]
+            cola = self._colas.pop(canal, None)
+            if cola is not None and cola.qsize():
+                self._descontar(canal, cola.qsize())
+
+    async def new_channel(self, prefix='specific.'):
+        return f'{prefix}{self.id_cliente}!{uuid.uuid4().hex}'
+
+    # Grupos
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        clave = self._clave_grupo(group)
+        await self._conexion().tuberia(
+            ('ZADD', clave, time.time(), channel),
+            ('EXPIRE', clave, self.group_expiry),
+        )
+
+    async def group_discard(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._conexion().comando('ZREM', self._clave_grupo(group), channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        self.require_valid_group_name(group)
+        clave = self._clave_grupo(group)
+        conexion = self._conexion()
+        # Olvidar los miembros que llevan más de group_expiry sin renovarse
+        _, canales = await conexion.tuberia(
+            ('ZREMRANGEBYSCORE', clave, '-inf', time.time() - self.group_expiry),
+            ('ZRANGE', clave, 0, -1),
+        )
+        if not canales:
+            return
+        # Todos los miembros en un viaje; los llenos se deshacen en otro
+        expira = time.time() + self.expiry
+        envios = [(canal.decode(), self._codificar(canal.decode(), message, expira)) for canal in canales]
+        comandos = [self._comandos_envio(canal, datos) for canal, datos in envios]
+        respuestas = await conexion.tuberia(*[comando for grupo in comandos for comando in grupo])
+        deshacer = []
+        posicion = 0
+        for (canal, datos), grupo in zip(envios, comandos):
+            if respuestas[posicion] > self.get_capacity(canal):
+                # Igual que las demás capas: un canal lleno no detiene el envío al grupo
+                deshacer += self._comandos_deshacer(canal, datos)
+            posicion += len(grupo)
+        if deshacer:
+            await conexion.tuberia(*deshacer)
+
+    # Mantenimiento
+
+    async def flush(self):
+        conexion = self._conexion()
+        claves = await conexion.comando('KEYS', f'{self.prefix}:*')
+        if claves:
+            await conexion.comando('DEL', *claves)
+        self._colas.clear()
+        self._ultima_entrada.clear()
+        self._recogidos.clear()
+
+    async def close(self):
+        for lector in self._lectores.values():
+            lector.cancel()
+        self._lectores.clear()
+        for conexion in self._conexiones.values():
+            await conexion.cerrar()
+        self._conexiones.clear()
@@ -0,0 +1,404 @@
+"""
+Servidor local en Python puro para la capa de canales en red.
+
+Implementa el subconjunto del protocolo de Redis que usa partygames.capa_red
+(listas con espera bloqueante, contadores, conjuntos ordenados y caducidad de
+claves), así
+que se puede probar el despliegue con varios procesos Daphne sin instalar Redis:
+
+    python -m partygames.servidor_capa --port 6379
+"""
+import argparse
+import asyncio
+import fnmatch
+import time
+from collections import deque
+
+from partygames.capa_red import ErrorResp
+
+
+def _respuesta(valor):
+    """Codifica un valor de Python como respuesta RESP"""
+    if valor is None:
+        return b'$-1\r\n'
+    if isinstance(valor, ErrorResp):
+        return b'-ERR %s\r\n' % str(valor).encode()
+    if isinstance(valor, bool):
+        return b':%d\r\n' % int(valor)
+    if isinstance(valor, int):
+        return b':%d\r\n' % valor
+    if isinstance(valor, str):
+        return b'+%s\r\n' % valor.encode()
+    if isinstance(valor, bytes):
+        return b'$%d\r\n%s\r\n' % (len(valor), valor)
+    if isinstance(valor, (list, tuple)):
+        return b'*%d\r\n' % len(valor) + b''.join(_respuesta(v) for v in valor)
+    raise TypeError(valor)
+
+
+def _cerrado(lector):
+    """
+    El cliente ha cerrado la conexión. at_eof() solo es cierto con el búfer
+    vacío, y un BLPOP enviado en tubería deja en él los comandos que lo siguen.
+    """
+    return lector.at_eof() or getattr(lector, '_eof', False)
+
+
+def _score(valor):
+    # float() ya entiende '-inf' y '+inf'
+    return float(valor.decode() if isinstance(valor, bytes) else valor)
+
+
+class ServidorCapa:
+    """Almacén en memoria con listas, conjuntos ordenados y caducidad"""
+
+    def __init__(self):
+        self.datos = {}
+        self.caducidad = {}
+        # Clientes esperando en BLPOP, por clave
+        self.esperas = {}
+        # Conexión de cada espera, para no entregar a un cliente que ya se ha ido
+        self.lectores = {}
+
+    # Caducidad
+
+    def _vigente(self, clave):
+        limite = self.caducidad.get(clave)
+        if limite is not None and limite <= time.monotonic():
+            self.datos.pop(clave, None)
+            self.caducidad.pop(clave, None)
+        return clave in self.datos
+
+    def _borrar(self, clave):
+        self.caducidad.pop(clave, None)
+        return self.datos.pop(clave, None) is not None
+
+    def _lista(self, clave, crear=False):
+        if self._vigente(clave):
+            valor = self.datos[clave]
+            if not isinstance(valor, deque):
+                raise ErrorResp('WRONGTYPE Operation against a key holding the wrong kind of value')
+            return valor
+        if crear:
+            valor = self.datos[clave] = deque()
+            return valor
+        return None
+
+    def _contador(self, clave):
+        if self._vigente(clave):
+            valor = self.datos[clave]
+            if not isinstance(valor, int):
+                raise ErrorResp('WRONGTYPE Operation against a key holding the wrong kind of value')
+            return valor
+        return 0
+
+    def _zset(self, clave, crear=False):
+        if self._vigente(clave):
+            valor = self.datos[clave]
+            if not isinstance(valor, dict):
+                raise ErrorResp('WRONGTYPE Operation against a key holding the wrong kind of value')
+            return valor
+        if crear:
+            valor = self.datos[clave] = {}
+            return valor
+        return None
+
+    async def barrer(self, intervalo=1.0):
+        """Borra periódicamente las claves caducadas"""
+        while True:
+            await asyncio.sleep(intervalo)
+            for clave in list(self.caducidad):
+                self._vigente(clave)
+
+    # Comandos
+
+    async def ejecutar(self, args, lector=None):
+        nombre = args[0].decode().upper()
+        metodo = getattr(self, f'cmd_{nombre.lower()}', None)
+        if metodo is None:
+            return ErrorResp(f"unknown command '{nombre}'")
+        try:
+            resultado = metodo(*args[1:], lector=lector) if nombre == 'BLPOP' else metodo(*args[1:])
+            if asyncio.iscoroutine(resultado):
+                resultado = await resultado
+            return resultado
+        except ErrorResp as error:
+            return error
+        except (TypeError, ValueError):
+            return ErrorResp(f"wrong arguments for '{nombre}' command")
+
+    def cmd_ping(self, *args):
+        return args[0] if args else 'PONG'
+
+    def cmd_echo(self, mensaje):
+        return mensaje
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    def cmd_auth(self, *args):
+        return 'OK'
+
+    def cmd_rpush(self, clave, *valores):
+        lista = self._lista(clave, crear=True)
+        entregados = 0
+        for valor in valores:
+            esperas = self.esperas.get(clave)
+            entregado = False
+            # Entregar directamente a quien esté esperando en BLPOP
+            while esperas:
+                futuro = esperas.popleft()
+                if futuro.done():
+                    continue
+                lector = self.lectores.get(futuro)
+                if lector is not None and _cerrado(lector):
+                    # Como Redis: el cliente ha cerrado la conexión y su BLPOP ya no cuenta
+                    futuro.set_exception(ConnectionResetError())
+                    continue
+                futuro.set_result([clave, valor])
+                entregado = True
+                break
+            if entregado:
+                entregados += 1
+            else:
+                lista.append(valor)
+        longitud = len(lista)
+        if not lista:
+            self._borrar(clave)
+        return longitud + entregados
+
+    def cmd_lpush(self, clave, *valores):
+        lista = self._lista(clave, crear=True)
+        for valor in valores:
+            lista.appendleft(valor)
+        return len(lista)
+
+    def cmd_lpop(self, clave):
+        lista = self._lista(clave)
+        if not lista:
+            return None
+        valor = lista.popleft()
+        if not lista:
+            self._borrar(clave)
+        return valor
+
+    def cmd_lrem(self, clave, cuantos, valor):
+        lista = self._lista(clave)
+        if not lista:
+            return 0
+        cuantos = int(cuantos)
+        # Como en Redis: cuantos < 0 quita desde el final, 0 quita todos
+        posiciones = [i for i, v in enumerate(lista) if v == valor]
+        if cuantos < 0:
+            posiciones = posiciones[cuantos:]
+        elif cuantos > 0:
+            posiciones = posiciones[:cuantos]
+        for i in reversed(posiciones):
+            del lista[i]
+        if not lista:
+            self._borrar(clave)
+        return len(posiciones)
+
+    def cmd_llen(self, clave):
+        lista = self._lista(clave)
+        return len(lista) if lista else 0
+
+    def cmd_lrange(self, clave, inicio, fin):
+        lista = self._lista(clave)
+        if not lista:
+            return []
+        inicio, fin = int(inicio), int(fin)
+        # Como en Redis: los índices negativos cuentan desde el final y fin es inclusivo
+        inicio = max(len(lista) + inicio, 0) if inicio < 0 else inicio
+        fin = len(lista) + fin if fin < 0 else fin
+        return list(lista)[inicio:fin + 1]
+
+    def cmd_ltrim(self, clave, inicio, fin):
+        lista = self._lista(clave)
+        if lista:
+            conservados = self.cmd_lrange(clave, inicio, fin)
+            lista.clear()
+            lista.extend(conservados)
+            if not lista:
+                self._borrar(clave)
+        return 'OK'
+
+    def cmd_incrby(self, clave, incremento):
+        # Como en Redis, la caducidad que tuviera la clave se conserva
+        valor = self.datos[clave] = self._contador(clave) + int(incremento)
+        return valor
+
+    def cmd_incr(self, clave):
+        return self.cmd_incrby(clave, 1)
+
+    def cmd_decrby(self, clave, decremento):
+        return self.cmd_incrby(clave, -int(decremento))
+
+    def cmd_decr(self, clave):
+        return self.cmd_incrby(clave, -1)
+
+    async def cmd_blpop(self, *args, lector=None):
+        claves, timeout = args[:-1], float(args[-1])
+        for clave in claves:
+            valor = self.cmd_lpop(clave)
+            if valor is not None:
+                return [clave, valor]
+
+        futuro = asyncio.get_running_loop().create_future()
+        for clave in claves:
+            self.esperas.setdefault(clave, deque()).append(futuro)
+        if lector is not None:
+            self.lectores[futuro] = lector
+        try:
+            return await asyncio.wait_for(futuro, timeout or None)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self.lectores.pop(futuro, None)
+            for clave in claves:
+                esperas = self.esperas.get(clave)
+                if esperas is not None:
+                    try:
+                        esperas.remove(futuro)
+                    except ValueError:
+                        pass
+                    if not esperas:
+                        del self.esperas[clave]
+
+    def cmd_expire(self, clave, segundos):
+        if not self._vigente(clave):
+            return 0
+        self.caducidad[clave] = time.monotonic() + float(segundos)
+        return 1
+
+    def cmd_ttl(self, clave):
+        if not self._vigente(clave):
+            return -2
+        limite = self.caducidad.get(clave)
+        if limite is None:
+            return -1
+        return max(0, int(limite - time.monotonic()))
+
+    def cmd_del(self, *claves):
+        return sum(1 for clave in claves if self._vigente(clave) and self._borrar(clave))
+
+    def cmd_exists(self, *claves):
+        return sum(1 for clave in claves if self._vigente(clave))
+
+    def cmd_keys(self, patron):
+        patron = patron.decode()
+        return [clave for clave in list(self.datos) if self._vigente(clave) and fnmatch.fnmatchcase(clave.decode(), patron)]
+
+    def cmd_zadd(self, clave, *args):
+        zset = self._zset(clave, crear=True)
+        nuevos = 0
+        for i in range(0, len(args), 2):
+            miembro = args[i + 1]
+            if miembro not in zset:
+                nuevos += 1
+            zset[miembro] = _score(args[i])
+        return nuevos
+
+    def cmd_zrem(self, clave, *miembros):
+        zset = self._zset(clave)
+        if not zset:
+            return 0
+        quitados = sum(1 for miembro in miembros if zset.pop(miembro, None) is not None)
+        if not zset:
+            self._borrar(clave)
+        return quitados
+
+    def cmd_zcard(self, clave):
+        zset = self._zset(clave)
+        return len(zset) if zset else 0
+
+    def _ordenados(self, clave):
+        zset = self._zset(clave) or {}
+        return sorted(zset, key=lambda miembro: (zset[miembro], miembro))
+
+    def cmd_zrange(self, clave, inicio, fin):
+        miembros = self._ordenados(clave)
+        inicio, fin = int(inicio), int(fin)
+        fin = len(miembros) + fin if fin < 0 else fin
+        return miembros[inicio:fin + 1]
+
+    def cmd_zrangebyscore(self, clave, minimo, maximo):
+        zset = self._zset(clave) or {}
+        minimo, maximo = _score(minimo), _score(maximo)
+        return [m for m in self._ordenados(clave) if minimo <= zset[m] <= maximo]
+
+    def cmd_zremrangebyscore(self, clave, minimo, maximo):
+        zset = self._zset(clave)
+        if not zset:
+            return 0
+        minimo, maximo = _score(minimo), _score(maximo)
+        quitar = [m for m, score in zset.items() if minimo <= score <= maximo]
+        for miembro in quitar:
+            del zset[miembro]
+        if not zset:
+            self._borrar(clave)
+        return len(quitar)
+
+    def cmd_flushdb(self):
+        self.datos.clear()
+        self.caducidad.clear()
+        return 'OK'
+
+    cmd_flushall = cmd_flushdb
+
+    # Red
+
+    async def atender(self, reader, writer):
+        try:
+            while True:
+                linea = await reader.readline()
+                if not linea:
+                    break
+                if not linea.startswith(b'*'):
+                    # Comando en línea (p. ej. desde telnet)
+                    args = linea.split()
+                else:
+                    args = []
+                    for _ in range(int(linea[1:-2])):
+                        cabecera = await reader.readline()
+                        longitud = int(cabecera[1:-2])
+                        args.append((await reader.readexactly(longitud + 2))[:-2])
+                if not args:
+                    continue
+                if args[0].upper() == b'QUIT':
+                    writer.write(_respuesta('OK'))
+                    break
+                writer.write(_respuesta(await self.ejecutar(args, reader)))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # El servidor se cierra con clientes esperando en BLPOP: la conexión termina sin más
+            pass
+        finally:
+            writer.close()
+
+    async def servir(self, host='127.0.0.1', port=6379):
+        servidor = await asyncio.start_server(self.atender, host, port)
+        barrido = asyncio.ensure_future(self.barrer())
+        try:
+            async with servidor:
+                await servidor.serve_forever()
+        finally:
+            barrido.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Servidor local compatible con la capa de canales en red')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=6379)
+    args = parser.parse_args()
+    print(f'Servidor de la capa de canales escuchando en {args.host}:{args.port}')
+    try:
+        asyncio.run(ServidorCapa().servir(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -59,6 +59,8 @@ MIDDLEWARE = [
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    # Después de WhiteNoise, para que los estáticos no cuenten como vistas
+    'blanco.metricas.MetricasMiddleware',
 ]
 
 ROOT_URLCONF = 'partygames.urls'
@@ -82,11 +84,42 @@ WSGI_APPLICATION = 'partygames.wsgi.application'
 ASGI_APPLICATION = 'partygames.asgi.application'
 
 # Channels configuration
-CHANNEL_LAYERS = {
-    'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
-    },
-}
+# Con REDIS_URL los grupos se comparten entre procesos Daphne (Redis o partygames/servidor_capa.py);
+# sin ella se usa la capa en memoria, válida solo para un proceso
+if os.getenv('REDIS_URL'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'partygames.capa_red.CapaRed',
+            'CONFIG': {
+                'url': os.getenv('REDIS_URL'),
+                'expiry': 60,
+                'capacity': 100,
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Reparto de salas entre procesos Daphne: BLANCO_TRABAJADORES="w1=ws://host:8001,w2=ws://host:8002"
+# y BLANCO_TRABAJADOR con el identificador de cada proceso (requiere REDIS_URL)
+BLANCO_TRABAJADORES = dict(
+    par.split('=', 1) for par in os.getenv('BLANCO_TRABAJADORES', '').split(',') if '=' in par
+)
+BLANCO_TRABAJADOR = os.getenv('BLANCO_TRABAJADOR')
+
+# Fichero JSON en el que blanco/tests_rendimiento.py añade los tiempos de cada ejecución
+BLANCO_RENDIMIENTO_HISTORIAL = os.getenv('BLANCO_RENDIMIENTO_HISTORIAL')
+
+# Métricas de vistas y consumer en /blanco/metricas/ (BLANCO_METRICAS=0 las desactiva sin coste)
+BLANCO_METRICAS = os.getenv('BLANCO_METRICAS', '1') != '0'
+
+# Hilos de la base de datos de las salas, por separado para lecturas y escrituras (0 usa el hilo de channels)
+BLANCO_HILOS_LECTURA = int(os.getenv('BLANCO_HILOS_LECTURA', '4'))
+BLANCO_HILOS_ESCRITURA = int(os.getenv('BLANCO_HILOS_ESCRITURA', '2'))
 
 # Configurar Django para usar ASGI por defecto
 ASGI_APPLICATION = 'partygames.asgi.application'
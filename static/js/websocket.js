@@ -1,11 +1,147 @@
+// Codificación compacta de los mensajes. El esquema lo genera blanco/protocolo.py y llega en la plantilla.
+class ProtocoloCompacto {
+    constructor(esquema) {
+        this.subprotocolo = esquema.subprotocolo;
+        this.compresion = esquema.compresion;
+        this.version = esquema.version;
+        this.tipos = esquema.tipos;
+        this.booleanos = new Set(esquema.booleanos);
+        this.abreviaturas = new Map();
+        this.claves = new Map();
+        esquema.claves.forEach((clave, posicion) => {
+            const corta = ProtocoloCompacto.abreviatura(posicion);
+            this.abreviaturas.set(clave, corta);
+            this.claves.set(corta, clave);
+        });
+        this.posicionTipos = new Map(this.tipos.map((tipo, posicion) => [tipo, posicion]));
+    }
+
+    static abreviatura(posicion) {
+        const letras = 'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ';
+        if (posicion < letras.length) {
+            return letras[posicion];
+        }
+        return letras[Math.floor(posicion / letras.length) - 1] + letras[posicion % letras.length];
+    }
+
+    static esObjeto(valor) {
+        return valor !== null && typeof valor === 'object' && !Array.isArray(valor);
+    }
+
+    compactarClave(clave) {
+        if (this.abreviaturas.has(clave)) {
+            return this.abreviaturas.get(clave);
+        }
+        if (this.claves.has(clave) || clave === '#' || clave === '=' || clave.startsWith('~')) {
+            return '~' + clave;
+        }
+        return clave;
+    }
+
+    expandirClave(clave) {
+        if (clave.startsWith('~')) {
+            return clave.slice(1);
+        }
+        return this.claves.has(clave) ? this.claves.get(clave) : clave;
+    }
+
+    compactar(valor, clave = null) {
+        if (Array.isArray(valor)) {
+            // Listas de objetos con las mismas claves: por columnas
+            if (valor.length > 1 && valor.every(ProtocoloCompacto.esObjeto)) {
+                const columnas = Object.keys(valor[0]);
+                const firma = columnas.join(',');
+                if (valor.every(fila => Object.keys(fila).join(',') === firma)) {
+                    return {
+                        '#': columnas.map(columna => this.compactarClave(columna)),
+                        '=': valor.map(fila => columnas.map(columna => this.compactar(fila[columna], columna))),
+                    };
+                }
+            }
+            return valor.map(elemento => this.compactar(elemento));
+        }
+        if (ProtocoloCompacto.esObjeto(valor)) {
+            const compacto = {};
+            Object.entries(valor).forEach(([k, v]) => {
+                compacto[this.compactarClave(k)] = this.compactar(v, k);
+            });
+            return compacto;
+        }
+        if (typeof valor === 'boolean') {
+            return this.booleanos.has(clave) ? Number(valor) : valor;
+        }
+        if (clave === 'type' && this.posicionTipos.has(valor)) {
+            return this.posicionTipos.get(valor);
+        }
+        return valor;
+    }
+
+    expandir(valor, clave = null) {
+        if (Array.isArray(valor)) {
+            return valor.map(elemento => this.expandir(elemento));
+        }
+        if (ProtocoloCompacto.esObjeto(valor)) {
+            const claves = Object.keys(valor);
+            if (claves.length === 2 && '#' in valor && '=' in valor) {
+                const columnas = valor['#'].map(columna => this.expandirClave(columna));
+                return valor['='].map(fila => {
+                    const objeto = {};
+                    columnas.forEach((columna, i) => {
+                        objeto[columna] = this.expandir(fila[i], columna);
+                    });
+                    return objeto;
+                });
+            }
+            const expandido = {};
+            claves.forEach(k => {
+                const larga = this.expandirClave(k);
+                expandido[larga] = this.expandir(valor[k], larga);
+            });
+            return expandido;
+        }
+        if (typeof valor === 'number' && this.booleanos.has(clave)) {
+            return Boolean(valor);
+        }
+        if (typeof valor === 'number' && clave === 'type') {
+            return this.tipos[valor];
+        }
+        return valor;
+    }
+
+    codificar(mensaje) {
+        return JSON.stringify([this.version, this.compactar(mensaje)]);
+    }
+
+    decodificar(trama) {
+        if (trama[0] !== this.version) {
+            throw new Error(`Versión del protocolo compacto no soportada: ${trama[0]}`);
+        }
+        return this.expandir(trama[1]);
+    }
+}
+
 class PartidaWebSocket {
-    constructor(codigoPartida) {
+    constructor(codigoPartida, userId, wsUrl = '', esquema = null) {
         this.codigoPartida = codigoPartida;
+        this.userId = userId;
+        // Dirección del trabajador dueño de la sala (vacía: el mismo servidor que sirve la página)
+        this.wsUrl = wsUrl;
+        this.redirigiendo = false;
+        this.esperaRedireccion = 0;
+        // Codificación compacta: se ofrece como subprotocolo y se usa si el servidor la acepta
+        this.protocolo = esquema ? new ProtocoloCompacto(esquema) : null;
+        this.compacto = false;
+        // Las tramas binarias llegan comprimidas y se descomprimen en orden
+        this.recepcion = Promise.resolve();
         this.socket = null;
         this.reconnectAttempts = 0;
         this.maxReconnectAttempts = 5;
         this.reconnectDelay = 1000;
         this.currentPartidaData = null;
+        this.version = null;
+        // Cada cuánto se avisa al servidor de que la conexión sigue viva
+        this.intervaloLatido = 20000;
+        this.latido = null;
         this.init();
     }
 
@@ -15,27 +151,40 @@ class PartidaWebSocket {
 
     connect() {
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws/partida/${this.codigoPartida}/`;
+        const wsUrl = this.wsUrl || `${protocol}//${window.location.host}/ws/partida/${this.codigoPartida}/`;
         
-        this.socket = new WebSocket(wsUrl);
+        this.socket = this.protocolo ? new WebSocket(wsUrl, this.subprotocolos()) : new WebSocket(wsUrl);
+        this.socket.binaryType = 'arraybuffer';
         
         this.socket.onopen = (event) => {
+            this.compacto = this.protocolo !== null && this.socket.protocol.split('+')[0] === this.protocolo.subprotocolo;
+            // Tras una reconexión o un traslado la página puede haberse quedado atrás: pedir los fragmentos de nuevo
+            if (this.reconnectAttempts > 0 || this.redirigiendo) {
+                this.cargarFragmentos();
+            }
             this.reconnectAttempts = 0;
-            this.initializePartidaData();
+            this.redirigiendo = false;
+            this.iniciarLatido();
         };
 
         this.socket.onmessage = (event) => {
-            try {
-                const data = JSON.parse(event.data);
-                this.handleMessage(data);
-            } catch (error) {
-                console.error('Error al parsear mensaje WebSocket:', error);
-            }
+            // Encadenado: una trama comprimida no debe adelantarse a las que llegaron antes
+            this.recepcion = this.recepcion
+                .then(() => PartidaWebSocket.leerTrama(event.data))
+                .then((texto) => this.handleMessage(this.decodificar(texto)))
+                .catch((error) => console.error('Error al parsear mensaje WebSocket:', error));
         };
 
         this.socket.onclose = (event) => {
+            this.detenerLatido();
+            // La sala se atiende en otro trabajador: conectarse allí enseguida (o cuando diga el servidor)
+            if (this.redirigiendo) {
+                setTimeout(() => this.connect(), this.esperaRedireccion);
+                return;
+            }
             
-            if (!event.wasClean && this.reconnectAttempts < this.maxReconnectAttempts) {
+            // 4001: el servidor cerró la conexión por falta de latidos, así que se vuelve a conectar
+            if ((!event.wasClean || event.code === 4001) && this.reconnectAttempts < this.maxReconnectAttempts) {
                 this.reconnectAttempts++;
                 setTimeout(() => {
                     this.connect();
@@ -50,82 +199,70 @@ class PartidaWebSocket {
     }
 
     handleMessage(data) {
+        // Los mensajes de estado traen ya renderizadas las partes de la página que han cambiado
+        if (data.fragmentos) {
+            this.aplicarFragmentos(data.fragmentos);
+        }
+        
         switch (data.type) {
+            case 'redirigir':
+                this.wsUrl = data.url;
+                this.redirigiendo = true;
+                this.esperaRedireccion = data.reintentar || 0;
+                break;
+                
             case 'partida_updated':
-                // Forzar recarga si el número de eliminados aumenta
-                if (this.currentPartidaData && data.data.jugadores_eliminados > this.currentPartidaData.jugadores_eliminados) {
-                    this.showNotification('Un jugador ha sido eliminado', 'danger');
-                    setTimeout(() => window.location.reload(), 1000);
-                    return;
-                }
+                // Estado completo: sustituye al que tuviéramos
+                this.version = data.data.version;
+                this.aplicarPartidaData(data.data);
+                break;
                 
-                // También detectar si hay cambios en la lista de jugadores
-                if (this.currentPartidaData && this.currentPartidaData.jugadores) {
-                    const jugadoresActuales = this.currentPartidaData.jugadores;
-                    const jugadoresNuevos = data.data.jugadores;
-                    
-                    const cambiosDetectados = jugadoresActuales.some((jugadorActual, index) => {
-                        const jugadorNuevo = jugadoresNuevos[index];
-                        return jugadorActual.eliminado !== jugadorNuevo.eliminado;
-                    });
-                    
-                    if (cambiosDetectados) {
-                        this.showNotification('Un jugador ha sido eliminado', 'danger');
-                        setTimeout(() => window.location.reload(), 1000);
-                        return;
-                    }
-                    
-                    // Detectar si un impostor eliminado intentó adivinar (cambios en puntos o estado)
-                    const cambiosImpostor = jugadoresActuales.some((jugadorActual, index) => {
-                        const jugadorNuevo = jugadoresNuevos[index];
-                        // Si es un impostor eliminado y sus puntos cambiaron, probablemente intentó adivinar
-                        if (jugadorActual.es_impostor && jugadorActual.eliminado && 
-                            jugadorNuevo.es_impostor && jugadorNuevo.eliminado &&
-                            jugadorActual.puntos !== jugadorNuevo.puntos) {
-                            return true;
-                        }
-                        return false;
-                    });
-                    
-                    if (cambiosImpostor) {
-                        this.showNotification('Un impostor eliminado intentó adivinar la palabra', 'info');
-                        setTimeout(() => window.location.reload(), 1000);
-                        return;
-                    }
-                }
+            case 'partida_delta':
+                this.aplicarDelta(data);
+                break;
                 
-                this.currentPartidaData = data.data;
-                this.updatePartidaUI(data.data);
+            case 'lote':
+                // Mensajes agrupados por el servidor en un mismo envío: se aplican en orden
+                data.mensajes.forEach(mensaje => this.handleMessage(mensaje));
                 break;
                 
-            case 'user_connected':
-                this.showNotification(`${data.username} se ha unido a la partida`, 'success');
+            case 'presencia':
+                // Entradas y salidas de la sala agrupadas; las recargas de página no llegan aquí
+                data.conectados.forEach(username => {
+                    this.showNotification(`${username} se ha unido a la partida`, 'success');
+                });
+                data.desconectados.forEach(username => {
+                    this.showNotification(`${username} se ha desconectado`, 'warning');
+                });
+                if (this.currentPartidaData) {
+                    this.currentPartidaData.presentes = data.presentes;
+                }
                 break;
                 
-            case 'user_disconnected':
-                this.showNotification(`${data.username} se ha desconectado`, 'warning');
+            case 'latido':
                 break;
                 
             case 'jugador_eliminado':
                 this.showNotification('Un jugador ha sido eliminado', 'danger');
-                setTimeout(() => window.location.reload(), 1000);
                 break;
                 
             case 'jugador_expulsado':
-                this.showNotification('Un jugador ha sido expulsado de la partida', 'warning');
-                setTimeout(() => window.location.reload(), 1000);
+                if (data.user_id === this.userId) {
+                    this.showNotification('Has sido expulsado de la partida', 'danger');
+                    setTimeout(() => {
+                        window.location.href = '/';
+                    }, 2000);
+                } else {
+                    this.showNotification('Un jugador ha sido expulsado de la partida', 'warning');
+                }
                 break;
                 
             case 'partida_iniciada':
                 this.showNotification(data.message, 'success');
-                setTimeout(() => window.location.reload(), 1000);
-                setTimeout(() => window.location.reload(), 3000);
                 break;
                 
             case 'nueva_ronda_iniciada':
                 this.showNotification(data.message, 'success');
-                setTimeout(() => window.location.reload(), 1000);
-                setTimeout(() => window.location.reload(), 3000);
                 break;
                 
             case 'partida_terminada':
@@ -139,9 +276,13 @@ class PartidaWebSocket {
                 this.showNotification(data.message, 'danger');
                 break;
                 
+            case 'ocupado':
+                // El servidor ha descartado el refresh_request por estar saturado: repetirlo más tarde
+                setTimeout(() => this.sendMessage('refresh_request', { version: this.version }), data.reintentar);
+                break;
+                
             case 'ronda_terminada':
                 this.showNotification(data.message, 'warning');
-                setTimeout(() => window.location.reload(), 2000);
                 break;
                 
             case 'adivinacion_resultado':
@@ -149,211 +290,129 @@ class PartidaWebSocket {
                     this.showNotification(data.resultado.error, 'danger');
                 } else {
                     this.showNotification(data.resultado.mensaje, data.resultado.correcto ? 'success' : 'warning');
-                    // Recargar la página después de mostrar el resultado de la adivinación
-                    setTimeout(() => window.location.reload(), 2000);
                 }
                 break;
         }
     }
 
-    updatePuntuacionTable(jugadores) {
-        const tbody = document.querySelector('#puntuacion-table tbody');
-        if (!tbody) return;
-
-        tbody.innerHTML = '';
-        
-        jugadores.forEach(jugador => {
-            const row = document.createElement('tr');
-            row.innerHTML = `
-                <td>
-                    ${jugador.username}
-                    ${jugador.es_host ? '<span class="badge bg-success ms-2">Host</span>' : ''}
-                </td>
-                <td><span class="badge bg-warning points">${jugador.puntos}</span></td>
-                <td>${jugador.ronda_actual}</td>
-            `;
-            tbody.appendChild(row);
+    aplicarFragmentos(fragmentos) {
+        // Sustituir en el sitio solo los contenedores que han cambiado
+        Object.keys(fragmentos).forEach(nombre => {
+            const contenedor = document.getElementById(`fragmento-${nombre}`);
+            if (contenedor) {
+                contenedor.innerHTML = fragmentos[nombre];
+            }
         });
     }
 
-    updatePlayerCounters(partidaData) {
-        const activosElement = document.querySelector('#jugadores-activos-count');
-        const eliminadosElement = document.querySelector('#jugadores-eliminados-count');
-        
-        if (activosElement) {
-            activosElement.textContent = partidaData.jugadores_activos;
-        }
-        if (eliminadosElement) {
-            eliminadosElement.textContent = partidaData.jugadores_eliminados;
-        }
+    cargarFragmentos(nombres = []) {
+        const params = new URLSearchParams();
+        nombres.forEach(nombre => params.append('f', nombre));
+        return fetch(`/blanco/partida/${this.codigoPartida}/fragmentos/?${params}`, { credentials: 'same-origin' })
+            .then(response => response.ok ? response.json() : null)
+            .then(data => {
+                if (data) {
+                    this.aplicarFragmentos(data.fragmentos);
+                }
+            })
+            .catch(error => console.error('Error al cargar fragmentos:', error));
     }
 
-    updateGameState(partidaData) {
-        const estadoElement = document.querySelector('#estado-partida');
-        if (estadoElement) {
-            estadoElement.textContent = partidaData.estado === 'en_juego' ? 'En juego' : 'Esperando';
+    aplicarPartidaData(partidaData) {
+        const anterior = this.currentPartidaData;
+        
+        if (anterior && anterior.jugadores) {
+            // Avisar de los cambios relevantes; la página ya se actualiza con los fragmentos
+            const eliminados = partidaData.jugadores.filter(jugadorNuevo => {
+                const jugadorActual = anterior.jugadores.find(j => j.id === jugadorNuevo.id);
+                return jugadorActual && !jugadorActual.eliminado && jugadorNuevo.eliminado;
+            });
+            
+            if (eliminados.length > 0) {
+                this.showNotification('Un jugador ha sido eliminado', 'danger');
+            }
         }
+        
+        this.currentPartidaData = partidaData;
+    }
 
-        const puntuacionRow = document.querySelector('.row.mb-4');
-        if (puntuacionRow) {
-            puntuacionRow.style.display = partidaData.estado === 'en_juego' ? 'block' : 'none';
+    aplicarDelta(delta) {
+        // Sin estado completo o con una versión perdida, pedir el snapshot al servidor
+        const base = this.currentPartidaData;
+        if (this.version === null || !base || !base.jugadores || delta.version !== this.version + 1) {
+            this.sendMessage('refresh_request', { version: this.version });
+            return;
         }
-
-        const botonesJuego = document.querySelectorAll('.boton-juego');
-        botonesJuego.forEach(boton => {
-            boton.style.display = partidaData.estado === 'en_juego' ? 'inline-block' : 'none';
+        this.version = delta.version;
+        
+        const quitados = delta.quitados || [];
+        const cambiosJugadores = delta.jugadores || {};
+        const jugadores = base.jugadores
+            .filter(jugador => !quitados.includes(jugador.id))
+            .map(jugador => Object.assign({}, jugador, cambiosJugadores[jugador.id] || {}));
+        
+        // Jugadores que llegan nuevos a la sala
+        const existentes = new Set(jugadores.map(jugador => String(jugador.id)));
+        Object.keys(cambiosJugadores).forEach(id => {
+            if (!existentes.has(id)) {
+                jugadores.push(cambiosJugadores[id]);
+            }
         });
-
-        this.updateStartButton(partidaData);
+        
+        const partidaData = Object.assign({}, base, delta.partida || {}, { jugadores: jugadores, version: delta.version });
+        if (delta.privado && delta.privado.palabra_secreta !== undefined) {
+            partidaData.palabra_secreta = delta.privado.palabra_secreta;
+        }
+        this.aplicarPartidaData(partidaData);
     }
 
-    updateStartButton(partidaData) {
-        const hostControls = document.querySelector('.mt-4');
-        if (!hostControls) return;
-
-        let startButton = hostControls.querySelector('#start-game-button');
-        let warningDiv = hostControls.querySelector('#warning-message');
+    iniciarLatido() {
+        this.detenerLatido();
+        this.latido = setInterval(() => {
+            this.sendMessage('latido');
+        }, this.intervaloLatido);
+    }
 
-        const oldButtons = hostControls.querySelectorAll('button[onclick*="iniciarPartida"]');
-        const oldWarnings = hostControls.querySelectorAll('.alert-warning');
-        
-        oldButtons.forEach(btn => {
-            if (!btn.id) btn.remove();
-        });
-        oldWarnings.forEach(warn => {
-            if (!warn.id) warn.remove();
-        });
+    detenerLatido() {
+        if (this.latido) {
+            clearInterval(this.latido);
+            this.latido = null;
+        }
+    }
 
-        if (partidaData.jugadores_activos >= 4 && partidaData.estado !== 'en_juego') {
-            if (warningDiv) {
-                warningDiv.style.display = 'none';
-            }
-            
-            if (!startButton) {
-                startButton = document.createElement('button');
-                startButton.id = 'start-game-button';
-                startButton.type = 'button';
-                startButton.className = 'btn btn-success mt-2';
-                startButton.onclick = () => this.iniciarPartida();
-                startButton.textContent = 'Empezar partida';
-                hostControls.appendChild(startButton);
-            } else {
-                startButton.style.display = 'inline-block';
-            }
-        } else if (partidaData.estado !== 'en_juego') {
-            if (startButton) {
-                startButton.style.display = 'none';
-            }
-            
-            if (!warningDiv) {
-                warningDiv = document.createElement('div');
-                warningDiv.id = 'warning-message';
-                warningDiv.className = 'alert alert-warning mt-2';
-                warningDiv.textContent = 'Se necesitan al menos 4 jugadores para empezar la partida.';
-                hostControls.appendChild(warningDiv);
-            } else {
-                warningDiv.style.display = 'block';
-            }
-        } else {
-            if (startButton) {
-                startButton.style.display = 'none';
-            }
-            if (warningDiv) {
-                warningDiv.style.display = 'none';
-            }
+    subprotocolos() {
+        // Con compresión se ofrece primero la variante '+deflate'; el servidor elige la primera que admite
+        const base = this.protocolo.subprotocolo;
+        if (this.protocolo.compresion && PartidaWebSocket.admiteDeflate()) {
+            return [`${base}+${this.protocolo.compresion}`, base];
         }
+        return [base];
     }
 
-    updatePlayerLists(jugadores) {
-        const activosList = document.querySelector('#jugadores-activos-list');
-        if (activosList) {
-            activosList.innerHTML = '';
-            const jugadoresActivos = jugadores.filter(j => !j.eliminado);
-            
-            jugadoresActivos.forEach(jugador => {
-                const li = document.createElement('li');
-                li.className = 'list-group-item bg-dark text-light d-flex justify-content-between align-items-center';
-                
-                const hostControls = document.querySelector('.mt-4');
-                const isHost = hostControls !== null;
-                
-                let buttonsHtml = '';
-                if (isHost) {
-                    const partidaData = this.getCurrentPartidaData();
-                    
-                    if (partidaData && partidaData.estado !== 'en_juego') {
-                        buttonsHtml = `
-                            <button type="button" class="btn btn-sm btn-danger" onclick="partidaWS.expulsarJugador(${jugador.user_id})">
-                                Expulsar
-                            </button>
-                        `;
-                    } else if (partidaData && partidaData.estado === 'en_juego' && !partidaData.ronda_terminada) {
-                        buttonsHtml = `
-                            <button type="button" class="btn btn-sm btn-warning boton-juego" onclick="partidaWS.eliminarJugador(${jugador.id})">
-                                Eliminar de ronda
-                            </button>
-                        `;
-                    }
-                }
-                
-                li.innerHTML = `
-                    <span>
-                        ${jugador.username}
-                        ${jugador.es_host ? '<span class="badge bg-success ms-2">Host</span>' : ''}
-                    </span>
-                    ${buttonsHtml}
-                `;
-                activosList.appendChild(li);
-            });
+    static admiteDeflate() {
+        try {
+            new DecompressionStream('deflate-raw');
+            return true;
+        } catch (error) {
+            return false;
         }
+    }
 
-        let eliminadosList = document.querySelector('#jugadores-eliminados-list');
-        const jugadoresEliminados = jugadores.filter(j => j.eliminado);
-        
-        let eliminadosContainer = eliminadosList ? eliminadosList.closest('.col-md-6') : null;
-        if (!eliminadosContainer) {
-            const row = document.querySelector('.row');
-            if (row) {
-                eliminadosContainer = document.createElement('div');
-                eliminadosContainer.className = 'col-md-6';
-                eliminadosContainer.innerHTML = `
-                    <h4>Eliminados de la ronda (<span id="jugadores-eliminados-count">${jugadoresEliminados.length}</span>)</h4>
-                    <ul id="jugadores-eliminados-list" class="list-group list-group-flush mb-3">
-                    </ul>
-                `;
-                row.appendChild(eliminadosContainer);
-                eliminadosList = eliminadosContainer.querySelector('#jugadores-eliminados-list');
-            }
+    static leerTrama(datos) {
+        if (typeof datos === 'string') {
+            return datos;
         }
-        
-        if (eliminadosList) {
-            eliminadosList.innerHTML = '';
-            
-            jugadoresEliminados.forEach(jugador => {
-                const li = document.createElement('li');
-                li.className = 'list-group-item bg-secondary text-light d-flex justify-content-between align-items-center';
-                li.innerHTML = `
-                    <span>
-                        ${jugador.username}
-                        ${jugador.es_host ? '<span class="badge bg-success ms-2">Host</span>' : ''}
-                        ${jugador.es_impostor ? '<span class="badge bg-danger ms-2">Impostor</span>' : ''}
-                        ${jugador.es_infiltrado ? '<span class="badge bg-warning ms-2">Infiltrado</span>' : ''}
-                        ${jugador.es_bueno ? '<span class="badge bg-info ms-2">Bueno</span>' : ''}
-                    </span>
-                    <span class="badge bg-secondary">Eliminado</span>
-                `;
-                eliminadosList.appendChild(li);
-            });
-            
-            const countElement = document.querySelector('#jugadores-eliminados-count');
-            if (countElement) {
-                countElement.textContent = jugadoresEliminados.length;
-            }
-            
-            if (eliminadosContainer) {
-                eliminadosContainer.style.display = jugadoresEliminados.length > 0 ? 'block' : 'none';
-            }
+        const flujo = new Blob([datos]).stream().pipeThrough(new DecompressionStream('deflate-raw'));
+        return new Response(flujo).text();
+    }
+
+    decodificar(texto) {
+        // Las tramas compactas son listas [versión, mensaje]; los mensajes JSON normales, objetos
+        const datos = JSON.parse(texto);
+        if (Array.isArray(datos) && this.protocolo) {
+            return this.protocolo.decodificar(datos);
         }
+        return datos;
     }
 
     sendMessage(type, data = {}) {
@@ -362,7 +421,7 @@ class PartidaWebSocket {
                 type: type,
                 ...data
             };
-            this.socket.send(JSON.stringify(message));
+            this.socket.send(this.compacto ? this.protocolo.codificar(message) : JSON.stringify(message));
         }
     }
 
@@ -452,63 +511,4 @@ class PartidaWebSocket {
             this.socket.close();
         }
     }
-
-    getCurrentPartidaData() {
-        if (this.currentPartidaData) {
-            return this.currentPartidaData;
-        }
-        
-        const estadoElement = document.querySelector('#estado-partida');
-        const rondaTerminada = document.querySelector('.badge.bg-warning') !== null;
-        
-        if (estadoElement) {
-            return {
-                estado: estadoElement.textContent === 'En juego' ? 'en_juego' : 'esperando',
-                ronda_terminada: rondaTerminada
-            };
-        }
-        return null;
-    }
-
-    initializePartidaData() {
-        const activosCount = document.querySelector('#jugadores-activos-count');
-        const eliminadosCount = document.querySelector('#jugadores-eliminados-count');
-        const estadoElement = document.querySelector('#estado-partida');
-        
-        this.currentPartidaData = {
-            jugadores_activos: activosCount ? parseInt(activosCount.textContent) : 0,
-            jugadores_eliminados: eliminadosCount ? parseInt(eliminadosCount.textContent) : 0,
-            estado: estadoElement ? (estadoElement.textContent === 'En juego' ? 'en_juego' : 'esperando') : 'esperando',
-            ronda_terminada: document.querySelector('.badge.bg-warning') !== null
-        };
-        
-        if (this.currentPartidaData.estado === 'en_juego') {
-            setTimeout(() => window.location.reload(), 2000);
-        }
-    }
-
-    updatePalabraSecreta(palabraSecreta) {
-        const estadoElement = document.querySelector('#estado-partida');
-        if (estadoElement && estadoElement.textContent !== 'En juego') {
-            return;
-        }
-        
-        const palabraElement = document.querySelector('.alert-primary .display-6');
-        if (palabraElement && palabraSecreta) {
-            if (palabraSecreta.includes("¡Impostor!")) {
-                palabraElement.innerHTML = `<b>${palabraSecreta}</b>`;
-            } else {
-                palabraElement.innerHTML = `Tu palabra secreta: <b>${palabraSecreta}</b>`;
-            }
-        }
-    }
-
-    updatePartidaUI(partidaData) {
-        this.currentPartidaData = partidaData;
-        this.updatePuntuacionTable(partidaData.jugadores);
-        this.updatePlayerCounters(partidaData);
-        this.updateGameState(partidaData);
-        this.updatePlayerLists(partidaData.jugadores);
-        this.updatePalabraSecreta(partidaData.palabra_secreta);
-    }
-} 
\ No newline at end of file
+}